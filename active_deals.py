@@ -0,0 +1,73 @@
+# ================== ACTIVE DEAL INDEX ==================
+#
+# Every active deal, keyed by escrow message id and indexed by group and
+# by admin. database.py loads it once from Mongo and keeps it in step with
+# its own writes (store / complete / remove), so it is authoritative for
+# "is this deal active?" and for /running and /mydeals.
+#
+# It also keeps each admin's open exposure (sum of open deal amounts per
+# currency), which /add checks against the admin's limit.
+
+
+class ActiveDeals:
+
+    def __init__(self):
+        self.by_id = {}         # "escrow msg id" -> deal doc
+        self.by_group = {}      # group_id -> {escrow id: deal}
+        self.by_admin = {}      # admin_id -> {escrow id: deal}
+        self.exposure = {}      # admin_id -> {currency: open amount}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def load(self, docs):
+        self.by_id.clear()
+        self.by_group.clear()
+        self.by_admin.clear()
+        self.exposure.clear()
+        for doc in docs:
+            self.add(doc)
+        self.loaded = True
+
+    def add(self, deal):
+        deal_id = str(deal["_id"])
+        self.remove(deal_id)
+        self.by_id[deal_id] = deal
+        self.by_group.setdefault(deal.get("group_id"), {})[deal_id] = deal
+        self.by_admin.setdefault(deal.get("admin_id"), {})[deal_id] = deal
+        self._expose(deal, 1)
+
+    def remove(self, deal_id):
+        deal = self.by_id.pop(str(deal_id), None)
+        if deal is None:
+            return None
+        for index, key in ((self.by_group, deal.get("group_id")), (self.by_admin, deal.get("admin_id"))):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(str(deal_id), None)
+                if not bucket:
+                    del index[key]
+        self._expose(deal, -1)
+        return deal
+
+    def _expose(self, deal, sign):
+        admin_id, currency = deal.get("admin_id"), deal.get("currency")
+        if admin_id is None or not currency:
+            return
+        totals = self.exposure.setdefault(admin_id, {})
+        totals[currency] = totals.get(currency, 0) + sign * (deal.get("amount") or 0)
+        if not any(totals.values()):
+            del self.exposure[admin_id]
+
+    def get(self, deal_id):
+        return self.by_id.get(str(deal_id))
+
+    def for_group(self, group_id):
+        return list(self.by_group.get(group_id, {}).values())
+
+    def for_admin(self, admin_id):
+        return list(self.by_admin.get(admin_id, {}).values())
+
+    def exposure_of(self, admin_id, currency):
+        return self.exposure.get(admin_id, {}).get(currency, 0)
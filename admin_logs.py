@@ -1,17 +1,20 @@
 import os
 import time
-from database import db
+from datetime import datetime, timezone
+from database import db, write_buffer
 
 LOG_CHANNEL = os.getenv("LOG_CHANNEL")
 
 logs_col = db.logs if "logs" in db.list_collection_names() else db.create_collection("logs")
 
 async def send_log(client, text: str):
-    # Save log in MongoDB
-    logs_col.insert_one({
+    # Save log in MongoDB (batched, see writebehind.py)
+    write_buffer.insert(logs_col, {
         "text": text,
-        "time": time.time()
+        "time": time.time(),
+        "at": datetime.now(timezone.utc)  # TTL, see retention.py
     })
+    await write_buffer.maybe_flush()
 
     # Send to Telegram log channel (if set)
     if LOG_CHANNEL:
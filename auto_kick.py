@@ -1,51 +1,103 @@
 import asyncio
+import logging
+import os
 import time
 from telethon.tl.functions.channels import EditBannedRequest
 from telethon.tl.types import ChatBannedRights
 
-from database import deals_col
+import database
+import entities
+from sender import KICK, send_queue
+from timers import timer_wheel
+
+LOGGER = logging.getLogger(__name__)
 
 AUTO_KICK_TIME = 600  # 10 minutes
+KICK_CONCURRENCY = int(os.getenv("KICK_CONCURRENCY", "5"))
+KICK_USERNAME_MAX_AGE = int(os.getenv("KICK_USERNAME_MAX_AGE", "3600"))    # seconds
 
 BANNED_RIGHTS = ChatBannedRights(
     until_date=None,
     view_messages=True
 )
 
-async def auto_kick_worker(client):
-    while True:
-        now = time.time()
+# ================== AUTO KICK ==================
+#
+# A completed deal schedules one "kick:<deal id>" timer (timers.py) that
+# bans its buyer and seller AUTO_KICK_TIME later and archives the deal.
+# Timers are persisted; completed deals from before that are picked up
+# again on startup (same timer id, so nothing is scheduled twice).
+
+_sem = asyncio.Semaphore(KICK_CONCURRENCY)
+_scheduled = set()      # deal ids this process scheduled, until archived
+_kicking = set()        # deal ids whose kick is running
+
+
+def schedule_kick(deal):
+    """Schedule the kick for a just-completed deal."""
+    targets = [u for u in (deal.get("buyer"), deal.get("seller")) if u]
+    _scheduled.add(str(deal["_id"]))
+    timer_wheel.schedule(
+        "kick",
+        deal.get("completed_at", time.time()) + AUTO_KICK_TIME,
+        {"deal_id": str(deal["_id"]), "group_id": deal.get("group_id"), "targets": targets},
+        timer_id=f"kick:{deal['_id']}", chat_id=deal.get("group_id")
+    )
+
 
-        # completed deals fetch
-        deals = deals_col.find({"status": "completed"})
+async def _load_pending(owns):
+    # the deals this process scheduled itself may already be kicked with
+    # the archive still in flight; the rest (restart, or chats taken over
+    # from another worker) are either loaded timers or need one
+    for deal in await database.get_completed_deals():
+        if str(deal["_id"]) not in _scheduled and owns(deal.get("group_id")):
+            schedule_kick(deal)
 
-        async for deal in _iterate(deals):
-            if now - deal.get("completed_at", 0) >= AUTO_KICK_TIME:
-                chat_id = deal.get("group_id")
+timer_wheel.startup.append(_load_pending)
 
-                for user_id in (deal.get("buyer"), deal.get("seller")):
-                    if not user_id or not chat_id:
-                        continue
 
-                    try:
-                        await client(EditBannedRequest(
-                            channel=chat_id,
-                            participant=user_id,
-                            banned_rights=BANNED_RIGHTS
-                        ))
-                    except Exception:
-                        pass
+async def _kick(client, chat_id, user_id):
+    async with _sem:
+        try:
+            await send_queue.call(chat_id, lambda: client(EditBannedRequest(
+                channel=chat_id,
+                participant=user_id,
+                banned_rights=BANNED_RIGHTS
+            )), KICK)
+        except Exception:
+            pass  # already logged / retried by the send queue
 
-                # mark as archived to avoid double kick
-                deals_col.update_one(
-                    {"_id": deal["_id"]},
-                    {"$set": {"status": "archived"}}
-                )
 
-        await asyncio.sleep(30)
+@timer_wheel.handler("kick")
+async def _kick_deal(client, payload):
+    deal_id = payload["deal_id"]
+    if deal_id in _kicking:
+        # a takeover loads the timer, schedules it and replays the outbox:
+        # one run at a time, the next one finds the deal archived
+        return
+    _kicking.add(deal_id)
+    try:
+        await _run_kick(client, payload)
+    finally:
+        _kicking.discard(deal_id)
 
 
-# 🔁 helper: async mongo cursor
-async def _iterate(cursor):
-    for doc in cursor:
-        yield doc
+async def _run_kick(client, payload):
+    chat_id = payload.get("group_id")
+    targets = payload.get("targets", [])
+    deal = await database.find_deal(payload["deal_id"])
+    if deal is not None and deal.get("status") == "archived":
+        # kicked already: an outbox replay or a takeover scheduled it again
+        _scheduled.discard(payload["deal_id"])
+        return
+    if chat_id and targets:
+        # the form has @usernames: resolve them through the entity cache
+        # (one Mongo query for the lot) instead of per-ban inside Telethon;
+        # only recent mappings, a username may belong to someone else now
+        ids = await entities.resolve(client, [u for u in targets if isinstance(u, str)],
+                                     max_age=KICK_USERNAME_MAX_AGE)
+        targets = [ids.get(u) or u if isinstance(u, str) else u for u in targets]
+        await asyncio.gather(*(_kick(client, chat_id, user_id) for user_id in targets))
+    # mark as archived to avoid double kick
+    await database.archive_deals([payload["deal_id"]])
+    _scheduled.discard(payload["deal_id"])
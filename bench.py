@@ -0,0 +1,672 @@
+"""Offline benchmarks for the escrow bot.
+
+Drives register_handlers() with synthetic NewMessage / CallbackQuery
+events through a fake Telegram client (records sends, pins, deletes and
+kicks) against the chosen storage backend (in-memory by default, so no
+network and no Mongo server).
+
+    python bench.py                       # all scenarios
+    python bench.py add --deals 500 --groups 50
+    python bench.py form --messages 20000
+    python bench.py complete --tg-latency 20
+    python bench.py parse --messages 200000   # form parser micro-benchmark
+    python bench.py shards --workers 3        # multi-process sharding, no double processing
+    python bench.py --backend sqlite      # same workload, other backend
+    MONGO_URI=mongodb://... python bench.py --backend mongo
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from types import SimpleNamespace
+
+# must be set before the bot modules read their config
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("LEASE_BACKEND", "mongo")
+os.environ.setdefault("TIMER_TICK", "0.01")
+
+OWNER_ID = 1
+ADMIN_BASE = 1000
+USER_BASE = 50000
+
+_msg_ids = itertools.count(1)
+
+
+# ================== FAKE TELEGRAM ==================
+
+class FakeMessage:
+
+    def __init__(self, client, chat_id, text, sender_id, reply_to=None, msg_id=None):
+        self.client = client
+        self.id = msg_id or next(_msg_ids)
+        self.chat_id = chat_id
+        self.text = self.raw_text = self.message = text
+        self.sender_id = sender_id
+        self.reply_to_msg_id = reply_to
+        client.messages[(chat_id, self.id)] = self
+
+    async def delete(self):
+        await self.client._act("delete")
+        self.client.messages.pop((self.chat_id, self.id), None)
+
+
+class FakeNewMessage:
+
+    def __init__(self, client, message):
+        self.client = client
+        self.message = message
+        self.id = message.id
+        self.raw_text = self.text = message.text
+        self.chat_id = message.chat_id
+        self.sender_id = message.sender_id
+        self.is_group = message.chat_id < 0
+        self.is_private = not self.is_group
+        self.reply_to_msg_id = message.reply_to_msg_id
+        self.is_reply = self.reply_to_msg_id is not None
+        self.pattern_match = None
+
+    async def reply(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.message.id)
+
+    async def respond(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    async def get_reply_message(self):
+        await self.client._act("get_reply_message")
+        return self.client.messages.get((self.chat_id, self.message.reply_to_msg_id))
+
+    async def get_sender(self):
+        await self.client._act("get_sender")
+        return SimpleNamespace(id=self.sender_id, username=f"user{self.sender_id}",
+                               first_name=f"User {self.sender_id}")
+
+    async def delete(self):
+        await self.message.delete()
+
+
+class FakeCallback:
+
+    def __init__(self, client, chat_id, msg_id, sender_id, data):
+        self.client = client
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.data = data
+        self._msg_id = msg_id
+
+    async def get_message(self):
+        await self.client._act("get_message")
+        return self.client.messages.get((self.chat_id, self._msg_id))
+
+    async def answer(self, text=None, alert=False):
+        await self.client._act("answer")
+
+    async def respond(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+
+class FakeClient:
+    """Just enough of TelegramClient for handlers.py and auto_kick.py."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.actions = Counter()
+        self.messages = {}
+        self.message_handlers = []
+        self.callback_handlers = []
+        self.edit_handlers = []
+        self.sent = {}     # chat_id -> [FakeMessage]
+
+    async def _act(self, name):
+        self.actions[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # ----- registration -----
+
+    def add_event_handler(self, fn, builder):
+        from telethon import events
+        if isinstance(builder, events.CallbackQuery):
+            self.callback_handlers.append((builder, fn))
+        elif isinstance(builder, events.MessageEdited):
+            self.edit_handlers.append(fn)
+        else:
+            self.message_handlers.append(fn)
+
+    def on(self, builder):
+        def deco(fn):
+            self.add_event_handler(fn, builder)
+            return fn
+        return deco
+
+    # ----- outbound API -----
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        await self._act("send_message")
+        msg = FakeMessage(self, chat_id, text, sender_id=0, reply_to=reply_to)
+        self.sent.setdefault(chat_id, []).append(msg)
+        return msg
+
+    async def pin_message(self, chat_id, message):
+        await self._act("pin")
+
+    async def unpin_message(self, chat_id, message=None):
+        await self._act("unpin")
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self._act("delete")
+
+    async def get_permissions(self, chat_id, user_id):
+        await self._act("get_permissions")
+        return SimpleNamespace(is_creator=user_id == OWNER_ID)
+
+    async def get_entity(self, entity):
+        await self._act("get_entity")
+        if isinstance(entity, list):
+            return [SimpleNamespace(id=e, username=f"user{e}", first_name=f"User {e}") for e in entity]
+        name = entity.lstrip("@")
+        user_id = int(name[4:]) if name.startswith("user") and name[4:].isdigit() else USER_BASE + zlib.crc32(name.encode()) % 10 ** 6
+        return SimpleNamespace(id=user_id, username=name, first_name=name)
+
+    async def __call__(self, request):
+        await self._act(type(request).__name__)
+
+    # ----- inbound simulation -----
+
+    def post(self, chat_id, sender_id, text, reply_to=None, msg_id=None):
+        """Create a message as if a user sent it (no handlers run)."""
+        return FakeMessage(self, chat_id, text, sender_id, reply_to, msg_id)
+
+    async def incoming(self, chat_id, sender_id, text, reply_to=None, msg_id=None):
+        event = FakeNewMessage(self, self.post(chat_id, sender_id, text, reply_to, msg_id))
+        for fn in self.message_handlers:
+            await fn(event)
+        return event
+
+    async def click(self, chat_id, msg_id, sender_id, data):
+        event = FakeCallback(self, chat_id, msg_id, sender_id, data)
+        for builder, fn in self.callback_handlers:
+            if builder.match(data):
+                await fn(event)
+
+
+# ================== HARNESS ==================
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def timed(coro, latencies):
+    started = time.perf_counter()
+    await coro
+    latencies.append(time.perf_counter() - started)
+
+
+async def run_concurrently(coros, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(coro):
+        async with sem:
+            await timed(coro, latencies)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(c) for c in coros))
+    return latencies, time.perf_counter() - started
+
+
+def db_calls():
+    import metrics
+    return sum(metrics.counts("db_seconds").values())
+
+
+def report(name, latencies, wall, client, db_before, extra=""):
+    n = len(latencies)
+    print(
+        f"{name:<10} {n:>7} ev  {wall:>7.2f}s  {n / wall if wall else 0:>9.0f} ev/s  "
+        f"p50 {percentile(latencies, .50) * 1000:>7.2f}ms  "
+        f"p95 {percentile(latencies, .95) * 1000:>7.2f}ms  "
+        f"p99 {percentile(latencies, .99) * 1000:>7.2f}ms  "
+        f"db {db_calls() - db_before:>6}  {extra}"
+    )
+    top = ", ".join(f"{k}={v}" for k, v in client.actions.most_common(6))
+    print(f"{'':<10} telegram: {top}")
+
+
+def form_text(i):
+    return (f"@admins\nSeller: @seller{i}\nBuyer: @buyer{i}\nAmount: {100 + i}\n"
+            f"Payment Method: UPI\nRelease to : @seller{i}")
+
+
+async def setup(groups, admins):
+    import database
+    from group_auth import authorize_group
+    for g in groups:
+        await authorize_group(g)
+    for a in admins:
+        await database.set_admin_limit(a, is_mod=True)
+
+
+async def open_deals(client, groups, deals, concurrency, dupes=0.0):
+    """Post one form per deal and /add them all concurrently."""
+    jobs = []
+    for i in range(deals):
+        chat = groups[i % len(groups)]
+        admin = ADMIN_BASE + i % len(groups)
+        form = await client.incoming(chat, USER_BASE + i, form_text(i))
+        jobs.append((chat, admin, form.id))
+    if dupes:
+        jobs += random.sample(jobs, int(len(jobs) * dupes))
+        random.shuffle(jobs)
+    coros = [client.incoming(chat, admin, f"/add {random.randint(10, 900)} inr", reply_to=form_id)
+             for chat, admin, form_id in jobs]
+    return await run_concurrently(coros, concurrency)
+
+
+# ================== SCENARIOS ==================
+
+async def scenario_add(args):
+    import database
+    from handlers import register_handlers
+    client = FakeClient(args.tg_latency / 1000)
+    register_handlers(client)
+    groups = [-(10 ** 12) - g for g in range(args.groups)]
+    await setup(groups, [ADMIN_BASE + g for g in range(args.groups)])
+
+    before_db = db_calls()
+    before_deals = await database.db_call(database.deals_col.count_documents, {})
+    latencies, wall = await open_deals(client, groups, args.deals, args.concurrency, dupes=args.dupes)
+    stored = await database.db_call(database.deals_col.count_documents, {}) - before_deals
+    ok = "OK" if stored == args.deals else f"MISMATCH stored={stored}"
+    report("add", latencies, wall, client, before_db, f"deals={stored}/{args.deals} {ok}")
+
+
+async def scenario_form(args):
+    from handlers import register_handlers
+    client = FakeClient(args.tg_latency / 1000)
+    register_handlers(client)
+    groups = [-(10 ** 12) - g for g in range(args.groups)]
+    await setup(groups, [])
+
+    words = ["hi", "deal done?", "bro check dm", "ok", "form", "FORM", "price?", "/unknown", "👍"]
+    coros = [client.incoming(groups[i % len(groups)], USER_BASE + i, random.choice(words))
+             for i in range(args.messages)]
+    for g in groups:   # warm the config cache; steady state should be 0 db calls
+        await client.incoming(g, USER_BASE, "form")
+    before_db = db_calls()
+    latencies, wall = await run_concurrently(coros, args.concurrency)
+    report("form", latencies, wall, client, before_db)
+
+
+async def scenario_complete(args):
+    import auto_kick
+    import database
+    import timers
+    from handlers import register_handlers
+    client = FakeClient(args.tg_latency / 1000)
+    register_handlers(client)
+    groups = [-(10 ** 12) - g for g in range(args.groups)]
+    await setup(groups, [ADMIN_BASE + g for g in range(args.groups)])
+    await open_deals(client, groups, args.deals, args.concurrency)
+
+    running = await database.get_running_deals()
+    clicks = [
+        client.click(d["group_id"], int(_id), d["admin_id"], f"comp_{d['admin_id']}".encode())
+        for _id, d in running.items()
+        if (d["group_id"], int(_id)) in client.messages   # skip earlier scenarios' deals
+    ]
+    auto_kick.AUTO_KICK_TIME = 0
+    kicker = asyncio.create_task(timers.timer_worker(client))
+
+    # every deal has a buyer and a seller in the form -> two kicks each
+    expected = client.actions["EditBannedRequest"] + 2 * len(clicks)
+    before_db = db_calls()
+    latencies, wall = await run_concurrently(clicks, args.concurrency)
+
+    started = time.perf_counter()
+    while client.actions["EditBannedRequest"] < expected and time.perf_counter() - started < 60:
+        await asyncio.sleep(0.01)
+    kick_wall = time.perf_counter() - started
+    kicker.cancel()
+    report("complete", latencies, wall, client, before_db,
+           f"kicks drained in {kick_wall:.2f}s")
+
+
+async def scenario_parse(args):
+    """Form parsing alone: the per-/add regex scans it replaced vs. the
+    compiled per-template parser (forms.py)."""
+    import re
+    import database
+    import forms
+    group = -(10 ** 12)
+    await setup([group], [])
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.json"), encoding="utf-8") as f:
+        template = json.load(f)["form_message"]
+    await database.update_form_message(template, chat_id=group)
+    texts = [form_text(i) for i in range(args.messages)]
+
+    def legacy(text):
+        seller = re.search(r'Seller:\s*(@?\w+)', text, re.IGNORECASE)
+        buyer = re.search(r'Buyer:\s*(@?\w+)', text, re.IGNORECASE)
+        t = text.lower()
+        m = re.findall(r'(\d+)\s*(inr|usdt|₹|\$|usd)', t) or re.findall(r'(\d+)', t)
+        return seller and seller.group(1), buyer and buyer.group(1), m
+
+    async def compiled(text):
+        return await forms.parse_form(group, text)
+
+    started = time.perf_counter()
+    for text in texts:
+        legacy(text)
+    legacy_wall = time.perf_counter() - started
+    await compiled(texts[0])      # compile + cache the template
+    before_db = db_calls()
+    started = time.perf_counter()
+    for text in texts:
+        await compiled(text)
+    wall = time.perf_counter() - started
+    n = len(texts)
+    fields = await compiled(texts[-1])
+    print(f"{'parse':<10} {n:>7} ev  {wall:>7.2f}s  {n / wall:>9.0f} ev/s  "
+          f"legacy (seller/buyer/amount only) {n / legacy_wall:.0f} ev/s  "
+          f"db {db_calls() - before_db:>6}  fields={len(fields)} {forms.compile_form.cache_info().currsize} compiled")
+
+
+# ================== MULTI-WORKER ==================
+#
+# `shards`: --workers bot processes with SHARD_SLOTS sharding on one shared
+# store (memstore.serve(), MONGO_URI=memory://host:port). This process
+# plays Telegram: every worker gets every update, one worker crashes, one
+# joins and one leaves while /adds and completions stream in. Afterwards
+# the store must show every form opened and started exactly once (pending
+# deals included), unique deal numbers, every deal counted once, archived,
+# announced and its pair kicked. Only a crashed worker may have announced
+# a deal or kicked its pair again (sent, then died before recording it),
+# posted a start message it never stored, or left a form taken that never
+# opened (died between activating its lease and storing the deal).
+
+
+class ShardClient(FakeClient):
+    """FakeClient that logs what it sends to the shared store, so the
+    parent can count side-effects across (even crashed) workers."""
+
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+
+    async def _log(self, doc):
+        import database
+        await database.db_call(database.db.bench_log.insert_one, {**doc, "worker": self.worker})
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        msg = await super().send_message(chat_id, text, reply_to=reply_to, **kwargs)
+        await self._log({"chat": chat_id, "text": text})
+        return msg
+
+    async def __call__(self, request):
+        await super().__call__(request)
+        await self._log({"chat": request.channel, "kick": request.participant})
+
+
+def _shard_worker(n, inbox, groups, admins):
+    global _msg_ids
+    _msg_ids = itertools.count((n + 1) * 10 ** 7)     # bot message ids: unique per worker
+    os.environ["WORKER_NAME"] = f"w{n}"
+    asyncio.run(_shard_worker_main(n, inbox, groups, admins))
+
+
+async def _shard_worker_main(n, inbox, groups, admins):
+    import auto_kick
+    import database
+    import shards
+    import timers
+    from handlers import register_handlers
+    from sender import send_queue
+    auto_kick.AUTO_KICK_TIME = 0
+    client = ShardClient(n)
+    register_handlers(client)
+    await setup(groups, admins)
+    await shards.shard_map.start()
+    background = [asyncio.create_task(shards.shard_worker()), asyncio.create_task(timers.timer_worker(client))]
+    loop = asyncio.get_running_loop()
+    while True:
+        kind, *update = await loop.run_in_executor(None, inbox.get)
+        if kind == "msg":
+            chat, sender, msg_id, text, reply_to, reply_text = update
+            if reply_to and (chat, reply_to) not in client.messages:
+                client.post(chat, 0, reply_text, msg_id=reply_to)     # "Telegram" has it
+            asyncio.ensure_future(client.incoming(chat, sender, text, reply_to, msg_id=msg_id))
+        elif kind == "click":
+            chat, msg_id, sender, text = update
+            client.messages.setdefault((chat, msg_id), client.post(chat, 0, text, msg_id=msg_id))
+            asyncio.ensure_future(client.click(chat, msg_id, sender, f"comp_{sender}".encode()))
+        elif kind == "crash":
+            os._exit(1)     # no release, no flush: leases have to expire
+        elif kind == "stop":
+            await shards.shard_map.stop()
+            for task in background:
+                task.cancel()
+            await send_queue.drain()
+            await database.write_buffer.flush()
+            return
+
+
+async def scenario_shards(args):
+    import memstore
+    os.environ["MEMSTORE_AUTHKEY"] = secrets.token_hex(16)
+    store, (host, port) = memstore.serve()
+    os.environ.update(MONGO_URI=f"memory://{host}:{port}", STORAGE_BACKEND="memory",
+                      SHARD_SLOTS=str(args.slots), SHARD_HEARTBEAT="0.2", SHARD_LEASE_TTL="1",
+                      SHARD_REPLAY="30", SHARD_REPLAY_SKEW="3", LEASE_TTL="5", OUTBOX_RETRY="1")
+    db = store["escrow_bot"]
+    ctx = multiprocessing.get_context("spawn")
+    groups = [-(10 ** 12) - g for g in range(args.groups)]
+    admins = [ADMIN_BASE + g for g in range(args.groups)]
+    workers = {}
+    crashed = set()
+
+    def spawn():
+        n = len(workers)
+        inbox = ctx.Queue()
+        inbox.cancel_join_thread()      # a crashed worker never reads the rest
+        proc = ctx.Process(target=_shard_worker, args=(n, inbox, groups, admins), daemon=True)
+        proc.start()
+        workers[n] = (proc, inbox)
+
+    def broadcast(*update):
+        for proc, inbox in workers.values():
+            if proc.is_alive():
+                inbox.put(update)
+
+    async def settle(done, timeout=30):
+        started = time.perf_counter()
+        while not done() and time.perf_counter() - started < timeout:
+            await asyncio.sleep(0.1)
+
+    for _ in range(args.workers):
+        spawn()
+    # until the slots are spread over all of them
+    await settle(lambda: len({d["owner"] for d in db.shards.find({"owner": {"$ne": None}})}) >= args.workers)
+
+    # 1) forms + /adds (some sent twice), while one worker crashes, one
+    # joins and one leaves
+    ids = itertools.count(1)
+    jobs = []
+    for i in range(args.deals):
+        chat = groups[i % len(groups)]
+        jobs.append((chat, admins[i % len(groups)], next(ids), form_text(i)))
+    adds = jobs + random.sample(jobs, int(len(jobs) * args.dupes))
+    started = time.perf_counter()
+    for i, (chat, admin, form_id, text) in enumerate(adds):
+        if i < len(jobs):
+            broadcast("msg", chat, USER_BASE + i, form_id, text, None, None)
+        broadcast("msg", chat, admin, next(ids), "/add 100 inr", form_id, text)
+        if i == len(adds) // 4:
+            workers[1][1].put(("crash",))
+            crashed.add(1)
+        elif i == len(adds) // 2:
+            spawn()
+        elif i == 3 * len(adds) // 4:
+            workers[2][1].put(("stop",))
+        if i % 50 == 0:
+            await asyncio.sleep(0.05)
+
+    # a deal whose /add outlived its form lease stays pending (expire_deal
+    # cancels it): only activated deals count as opened
+    activated = {"active_at": {"$exists": True}}
+
+    def opened():
+        return {d["form_id"] for d in db.deals.find(activated, {"form_id": 1})}
+
+    def locked():
+        # activated by a worker that crashed before storing the deal: its
+        # start message may be out, so the form stays taken for good
+        pids = {str(workers[n][0].pid) for n in crashed}
+        return {d["form_id"].split(":")[1] for d in db.active_forms.find({"status": "active", "escrow_id": None})
+                if d["owner"].split(":")[1] in pids}
+
+    await settle(lambda: len(opened()) >= args.deals, timeout=5)
+    # /adds the crashed worker had claimed stay "Deal already running"
+    # until LEASE_TTL; their admins send /add again
+    await asyncio.sleep(float(os.environ["LEASE_TTL"]) + 1)
+    retried = [job for job in jobs if str(job[2]) not in opened() | locked()]
+    for chat, admin, form_id, text in retried:
+        broadcast("msg", chat, admin, next(ids), "/add 100 inr", form_id, text)
+    await settle(lambda: len(opened() | locked()) >= args.deals)
+    add_wall = time.perf_counter() - started
+
+    # 2) complete every deal (some clicked twice) while another worker crashes
+    deals = list(db.deals.find(activated))
+    clicks = deals + random.sample(deals, int(len(deals) * args.dupes))
+    started = time.perf_counter()
+    for i, deal in enumerate(clicks):
+        broadcast("click", deal["group_id"], int(deal["_id"]), deal["admin_id"], f"{deal['deal_id']} @{deal['_id']}")
+        if i == len(clicks) // 2:
+            workers[3][1].put(("crash",))
+            crashed.add(3)
+        if i % 50 == 0:
+            await asyncio.sleep(0.05)
+    await settle(lambda: db.deals.count_documents({"status": "archived"}) >= len(deals)
+                 and sum(d.get("deals", 0) for d in db.stats.find({"is_admin": True})) >= len(deals)
+                 and db.deals.count_documents({"sent.announce_completed": {"$exists": True}}) >= len(deals))
+    complete_wall = time.perf_counter() - started
+    broadcast("stop")
+    for proc, _ in workers.values():
+        proc.join(10)
+
+    # 3) nothing done twice; everything done (the crashes may cost a
+    # message: those are at most once)
+    deals = list(db.deals.find(activated))
+    log = list(db.bench_log.find({}))
+    twice, missing = [], []
+    per_form = Counter(d["form_id"] for d in deals)
+    twice += [f"forms opened twice: {sum(c > 1 for c in per_form.values())}"] * any(c > 1 for c in per_form.values())
+    lost_forms = locked() - set(per_form)
+    missing += [f"forms opened {len(per_form)}/{args.deals}"] * (len(per_form) + len(lost_forms) != args.deals)
+    twice += ["duplicate deal numbers"] * (len({d["deal_id"] for d in deals}) != len(deals))
+    # every start message, pending and cancelled deals included, by form
+    form_of = {d["deal_id"]: d["form_id"] for d in db.deals.find({})}
+    started = [(e["text"].split("🆔 ID: ")[1].split("\n")[0], e["worker"])
+               for e in log if "ESCROW STARTED" in e.get("text", "")]
+    started_per_form = Counter(form_of[n] for n, _ in started if n in form_of)
+    twice += [f"forms started twice: {sum(c > 1 for c in started_per_form.values())}"] * \
+        any(c > 1 for c in started_per_form.values())
+    twice += ["deals started twice"] * (len({n for n, _ in started}) != len(started))
+    # posted, never stored: only a worker crashing right in between does that
+    orphans = Counter(worker in crashed for n, worker in started if n not in form_of)
+    twice += [f"start messages without a deal: {orphans[False]}"] * bool(orphans[False])
+    # at least once: repeated only by a worker dying right after the send
+    announced = Counter(e["text"].rsplit("@", 1)[1] for e in log if "DEAL COMPLETED" in e.get("text", ""))
+    announced_by_crashed = {e["text"].rsplit("@", 1)[1] for e in log
+                            if "DEAL COMPLETED" in e.get("text", "") and e["worker"] in crashed}
+    repeated = [d for d, c in announced.items() if c > 1]
+    twice += [f"completions announced twice: {len(repeated)}"] * any(d not in announced_by_crashed for d in repeated)
+    missing += [f"announced {len(announced)}/{len(deals)}"] * (len(announced) != len(deals))
+    counted = sum(d.get("deals", 0) for d in db.stats.find({"is_admin": True}))
+    twice += [f"stats count {counted} deals for {len(deals)}"] * (counted > len(deals))
+    missing += [f"stats count {counted} deals for {len(deals)}"] * (counted < len(deals))
+    archived = sum(d["status"] == "archived" for d in deals)
+    missing += [f"archived {archived}/{len(deals)}"] * (archived != len(deals))
+    kicks = Counter((e["chat"], e["kick"]) for e in log if "kick" in e)
+    kicks_live = Counter((e["chat"], e["kick"]) for e in log if "kick" in e and e["worker"] not in crashed)
+    twice += [f"kicked twice: {sum(c > 1 for c in kicks_live.values())}"] * any(c > 1 for c in kicks_live.values())
+    missing += [f"kicked {len(kicks)}/{2 * len(deals)}"] * (len(kicks) != 2 * len(deals))
+    lost = (f"retried /add {len(retried)}, left pending {db.deals.count_documents({'status': 'pending'})}, "
+            f"forms locked by a crash {len(lost_forms)}, "
+            f"started then crashed {orphans[True]}, announced again {len(repeated)}, "
+            f"re-kicks {sum(kicks.values()) - len(kicks)}")
+    print(
+        f"{'shards':<10} {len(adds):>7} ev  {add_wall:>7.2f}s  {len(clicks):>5} clicks {complete_wall:.2f}s  "
+        f"{len(workers)} workers / {args.slots} slots (2 crashed, 1 joined, 1 left)  "
+        f"{'OK' if not twice + missing else 'FAILED: ' + '; '.join(twice + missing)}\n"
+        f"{'':<10} deals opened per worker {dict(sorted(Counter(e['worker'] for e in log if 'ESCROW STARTED' in e.get('text', '')).items()))}; "
+        f"crash losses: {lost}"
+    )
+
+
+SCENARIOS = {
+    "add": scenario_add,
+    "form": scenario_form,
+    "complete": scenario_complete,
+    "parse": scenario_parse,
+    "shards": scenario_shards,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"one or more of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--deals", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--dupes", type=float, default=0.1,
+                        help="fraction of /add commands replayed concurrently (must not double-open)")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="simulated Telegram RTT in ms")
+    parser.add_argument("--real-limits", action="store_true",
+                        help="keep production send-queue rate limits")
+    parser.add_argument("--workers", type=int, default=3, help="shards: worker processes at the start")
+    parser.add_argument("--slots", type=int, default=64, help="shards: SHARD_SLOTS")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", choices=("memory", "sqlite", "mongo"), default="memory",
+                        help="STORAGE_BACKEND to run against (sqlite uses a fresh temp file)")
+    args = parser.parse_args(argv)
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    if not args.real_limits:
+        os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_BURST", "1000000")
+    random.seed(args.seed)
+    os.environ["STORAGE_BACKEND"] = args.backend
+    if args.backend == "sqlite":
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="escrow-bench-"), "bench.db")
+    print(f"backend: {args.backend}")
+
+    async def run():
+        for name in args.scenarios:
+            await SCENARIOS[name](args)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+
+# ================== TTL / LRU CACHE ==================
+
+MISSING = object()
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds.
+
+    Not thread-safe; only touch it from the event loop.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=MISSING):
+        if key is MISSING:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        for key in [k for k in self._data if k[0] == prefix]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
@@ -7,9 +7,11 @@ API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OWNER_ID = int(os.getenv("OWNER_ID"))
 
-# ================== MONGODB CONFIG ==================
+# ================== STORAGE CONFIG ==================
 
-MONGO_URI = os.getenv("MONGO_URI")
+# mongo (needs MONGO_URI) | sqlite (SQLITE_PATH) | memory, see database.py
+MONGO_URI = os.getenv("MONGO_URI", "")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or ("memory" if MONGO_URI.startswith("memory://") else "mongo")
 
 # ================== VALIDATION ==================
 
@@ -23,7 +25,7 @@ if not BOT_TOKEN:
     missing.append("BOT_TOKEN")
 if not OWNER_ID:
     missing.append("OWNER_ID")
-if not MONGO_URI:
+if STORAGE_BACKEND == "mongo" and not MONGO_URI:
     missing.append("MONGO_URI")
 
 if missing:
@@ -1,15 +1,82 @@
+import asyncio
+import logging
 import os
+import sys
 import time
-from pymongo import MongoClient, ASCENDING
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pymongo import MongoClient, ASCENDING, ReplaceOne
+from pymongo.errors import PyMongoError
+
+import metrics
+from active_deals import ActiveDeals
+from cache import MISSING, TTLCache
+from writebehind import ONCE_WINDOW, WriteBehind
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== Storage Setup ==================
+#
+# STORAGE_BACKEND picks what sits behind the pymongo API used below:
+#   mongo  - MongoClient(MONGO_URI) (default)
+#   sqlite - sqlitestore.SqliteClient(SQLITE_PATH), WAL mode, no network
+#   memory - memstore.MemoryClient, nothing persisted (tests / benchmarks);
+#            MONGO_URI=memory://host:port shares one served by memstore.serve()
+# The memory / sqlite stores implement the pymongo subset this bot uses,
+# so every function in this file runs unchanged on all three.
+
+MONGO_URI = os.getenv("MONGO_URI", "")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or ("memory" if MONGO_URI.startswith("memory://") else "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "escrow.db")
+
+# pymongo is blocking, so every call runs on a bounded thread pool
+# instead of the Telethon event loop. Pool size == connection pool size.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+if STORAGE_BACKEND == "mongo":
+    if not MONGO_URI:
+        raise RuntimeError("❌ MONGO_URI not set")
+    mongo = MongoClient(MONGO_URI, maxPoolSize=DB_POOL_SIZE)
+elif STORAGE_BACKEND == "sqlite":
+    from sqlitestore import SqliteClient
+    mongo = SqliteClient(SQLITE_PATH)
+elif STORAGE_BACKEND == "memory" and MONGO_URI[len("memory://"):]:
+    # memory://host:port - one memstore shared by several worker processes
+    from memstore import RemoteClient
+    mongo = RemoteClient(MONGO_URI)
+elif STORAGE_BACKEND == "memory":
+    from memstore import MemoryClient
+    mongo = MemoryClient()
+else:
+    raise RuntimeError(f"❌ Unknown STORAGE_BACKEND {STORAGE_BACKEND!r} (mongo, sqlite, memory)")
+db = mongo["escrow_bot"]
 
-# ================== Mongo Setup ==================
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mongo")
 
-MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    raise RuntimeError("❌ MONGO_URI not set")
 
-mongo = MongoClient(MONGO_URI)
-db = mongo["escrow_bot"]
+async def db_call(fn, *args, **kwargs):
+    """Run a blocking pymongo call off the event loop."""
+    owner = getattr(fn, "__self__", None)
+    if owner is not None and hasattr(owner, "find_one"):
+        labels = {"collection": owner.name, "op": fn.__name__}
+    else:
+        # helpers / lambdas: label by the database.* function that called us
+        labels = {"collection": "multi", "op": sys._getframe(1).f_code.co_name}
+    loop = asyncio.get_running_loop()
+    async with metrics.timer("db_seconds", **labels):
+        return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+# Per-group config (proof channels, forms) is read on every
+# group message, so it is cached in-process and invalidated on write.
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", "300"))
+config_cache = TTLCache(maxsize=4096, ttl=CONFIG_CACHE_TTL)
+
+# Stats / report / log writes are buffered and flushed in bulk; set
+# WRITE_BEHIND_INTERVAL=0 to write through.
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+write_buffer = WriteBehind(db_call, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH)
 
 # ================== Collections ==================
 
@@ -22,61 +89,100 @@ processed_col = db.processed
 reports_col = db.reports
 active_forms_col = db.active_forms
 tipped_col = db.tipped
+rollups_col = db.rollups
+counters_col = db.counters
+exposure_col = db.exposure_holds
 
 # ================== Indexes ==================
-
-deals_col.create_index([("status", ASCENDING)])
-limits_col.create_index([("user_id", ASCENDING)], unique=True)
-stats_col.create_index([("user_id", ASCENDING), ("is_admin", ASCENDING)])
-processed_col.create_index([("msg_id", ASCENDING)], unique=True)
-active_forms_col.create_index([("form_id", ASCENDING)], unique=True)
+#
+# Index builds are not run at import time any more (that blocked boot on
+# six round-trips). Modules register what they need with ensure_index();
+# ensure_indexes() builds them all in parallel, started in the background
+# by startup.warm_up() or lazily by the first indexes_ready() caller.
+
+INDEXES = []
+_indexes_task = None
+
+def ensure_index(col, keys, **kwargs):
+    INDEXES.append((col, keys, kwargs))
+
+ensure_index(deals_col, [("status", ASCENDING)])
+ensure_index(deals_col, [("status", ASCENDING), ("completed_at", ASCENDING)])
+ensure_index(deals_col, [("outbox_at", ASCENDING)], sparse=True)
+# an admin's open deals across every group (multi-worker mode, see below)
+ensure_index(deals_col, [("admin_id", ASCENDING), ("status", ASCENDING)])
+ensure_index(limits_col, [("user_id", ASCENDING)], unique=True)
+ensure_index(stats_col, [("user_id", ASCENDING), ("is_admin", ASCENDING)])
+ensure_index(processed_col, [("msg_id", ASCENDING)], unique=True)
+ensure_index(active_forms_col, [("form_id", ASCENDING)], unique=True)
+ensure_index(reports_col, [("time", ASCENDING)])
+ensure_index(rollups_col, [("res", ASCENDING), ("scope", ASCENDING), ("start", ASCENDING)])
+ensure_index(exposure_col, [("admin_id", ASCENDING), ("currency", ASCENDING)])
+ensure_index(exposure_col, [("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+async def _ensure_indexes():
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(db_call(col.create_index, keys, **kwargs) for col, keys, kwargs in INDEXES),
+        return_exceptions=True
+    )
+    for (col, keys, _), result in zip(INDEXES, results):
+        if isinstance(result, Exception):
+            LOGGER.error(f"Index {col.name} {keys} failed: {result!r}")
+    LOGGER.info(f"✅ {len(INDEXES)} indexes ensured in {time.perf_counter() - started:.2f}s")
+
+def ensure_indexes():
+    """Start building all registered indexes (once); returns the task."""
+    global _indexes_task
+    if _indexes_task is None:
+        _indexes_task = asyncio.ensure_future(_ensure_indexes())
+    return _indexes_task
+
+async def indexes_ready():
+    """Await before relying on a unique index; free once the build is done."""
+    task = ensure_indexes()
+    if not task.done():
+        await asyncio.shield(task)
 
 # ================== Defaults ==================
 
+DEFAULT_FORM = "Fill the form below to start a deal."
+
 def _get_meta():
     meta.update_one(
         {"_id": "global"},
         {"$setOnInsert": {
             "deal_count_inr": 0,
             "deal_count_usdt": 0,
-            "form_message": "Fill the form below to start a deal.",
+            "form_message": DEFAULT_FORM,
             "form_entities": []
         }},
         upsert=True
     )
     return meta.find_one({"_id": "global"})
 
-# ================== AUTH GROUP ==================
-
-async def set_auth_group(chat_id: int):
-    meta.update_one(
-        {"_id": "auth_group"},
-        {"$set": {"chat_id": int(chat_id)}},
-        upsert=True
-    )
-
-async def remove_auth_group():
-    meta.delete_one({"_id": "auth_group"})
-
-async def is_auth_group(chat_id: int) -> bool:
-    doc = meta.find_one({"_id": "auth_group"})
-    return bool(doc and int(doc.get("chat_id")) == int(chat_id))
-
 # ================== PROOF CHANNEL ==================
 
 async def set_proof_channel(group_id: int, channel_id: int):
-    meta.update_one(
+    await db_call(
+        meta.update_one,
         {"_id": f"proof_{group_id}"},
         {"$set": {"channel_id": int(channel_id)}},
         upsert=True
     )
+    config_cache.invalidate(("proof", int(group_id)))
 
 async def unset_proof_channel(group_id: int):
-    meta.delete_one({"_id": f"proof_{group_id}"})
+    await db_call(meta.delete_one, {"_id": f"proof_{group_id}"})
+    config_cache.invalidate(("proof", int(group_id)))
 
 async def get_proof_channel(group_id: int):
-    doc = meta.find_one({"_id": f"proof_{group_id}"})
-    return int(doc["channel_id"]) if doc else None
+    channel_id = config_cache.get(("proof", int(group_id)))
+    if channel_id is MISSING:
+        doc = await db_call(meta.find_one, {"_id": f"proof_{group_id}"})
+        channel_id = int(doc["channel_id"]) if doc else None
+        config_cache.set(("proof", int(group_id)), channel_id)
+    return channel_id
 
 # ================== FORM SYSTEM ==================
 
@@ -85,30 +191,120 @@ async def update_form_message(new_msg, entities=None, chat_id=None):
     serialized = [e.to_dict() for e in entities]
 
     if chat_id:
-        forms_col.update_one(
+        await db_call(
+            forms_col.update_one,
             {"chat_id": str(chat_id)},
             {"$set": {"message": new_msg, "entities": serialized}},
             upsert=True
         )
+        config_cache.invalidate(("form", str(chat_id)))
     else:
-        meta.update_one(
+        await db_call(
+            meta.update_one,
             {"_id": "global"},
             {"$set": {"form_message": new_msg, "form_entities": serialized}},
             upsert=True
         )
+        config_cache.invalidate(("form", None))
+
+async def _get_group_form(chat_id):
+    key = ("form", str(chat_id))
+    form = config_cache.get(key)
+    if form is MISSING:
+        doc = await db_call(forms_col.find_one, {"chat_id": str(chat_id)})
+        form = (doc["message"], doc.get("entities", [])) if doc else None
+        config_cache.set(key, form)
+    return form
 
 async def get_form_data(chat_id=None):
     if chat_id:
-        doc = forms_col.find_one({"chat_id": str(chat_id)})
-        if doc:
-            return doc["message"], doc.get("entities", [])
-    m = _get_meta()
-    return m["form_message"], m.get("form_entities", [])
+        form = await _get_group_form(chat_id)
+        if form:
+            return form
+    form = config_cache.get(("form", None))
+    if form is MISSING:
+        m = await db_call(_get_meta)
+        form = (m.get("form_message", DEFAULT_FORM), m.get("form_entities", []))
+        config_cache.set(("form", None), form)
+    return form
+
+async def warm_config(group_ids=()):
+    """Load every proof channel, form and admin limit into config_cache;
+    groups in `group_ids` without one are cached as "none" too."""
+    def _load():
+        proofs = list(meta.find({"_id": {"$ne": "global"}, "channel_id": {"$exists": True}}))
+        forms = list(forms_col.find({}))
+        limits = list(limits_col.find({}))
+        return proofs, forms, limits, _get_meta()
+
+    proofs, forms, limits, m = await db_call(_load)
+    for gid in group_ids:
+        config_cache.set(("proof", int(gid)), None)
+        config_cache.set(("form", str(gid)), None)
+    for doc in proofs:
+        config_cache.set(("proof", int(doc["_id"][len("proof_"):])), int(doc["channel_id"]))
+    for doc in forms:
+        config_cache.set(("form", str(doc["chat_id"])), (doc["message"], doc.get("entities", [])))
+    config_cache.set(("form", None), (m.get("form_message", DEFAULT_FORM), m.get("form_entities", [])))
+    for doc in limits:
+        config_cache.set(("limit", str(doc["user_id"])), _limit_profile(doc))
+    return len(proofs), len(forms)
+
+# ================== CONFIG CHANGE STREAM ==================
+
+# other modules keeping in-memory config (group_auth) register here:
+# collection name -> fn(change) called on the event loop
+change_listeners = {}
+
+def _invalidate_meta(doc_id):
+    if doc_id == "global":
+        config_cache.invalidate(("form", None))
+    elif isinstance(doc_id, str) and doc_id.startswith("proof_"):
+        config_cache.invalidate(("proof", int(doc_id[len("proof_"):])))
+
+def _watch_config(loop):
+    colls = [meta.name, forms_col.name, limits_col.name, *change_listeners]
+    pipeline = [{"$match": {"ns.coll": {"$in": colls}}}]
+    with db.watch(pipeline) as stream:
+        for change in stream:
+            coll = change["ns"]["coll"]
+            if coll in change_listeners:
+                loop.call_soon_threadsafe(change_listeners[coll], change)
+            elif coll == forms_col.name:
+                # forms are keyed by ObjectId, not chat id: drop them all
+                loop.call_soon_threadsafe(config_cache.invalidate_prefix, "form")
+            elif coll == limits_col.name:
+                # same for limits
+                loop.call_soon_threadsafe(config_cache.invalidate_prefix, "limit")
+            else:
+                doc_id = change.get("documentKey", {}).get("_id")
+                loop.call_soon_threadsafe(_invalidate_meta, doc_id)
+
+async def watch_config_changes():
+    """Invalidate config_cache on writes made by other bot instances.
+
+    Needs a replica set (change streams); on a standalone server it logs
+    and returns, leaving TTL expiry as the only cross-instance refresh.
+    """
+    try:
+        await asyncio.to_thread(_watch_config, asyncio.get_running_loop())
+    except PyMongoError as e:
+        LOGGER.warning(f"Config change stream unavailable: {e}")
 
 # ================== ADMIN LIMITS ==================
 
-async def set_admin_limit(user_id, amount=None, currency=None, is_mod=False, is_mmod=False):
-    data = {"inr": 0, "usdt": 0, "is_mod": False, "is_mmod": False}
+# Limits are read on every /add: cached in config_cache (write-through
+# on set_admin_limit, all loaded by warm_config, dropped by the change
+# stream when another instance writes).
+NO_LIMITS = {"inr": 0, "usdt": 0, "is_mod": False, "is_mmod": False}
+
+def _limit_profile(doc):
+    return {k: doc.get(k, v) for k, v in NO_LIMITS.items()} if doc else dict(NO_LIMITS)
+
+async def set_admin_limit(user_id, amount=None, currency=None, is_mod=False, is_mmod=False, **limits):
+    """Replace a user's admin profile; no arguments removes it (all zero).
+    Extra keywords set several currencies at once (inr=5000, usdt=50)."""
+    data = dict(NO_LIMITS)
 
     if is_mmod:
         data["is_mod"] = True
@@ -117,122 +313,616 @@ async def set_admin_limit(user_id, amount=None, currency=None, is_mod=False, is_
         data["is_mod"] = True
     elif amount is not None and currency:
         data[currency.lower()] = int(amount)
+    for cur, value in limits.items():
+        data[cur.lower()] = int(value)
 
-    limits_col.update_one(
+    await db_call(
+        limits_col.update_one,
         {"user_id": str(user_id)},
         {"$set": data},
         upsert=True
     )
+    config_cache.set(("limit", str(user_id)), data)
 
 async def get_admin_limit(user_id):
-    doc = limits_col.find_one({"user_id": str(user_id)})
-    return doc or {"inr": 0, "usdt": 0, "is_mod": False, "is_mmod": False}
+    key = ("limit", str(user_id))
+    profile = config_cache.get(key)
+    if profile is MISSING:
+        profile = _limit_profile(await db_call(limits_col.find_one, {"user_id": str(user_id)}))
+        config_cache.set(key, profile)
+    return profile
 
 # 🔥 MISSING FUNCTION (THIS FIXES CRASH)
 async def get_user_limit(user_id, currency):
     data = await get_admin_limit(user_id)
     return int(data.get(currency.lower(), 0))
 
-# ================== DEAL COUNTERS ==================
+# ---------- open exposure ----------
+
+# /add calls in flight (checked, deal not stored yet); counted with the
+# open deals so two concurrent /adds cannot both fit under one limit
+_reserved = {}      # (admin_id, currency) -> amount
+
+# Multi-worker mode (owns_group set): an admin's /adds in other workers'
+# groups must count too, so reservations are hold docs in Mongo instead,
+# reaped after EXPOSURE_HOLD_TTL if their worker dies mid-/add.
+EXPOSURE_HOLD_TTL = int(os.getenv("EXPOSURE_HOLD_TTL", "120"))
+
+def _open_exposure(admin_id, currency):
+    docs = deals_col.find({"admin_id": admin_id, "status": {"$in": list(OPEN_STATES)},
+                           "currency": currency}, {"amount": 1})
+    return sum(doc.get("amount") or 0 for doc in docs)
+
+def _shared_exposure(admin_id, currency):
+    # holds before deals: a hold released after its deal is stored is
+    # then counted twice at worst, never missed
+    now = datetime.now(timezone.utc)
+    holds = exposure_col.find({"admin_id": admin_id, "currency": currency,
+                               "expires_at": {"$gt": now}}, {"amount": 1})
+    held = sum(doc.get("amount") or 0 for doc in holds)
+    return held + _open_exposure(admin_id, currency)
+
+def _hold_exposure(admin_id, amount, currency, limit):
+    # ours first, then count everything: two racing /adds may both back
+    # off, but cannot both get under the limit
+    hold = exposure_col.insert_one({
+        "admin_id": admin_id, "currency": currency, "amount": amount,
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=EXPOSURE_HOLD_TTL)
+    }).inserted_id
+    if limit is not None and _shared_exposure(admin_id, currency) > limit:
+        exposure_col.delete_one({"_id": hold})
+        return None
+    return hold
+
+async def get_exposure(admin_id, currency):
+    """Open amount of an admin's running deals plus /adds in flight."""
+    await _active_loaded()
+    if owns_group is not None:
+        # the admin's deals in other workers' groups are not in our index
+        return await db_call(_shared_exposure, admin_id, currency)
+    return active_deals.exposure_of(admin_id, currency) + _reserved.get((admin_id, currency), 0)
+
+async def reserve_exposure(admin_id, amount, currency, limit):
+    """Take `amount` of the admin's limit for an /add in flight; a handle
+    for release_exposure(), or None (nothing taken) if it would go over.
+    limit=None means unlimited."""
+    if owns_group is not None:
+        return await db_call(_hold_exposure, admin_id, amount, currency, limit)
+    if limit is not None and await get_exposure(admin_id, currency) + amount > limit:
+        return None
+    _reserved[(admin_id, currency)] = _reserved.get((admin_id, currency), 0) + amount
+    return True
+
+async def release_exposure(admin_id, amount, currency, hold):
+    """Drop a reservation once the deal is stored (or /add failed)."""
+    if hold is True:
+        key = (admin_id, currency)
+        left = _reserved.get(key, 0) - amount
+        if left > 0:
+            _reserved[key] = left
+        else:
+            _reserved.pop(key, None)
+    elif hold is not None:
+        await db_call(exposure_col.delete_one, {"_id": hold})
 
-async def increment_deal(currency="inr"):
-    res = meta.find_one_and_update(
-        {"_id": "global"},
-        {"$inc": {f"deal_count_{currency.lower()}": 1}},
+# ================== DEAL COUNTERS ==================
+#
+# One counter doc per currency (per currency+group with DEAL_IDS_PER_GROUP)
+# in `counters`, instead of every /add serialising on meta "global".
+# Ids are reserved DEAL_ID_BLOCK at a time and handed out from memory, so
+# within a process #EscrowN stays monotonic and only every Nth deal hits
+# Mongo. Unused ids are handed back by release_deal_ids() on shutdown.
+
+DEAL_ID_BLOCK = int(os.getenv("DEAL_ID_BLOCK", "10"))
+DEAL_IDS_PER_GROUP = bool(os.getenv("DEAL_IDS_PER_GROUP"))
+
+_id_blocks = {}     # key -> [next, last, first]
+_id_locks = {}
+_seeded = set()
+
+def _counter_key(currency, group_id=None):
+    key = f"deal_{currency.lower()}"
+    if DEAL_IDS_PER_GROUP and group_id is not None:
+        key += f"_{group_id}"
+    return key
+
+def _seed_counter(key, currency):
+    # carry over the legacy meta "global" count the first time we see a key
+    seq = 0
+    if key == _counter_key(currency):
+        legacy = meta.find_one({"_id": "global"}, {f"deal_count_{currency}": 1}) or {}
+        seq = int(legacy.get(f"deal_count_{currency}", 0))
+    counters_col.update_one({"_id": key}, {"$setOnInsert": {"seq": seq}}, upsert=True)
+    _seeded.add(key)
+
+def _reserve_ids(key, currency, count):
+    if key not in _seeded:
+        _seed_counter(key, currency)
+    res = counters_col.find_one_and_update(
+        {"_id": key},
+        {"$inc": {"seq": count}},
         upsert=True,
         return_document=True
     )
-    return res[f"deal_count_{currency.lower()}"]
-
-async def decrement_deal(currency="inr"):
-    meta.update_one(
-        {"_id": "global"},
-        {"$inc": {f"deal_count_{currency.lower()}": -1}}
+    return res["seq"] - count + 1, res["seq"]
+
+async def increment_deal(currency="inr", group_id=None):
+    currency = currency.lower()
+    key = _counter_key(currency, group_id)
+    block = _id_blocks.get(key)
+    if not block or block[0] > block[1]:
+        lock = _id_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            block = _id_blocks.get(key)
+            if not block or block[0] > block[1]:
+                first, last = await db_call(_reserve_ids, key, currency, DEAL_ID_BLOCK)
+                block = _id_blocks[key] = [first, last, first]
+    deal_no = block[0]
+    block[0] += 1
+    return deal_no
+
+async def decrement_deal(currency="inr", group_id=None, deal_no=None):
+    """Give back the id most recently returned by increment_deal(); with
+    `deal_no`, only if no later one was handed out since (shared counter)."""
+    block = _id_blocks.get(_counter_key(currency, group_id))
+    if block and block[0] > block[2] and deal_no in (None, block[0] - 1):
+        block[0] -= 1
+
+def _release_ids(key, next_id, last):
+    # only if nobody reserved past our block in the meantime
+    counters_col.update_one(
+        {"_id": key, "seq": last},
+        {"$inc": {"seq": -(last - next_id + 1)}}
     )
 
-# ================== DEAL FLOW ==================
+async def release_deal_ids(owns=None):
+    """Hand back unused reserved ids: all of them (shutdown), or only the
+    per-group counters of the groups `owns` accepts (they moved to
+    another worker)."""
+    for key, (next_id, last, _) in list(_id_blocks.items()):
+        if owns is not None:
+            group_id = _counter_group(key)
+            if group_id is None or not owns(group_id):
+                continue
+        if next_id <= last:
+            await db_call(_release_ids, key, next_id, last)
+        del _id_blocks[key]
+
+def _counter_group(key):
+    # "deal_inr_-100123" -> -100123 (None for the global counters)
+    parts = key.split("_", 2)
+    return int(parts[2]) if len(parts) == 3 else None
 
-async def atomic_start_deal(form_msg_id):
-    try:
-        active_forms_col.insert_one(
-            {"form_id": str(form_msg_id), "status": "processing"}
-        )
-        return True
-    except:
-        return False
+# ================== DEAL FLOW ==================
 
-async def store_deal(escrow_msg_id, form_msg_id, deal_data):
+# Deal states. Each transition is one conditional find_one_and_update on
+# the deal doc that also records the transition's side-effects in the
+# doc's `outbox` ({kind: queued_at}, plus `outbox_at` while anything is
+# queued). deal_flow.py runs and clears them, so a crash right after the
+# update loses nothing: the outbox is replayed on startup.
+#
+#   pending --> active --> completed --> archived
+#      |          |
+#      +----------+------> cancelled --> archived
+#
+# (pending may also complete directly: the admin can click before the
+# activation effects have run.)
+DEAL_TRANSITIONS = {
+    "pending": ("active", "completed", "cancelled"),
+    "active": ("completed", "cancelled"),
+    "completed": ("archived",),
+    "cancelled": ("archived",),
+}
+OPEN_STATES = ("pending", "active")
+
+# Open deals live in an in-memory index (by escrow id, group and admin),
+# loaded once from Mongo and then updated by the writes below, so the
+# callback / reply side never reads Mongo. Every mutation first waits for
+# the load, so a deal stored mid-load cannot be overwritten by it.
+active_deals = ActiveDeals()
+_active_lock = asyncio.Lock()
+
+# Multi-worker mode (shards.py) sets this to group_id -> "this worker owns
+# the group". The index then only holds owned groups, loaded / dropped as
+# groups move between workers; views across groups (an admin's deals and
+# open exposure) read Mongo instead.
+owns_group = None
+
+def _find_active(owns=None):
+    docs = list(deals_col.find({"status": {"$in": list(OPEN_STATES)}}))
+    owns = owns or owns_group
+    return docs if owns is None else [d for d in docs if owns(d.get("group_id"))]
+
+async def load_running_deals():
+    async with _active_lock:
+        active_deals.load(await db_call(_find_active))
+    return len(active_deals)
+
+async def _active_loaded():
+    if not active_deals.loaded:
+        async with _active_lock:
+            if not active_deals.loaded:
+                active_deals.load(await db_call(_find_active))
+
+async def load_group_deals(owns):
+    """Add the open deals of the groups `owns` accepts to the index."""
+    await _active_loaded()
+    async with _active_lock:
+        docs = await db_call(_find_active, owns)
+        for doc in docs:
+            active_deals.add(doc)
+    return len(docs)
+
+def drop_group_deals(owns):
+    """Forget the open deals of the groups `owns` accepts."""
+    dropped = [_id for _id, deal in active_deals.by_id.items() if owns(deal.get("group_id"))]
+    for _id in dropped:
+        active_deals.remove(_id)
+    return len(dropped)
+
+def _outbox_fields(outbox, now):
+    fields = {f"outbox.{kind}": now for kind in outbox}
+    if outbox:
+        fields["outbox_at"] = now
+    return fields
+
+async def store_deal(escrow_msg_id, form_msg_id, deal_data, outbox=()):
+    """Insert a new deal as "pending" with its first outbox entries."""
+    await _active_loaded()
+    now = time.time()
     deal_data.update({
         "_id": str(escrow_msg_id),
-        "status": "active",
-        "time": time.time(),
-        "form_id": str(form_msg_id)
+        "status": "pending",
+        "time": now,
+        "form_id": str(form_msg_id),
+        "outbox": {kind: now for kind in outbox}
     })
-    deals_col.insert_one(deal_data)
-
-async def remove_deal(escrow_msg_id):
-    deal = deals_col.find_one({"_id": str(escrow_msg_id)})
-    if deal and deal.get("form_id"):
-        active_forms_col.delete_one({"form_id": deal["form_id"]})
-    deals_col.delete_one({"_id": str(escrow_msg_id)})
+    if outbox:
+        deal_data["outbox_at"] = now
+    await db_call(deals_col.insert_one, deal_data)
+    active_deals.add(deal_data)
+    return deal_data
+
+async def transition(escrow_msg_id, to, outbox=(), sources=None, **fields):
+    """Move a deal to state `to` in one round-trip, queueing `outbox`.
+
+    `sources` defaults to every state allowed to reach `to`. Returns the
+    updated deal, or None if it was in none of them (a double click, or
+    another worker got there first)."""
+    await _active_loaded()
+    if sources is None:
+        sources = [s for s, targets in DEAL_TRANSITIONS.items() if to in targets]
+    deal_id = str(escrow_msg_id)
+    now = time.time()
+    current = active_deals.get(deal_id)
+    if current is not None and current.get("status") not in sources:
+        return None     # e.g. expiring a deal that went active meanwhile
+    # closing: out of the index first, so a second click sees "Already processed"
+    removed = active_deals.remove(deal_id) if to not in OPEN_STATES else None
+    try:
+        deal = await db_call(
+            deals_col.find_one_and_update,
+            {"_id": deal_id, "status": {"$in": list(sources)}},
+            {"$set": {"status": to, f"{to}_at": now, **fields, **_outbox_fields(outbox, now)}},
+            return_document=True
+        )
+    except BaseException:
+        if removed is not None:
+            active_deals.add(removed)
+        raise
+    if deal is None and removed is not None:
+        # it moved on while we were writing (went active as it expired):
+        # keep it indexed unless another worker closed it
+        doc = await db_call(deals_col.find_one, {"_id": deal_id, "status": {"$in": list(OPEN_STATES)}})
+        if doc is not None:
+            active_deals.add(doc)
+    if deal is not None and to in OPEN_STATES:
+        current = active_deals.get(deal_id)
+        if current is not None:     # not closed meanwhile
+            current["status"] = to
+    return deal
+
+async def complete_deal(escrow_msg_id, outbox=(), **fields):
+    """Mark an open deal completed; the doc stays until auto-kick archives it."""
+    return await transition(escrow_msg_id, "completed", outbox, **fields)
+
+async def cancel_deal(escrow_msg_id, outbox=(), **fields):
+    """Cancel an open deal; returns it, or None if it was not open."""
+    return await transition(escrow_msg_id, "cancelled", outbox, **fields)
 
 async def get_deal(escrow_msg_id):
-    return deals_col.find_one({"_id": str(escrow_msg_id)})
+    """The open deal for an escrow message, or None (memory only)."""
+    await _active_loaded()
+    deal = active_deals.get(escrow_msg_id)
+    if deal is None and owns_group is not None:
+        # stored by the group's previous worker after we loaded the group
+        deal = await db_call(deals_col.find_one, {"_id": str(escrow_msg_id), "status": {"$in": list(OPEN_STATES)}})
+        if deal is not None and owns_group(deal.get("group_id")):
+            active_deals.add(deal)
+    return deal
+
+async def find_deal(escrow_msg_id):
+    """Any deal, whatever its state (reads Mongo)."""
+    return await db_call(deals_col.find_one, {"_id": str(escrow_msg_id)})
+
+async def get_running_deals(group_id=None, admin_id=None):
+    await _active_loaded()
+    if group_id is not None:
+        return active_deals.for_group(group_id)
+    if admin_id is not None:
+        if owns_group is not None:
+            return await db_call(lambda: list(deals_col.find(
+                {"admin_id": admin_id, "status": {"$in": list(OPEN_STATES)}})))
+        return active_deals.for_admin(admin_id)
+    return dict(active_deals.by_id)
+
+async def get_completed_deals():
+    # served by the (status, completed_at) index
+    return await db_call(lambda: list(deals_col.find(
+        {"status": "completed"},
+        {"group_id": 1, "buyer": 1, "seller": 1, "completed_at": 1}
+    ).sort("completed_at", ASCENDING)))
+
+async def archive_deals(escrow_msg_ids):
+    await db_call(
+        deals_col.update_many,
+        {"_id": {"$in": [str(i) for i in escrow_msg_ids]},
+         "status": {"$in": [s for s, targets in DEAL_TRANSITIONS.items() if "archived" in targets]}},
+        {"$set": {"status": "archived", "archived_at": time.time()}}
+    )
+
+# ---------- outbox ----------
+
+async def get_outbox_deals():
+    # sparse index: only deals with something queued carry outbox_at
+    return await db_call(lambda: list(deals_col.find({"outbox_at": {"$exists": True}})))
+
+async def mark_sent(escrow_msg_id, kind, msg_id):
+    """Record a message effect as sent (and done) right after the send,
+    so a retry does not post it again."""
+    await db_call(
+        deals_col.update_one,
+        {"_id": str(escrow_msg_id)},
+        {"$set": {f"sent.{kind}": msg_id}, "$unset": {f"outbox.{kind}": ""}}
+    )
+
+def _clear_outbox(deal_id, done, marker):
+    update = {}
+    if done:
+        update["$unset"] = {f"outbox.{kind}": "" for kind in done}
+    if marker is not None:
+        # everything ran: drop the marker too, unless a later transition
+        # has queued more (and stamped a new outbox_at) in the meantime
+        res = deals_col.update_one(
+            {"_id": deal_id, "outbox_at": marker},
+            {**update, "$unset": {**update.get("$unset", {}), "outbox_at": ""}}
+        )
+        if res.matched_count:
+            return
+    if update:
+        deals_col.update_one({"_id": deal_id}, update)
 
-async def get_running_deals():
-    return {d["_id"]: d for d in deals_col.find({"status": "active"})}
+async def clear_outbox(escrow_msg_id, done=(), marker=None):
+    """One round-trip after a batch of effects: drop `done`, and with
+    `marker` (the batch's outbox_at; nothing failed) the marker itself."""
+    await db_call(_clear_outbox, str(escrow_msg_id), list(done), marker)
 
 # ================== PROCESSED ==================
 
 async def mark_processed(msg_id, status="completed"):
-    processed_col.update_one(
+    await db_call(
+        processed_col.update_one,
         {"msg_id": str(msg_id)},
-        {"$set": {"status": status}},
+        {"$set": {"status": status, "at": datetime.now(timezone.utc)}},  # TTL, see retention.py
         upsert=True
     )
 
 async def get_processed_status(msg_id):
-    doc = processed_col.find_one({"msg_id": str(msg_id)})
+    doc = await db_call(processed_col.find_one, {"msg_id": str(msg_id)})
     return doc["status"] if doc else None
 
 # ================== STATS & REPORTS ==================
 
-async def update_stats(user_id, amount, currency, is_admin=False, username=None):
-    stats_col.update_one(
+# modules maintaining derived views (leaderboard) register here:
+# fn(user_id, amount, currency, is_admin, username, ts, deal_id), called
+# synchronously so they can queue into the same write-behind batch
+stats_listeners = []
+_counted = {}   # deal ids this process counted, oldest first (last ONCE_WINDOW)
+
+async def update_stats(user_id, amount, currency, is_admin=False, username=None, group_id=None,
+                       deal_id=None):
+    """Count one deal. With `deal_id` the stats $inc is keyed by it and
+    the report row named after it, so calling again for the same deal (an
+    outbox retry, even from another process) counts neither twice."""
+    if deal_id is not None:
+        deal_id = str(deal_id)
+        if deal_id in _counted:
+            return  # still buffered, or landed already
+        _counted[deal_id] = None
+        if len(_counted) > ONCE_WINDOW:
+            del _counted[next(iter(_counted))]
+    now = time.time()
+    cur = currency.lower()
+    amount = float(amount)
+    admin_id = user_id if is_admin else None
+
+    write_buffer.inc(
+        stats_col,
         {"user_id": str(user_id), "is_admin": is_admin},
-        {"$inc": {
-            "deals": 1,
-            f"amount_{currency.lower()}": float(amount)
-        },
-        "$set": {"username": username or ""}},
-        upsert=True
+        {"deals": 1, f"amount_{cur}": amount},
+        set={"username": username or ""},
+        once=deal_id
     )
-
-    reports_col.insert_one({
-        "time": time.time(),
-        "amount": float(amount),
-        "currency": currency.lower()
-    })
+    report = {
+        "time": now,
+        "amount": amount,
+        "currency": cur,
+        "group_id": group_id,
+        "admin_id": admin_id
+    }
+    if deal_id is not None:
+        report["_id"] = f"deal:{deal_id}"   # a repeated insert is a duplicate key, dropped
+    write_buffer.insert(reports_col, report)
+    # rollups are a view of the reports (rebuild_rollups() recomputes
+    # them): plain merged $incs, only the stats doc is keyed
+    for filter, inc, set_on_insert in _rollup_incs(now, amount, cur, group_id, admin_id):
+        write_buffer.inc(rollups_col, filter, inc, set_on_insert=set_on_insert)
+    for listener in stats_listeners:
+        listener(user_id, amount, cur, is_admin, username, now, deal_id)
+    await write_buffer.maybe_flush()
 
 async def get_stats(user_id, is_admin=False):
-    doc = stats_col.find_one({"user_id": str(user_id), "is_admin": is_admin})
+    await write_buffer.flush()  # read-your-writes for buffered stats
+    doc = await db_call(stats_col.find_one, {"user_id": str(user_id), "is_admin": is_admin}, {"counted": 0})
     return doc or {"deals": 0, "amount_inr": 0, "amount_usdt": 0}
 
-async def get_leaderboard():
-    admins = list(stats_col.find({"is_admin": True}).sort("deals", -1))
-    total_deals = sum(a.get("deals", 0) for a in admins)
-    total_inr = sum(a.get("amount_inr", 0) for a in admins)
-    total_usdt = sum(a.get("amount_usdt", 0) for a in admins)
-    return admins, total_deals, total_inr, total_usdt
-
-async def get_report(seconds):
-    cutoff = time.time() - seconds
-    cursor = reports_col.find({"time": {"$gte": cutoff}})
+# ================== REPORT ROLLUPS ==================
+#
+# update_stats() $incs one hourly and one daily bucket per scope
+# ("all", "g:<group_id>", "a:<admin_id>"). A report over [start, end) reads
+# raw reports_col rows only for the ragged sub-hour edges, hourly buckets
+# up to the first/last day boundary and daily buckets in between.
+
+HOUR = 3600
+DAY = 86400
+ROLLUP_RES = {"h": HOUR, "d": DAY}
+
+def _scopes(group_id=None, admin_id=None):
+    scopes = ["all"]
+    if group_id is not None:
+        scopes.append(f"g:{group_id}")
+    if admin_id is not None:
+        scopes.append(f"a:{admin_id}")
+    return scopes
+
+def _scope(group_id=None, admin_id=None):
+    if admin_id is not None:
+        return f"a:{admin_id}"
+    if group_id is not None:
+        return f"g:{group_id}"
+    return "all"
+
+def _rollup_incs(ts, amount, currency, group_id=None, admin_id=None):
+    """(filter, $inc, $setOnInsert) per bucket touched by one deal."""
+    incs = []
+    for res, size in ROLLUP_RES.items():
+        start = int(ts // size * size)
+        for scope in _scopes(group_id, admin_id):
+            incs.append((
+                {"_id": f"{res}|{scope}|{start}"},
+                {"deals": 1, f"amount_{currency}": amount},
+                {"res": res, "scope": scope, "start": start}
+            ))
+    return incs
+
+def _raw_totals(start, end, scope):
+    query = {"time": {"$gte": start, "$lt": end}}
+    if scope.startswith("g:"):
+        query["group_id"] = int(scope[2:])
+    elif scope.startswith("a:"):
+        query["admin_id"] = int(scope[2:])
     deals = total_inr = total_usdt = 0
-    for d in cursor:
+    for d in reports_col.find(query, {"amount": 1, "currency": 1}):
         deals += 1
         if d["currency"] == "usdt":
             total_usdt += d["amount"]
         else:
             total_inr += d["amount"]
     return deals, total_inr, total_usdt
+
+def _bucket_totals(res, start, end, scope):
+    deals = total_inr = total_usdt = 0
+    if start >= end:
+        return deals, total_inr, total_usdt
+    for b in rollups_col.find({"res": res, "scope": scope, "start": {"$gte": start, "$lt": end}}):
+        deals += b.get("deals", 0)
+        total_inr += b.get("amount_inr", 0)
+        total_usdt += b.get("amount_usdt", 0)
+    return deals, total_inr, total_usdt
+
+def _ceil(ts, size):
+    return int(-(-ts // size) * size)
+
+def _floor(ts, size):
+    return int(ts // size * size)
+
+def _range_report(start, end, scope="all"):
+    h0, h1 = _ceil(start, HOUR), _floor(end, HOUR)
+    if h0 >= h1:
+        return _raw_totals(start, end, scope)
+
+    d0, d1 = _ceil(h0, DAY), _floor(h1, DAY)
+    if d0 < d1:
+        parts = [
+            _bucket_totals("h", h0, d0, scope),
+            _bucket_totals("d", d0, d1, scope),
+            _bucket_totals("h", d1, h1, scope),
+        ]
+    else:
+        parts = [_bucket_totals("h", h0, h1, scope)]
+    parts.append(_raw_totals(start, h0, scope))
+    parts.append(_raw_totals(h1, end, scope))
+    return tuple(sum(p[i] for p in parts) for i in range(3))
+
+async def get_report(seconds, group_id=None, admin_id=None):
+    await write_buffer.flush()
+    now = time.time()
+    return await db_call(_range_report, now - seconds, now, _scope(group_id, admin_id))
+
+async def get_report_range(start, end, group_id=None, admin_id=None):
+    await write_buffer.flush()
+    return await db_call(_range_report, start, end, _scope(group_id, admin_id))
+
+def _rebuild_rollups(before=None):
+    ops = []
+    keys = {"all": None, "g": "$group_id", "a": "$admin_id"}
+    for res, size in ROLLUP_RES.items():
+        for prefix, field in keys.items():
+            match = {"time": {"$exists": True} if before is None else {"$lt": before}}
+            if field:
+                match[field[1:]] = {"$ne": None}
+            pipeline = [
+                {"$match": match},
+                {"$group": {
+                    "_id": {
+                        "start": {"$subtract": ["$time", {"$mod": ["$time", size]}]},
+                        "key": field,
+                    },
+                    "deals": {"$sum": 1},
+                    "amount_inr": {"$sum": {"$cond": [{"$eq": ["$currency", "usdt"]}, 0, "$amount"]}},
+                    "amount_usdt": {"$sum": {"$cond": [{"$eq": ["$currency", "usdt"]}, "$amount", 0]}},
+                }},
+            ]
+            for row in reports_col.aggregate(pipeline, allowDiskUse=True):
+                start = int(row["_id"]["start"])
+                scope = "all" if field is None else f"{prefix}:{row['_id']['key']}"
+                ops.append(ReplaceOne(
+                    {"_id": f"{res}|{scope}|{start}"},
+                    {"res": res, "scope": scope, "start": start,
+                     "deals": row["deals"],
+                     "amount_inr": row["amount_inr"],
+                     "amount_usdt": row["amount_usdt"]},
+                    upsert=True
+                ))
+    for i in range(0, len(ops), 1000):
+        rollups_col.bulk_write(ops[i:i + 1000], ordered=False)
+    return len(ops)
+
+async def rebuild_rollups():
+    """Backfill rollup buckets from reports_col. Returns buckets written.
+
+    Buckets are replaced, not incremented, so it is safe to re-run; deals
+    finished while it runs may be overwritten in the current bucket.
+    """
+    await write_buffer.flush()
+    return await db_call(_rebuild_rollups)
+
+def _compact_reports(before):
+    buckets = _rebuild_rollups(before=before)
+    return buckets, reports_col.delete_many({"time": {"$lt": before}}).deleted_count
+
+async def compact_reports(before):
+    """Roll raw report rows older than `before` into their buckets and
+    delete them. `before` should be day-aligned. Returns (buckets, rows)."""
+    await write_buffer.flush()
+    return await db_call(_compact_reports, before)
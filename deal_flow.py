@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+import database
+import metrics
+from auto_kick import schedule_kick
+from leases import deal_leases
+from sender import CLEANUP, PROOF, REPLY, send_queue
+from timers import timer_wheel
+from workqueue import chat_queues
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== DEAL OUTBOX ==================
+#
+# The handlers only move a deal between states (database.transition: one
+# round-trip, side-effects queued in the deal doc) and answer the user.
+# Everything else - posting, pinning, the proof channel, the form lease,
+# stats, the auto-kick - is an outbox effect run here right after the
+# transition, in transition order per deal.
+#
+# Effects are cleared from the doc once they ran, so every one runs at
+# least once. Most are safe to repeat (unpin, delete, lease and processed
+# updates, kick scheduling, stats keyed by the deal); the messages are not,
+# and record their message id in `sent` right after the send, which a
+# retry checks first. Only dying between a send and that write repeats a
+# message. Failures are retried through the timer wheel (persisted, so
+# they survive a restart too), and deals with anything else still queued
+# are replayed on startup.
+
+DEAL_PENDING_TTL = int(os.getenv("DEAL_PENDING_TTL", "300"))   # pending -> cancelled
+OUTBOX_RETRY = int(os.getenv("OUTBOX_RETRY", "30"))            # seconds, x attempt
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+
+EFFECTS = {}    # kind -> (async fn(client, deal), once); once ones return the message sent
+
+OPEN_EFFECTS = ("activate", "pin")
+COMPLETE_EFFECTS = ("announce_completed", "unpin", "delete", "proof",
+                    "lease_completed", "stats", "processed_completed", "kick")
+CANCEL_EFFECTS = ("announce_cancelled", "unpin", "delete", "lease_cancelled", "processed_cancelled")
+EXPIRE_EFFECTS = ("unpin", "delete", "lease_release")
+
+
+def effect(kind, once=False):
+    def deco(fn):
+        EFFECTS[kind] = (fn, once)
+        return fn
+    return deco
+
+
+# ================== TRANSITIONS ==================
+
+async def _transition(client, deal_id, kinds, write):
+    # the kinds are ours from before the write lands, so a replay reading
+    # the outbox in between leaves them alone
+    _own(deal_id, kinds)
+    try:
+        deal = await write()
+    except BaseException:
+        _disown(deal_id, kinds)
+        raise
+    if deal is None:
+        _disown(deal_id, kinds)
+        return None
+    dispatch(client, deal, kinds, owned=True)
+    return deal
+
+
+async def open_deal(client, escrow_msg_id, form_msg_id, deal_data):
+    """Record a just-posted deal; it turns active once its lease is."""
+    deal = await _transition(client, escrow_msg_id, OPEN_EFFECTS, lambda: database.store_deal(
+        escrow_msg_id, form_msg_id, deal_data, outbox=OPEN_EFFECTS))
+    timer_wheel.schedule("expire_deal", deal["time"] + DEAL_PENDING_TTL, {"deal_id": deal["_id"]},
+                         timer_id=f"expire:{deal['_id']}", chat_id=deal["group_id"])
+    return deal
+
+
+async def complete_deal(client, escrow_msg_id, text):
+    return await _transition(client, escrow_msg_id, COMPLETE_EFFECTS, lambda: database.complete_deal(
+        escrow_msg_id, COMPLETE_EFFECTS, text=text))
+
+
+async def cancel_deal(client, escrow_msg_id, text):
+    return await _transition(client, escrow_msg_id, CANCEL_EFFECTS, lambda: database.cancel_deal(
+        escrow_msg_id, CANCEL_EFFECTS, text=text))
+
+
+@timer_wheel.handler("expire_deal")
+async def _expire(client, payload):
+    # a deal still pending this long never got its lease activated
+    deal_id = payload["deal_id"]
+    if await _transition(client, deal_id, EXPIRE_EFFECTS, lambda: database.transition(
+            deal_id, "cancelled", EXPIRE_EFFECTS, sources=("pending",), expired=True)):
+        LOGGER.warning(f"Deal {deal_id} expired while pending")
+
+
+# ================== DISPATCH ==================
+
+_chains = {}    # deal id -> its latest dispatch task
+_owned = {}     # deal id -> Counter of kinds a queued dispatch will run
+
+
+def _own(deal_id, kinds):
+    _owned.setdefault(str(deal_id), Counter()).update(kinds)
+
+
+def _disown(deal_id, kinds):
+    counts = _owned[str(deal_id)]
+    counts.subtract(kinds)
+    if not +counts:
+        del _owned[str(deal_id)]
+
+
+def dispatch(client, deal, kinds=None, attempt=1, owned=False):
+    """Run `kinds` of the deal's outbox in the background, after any
+    earlier dispatch of the same deal. kinds=None (retries, replay) means
+    whatever is still queued then, minus what a queued dispatch owns."""
+    deal_id = str(deal["_id"])
+    if kinds is not None:
+        kinds = list(kinds)
+        if not owned:
+            _own(deal_id, kinds)
+    task = asyncio.ensure_future(_run(client, deal_id, deal, kinds, attempt, _chains.get(deal_id)))
+    _chains[deal_id] = task
+    if deal.get("group_id") is not None:
+        # a handoff waits for it (retries are tracked as their timer)
+        chat_queues.track(deal["group_id"], task)
+    task.add_done_callback(lambda t: _chains.get(deal_id) is t and _chains.pop(deal_id))
+    return task
+
+
+async def _apply(client, deal, kind):
+    entry = EFFECTS.get(kind)
+    if entry is None:
+        LOGGER.warning(f"No outbox effect {kind!r}, dropping it from deal {deal['_id']}")
+        return True
+    fn, once = entry
+    if once and kind in (deal.get("sent") or {}):
+        return True     # sent before a failed clear or a crash
+    try:
+        message = await fn(client, deal)
+        if once:
+            await database.mark_sent(deal["_id"], kind, getattr(message, "id", None))
+        return True
+    except Exception as e:
+        metrics.inc("outbox_failed_total", kind=kind)
+        LOGGER.warning(f"Outbox {kind} for deal {deal['_id']} failed: {e!r}")
+        return False
+
+
+async def _run(client, deal_id, deal, kinds, attempt, previous):
+    owned = kinds
+    skipped = []
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        if kinds is None:
+            deal = await database.find_deal(deal_id)
+            busy = _owned.get(deal_id, ())
+            queued = list((deal or {}).get("outbox") or {})
+            # a transition in flight owns these; if it fails they are ours
+            # again, so look once more later
+            skipped = [k for k in queued if k in busy]
+            kinds = [k for k in queued if k not in busy]
+        ok = await asyncio.gather(*(_apply(client, deal, k) for k in kinds))
+        failed = [k for k, good in zip(kinds, ok) if not good]
+        if deal is not None:
+            # timers the effects scheduled (kick, expire) must be stored
+            # before the outbox entries that would replay them are gone
+            await database.write_buffer.flush()
+            await database.clear_outbox(
+                deal_id,
+                done=[k for k, good in zip(kinds, ok) if good],
+                marker=None if failed or skipped else deal.get("outbox_at")
+            )
+    except Exception as e:
+        LOGGER.warning(f"Outbox for deal {deal_id} failed: {e!r}")
+        failed = kinds or ["?"]
+    finally:
+        if owned:
+            _disown(deal_id, owned)
+    if not failed and not skipped:
+        return
+    if attempt >= OUTBOX_MAX_ATTEMPTS:
+        LOGGER.error(f"Outbox for deal {deal_id} gave up on {failed or skipped} (left queued in the deal doc)")
+        return
+    timer_wheel.schedule("outbox", time.time() + OUTBOX_RETRY * attempt,
+                         {"deal_id": deal_id, "attempt": attempt + 1}, timer_id=f"outbox:{deal_id}",
+                         chat_id=(deal or {}).get("group_id"))
+
+
+@timer_wheel.handler("outbox")
+async def _retry(client, payload):
+    await dispatch(client, {"_id": payload["deal_id"]}, attempt=payload.get("attempt", 1))
+
+
+async def _replay(owns):
+    now = time.time()
+    for deal in await database.get_outbox_deals():
+        if deal.get("outbox") and owns(deal.get("group_id")):
+            timer_wheel.schedule("outbox", now, {"deal_id": deal["_id"], "attempt": 1},
+                                 timer_id=f"outbox:{deal['_id']}", chat_id=deal.get("group_id"))
+
+timer_wheel.startup.append(_replay)
+
+
+# ================== EFFECTS ==================
+
+def _chat(deal):
+    return deal["group_id"], int(deal["_id"])
+
+
+@effect("activate")
+async def _activate(client, deal):
+    if await deal_leases.bind(deal["group_id"], deal["form_id"], deal.get("lease"), deal["_id"]):
+        if await database.transition(deal["_id"], "active"):
+            timer_wheel.cancel(f"expire:{deal['_id']}")
+    else:
+        # released meanwhile (the deal expired first): it stays pending
+        # and expire_deal cancels it
+        LOGGER.warning(f"Deal {deal['_id']} lost its form lease, left pending")
+
+
+@effect("pin")
+async def _pin(client, deal):
+    if deal.get("status") not in database.OPEN_STATES:
+        return  # a retry after the deal closed: nothing left to pin
+    chat_id, msg_id = _chat(deal)
+    await send_queue.call(chat_id, lambda: client.pin_message(chat_id, msg_id), CLEANUP)
+
+
+@effect("unpin")
+async def _unpin(client, deal):
+    chat_id, msg_id = _chat(deal)
+    await send_queue.call(chat_id, lambda: client.unpin_message(chat_id, msg_id), CLEANUP)
+
+
+@effect("delete")
+async def _delete(client, deal):
+    chat_id, msg_id = _chat(deal)
+    await send_queue.call(chat_id, lambda: client.delete_messages(chat_id, [msg_id]), CLEANUP)
+
+
+async def _announce(client, deal, title):
+    chat_id = deal["group_id"]
+    text = f"{title}\n\n{deal.get('text') or deal.get('deal_id')}"
+    return await send_queue.call(chat_id, lambda: client.send_message(chat_id, text), REPLY)
+
+
+@effect("announce_completed", once=True)
+async def _announce_completed(client, deal):
+    return await _announce(client, deal, "✅ **DEAL COMPLETED**")
+
+
+@effect("announce_cancelled", once=True)
+async def _announce_cancelled(client, deal):
+    return await _announce(client, deal, "❌ **DEAL CANCELLED**")
+
+
+@effect("proof", once=True)
+async def _proof(client, deal):
+    proof_ch = await database.get_proof_channel(deal["group_id"])
+    if proof_ch:
+        text = f"✅ **DEAL COMPLETED**\n\n{deal.get('text') or deal.get('deal_id')}"
+        return await send_queue.call(proof_ch, lambda: client.send_message(proof_ch, text), PROOF)
+
+
+@effect("lease_completed")
+async def _lease_completed(client, deal):
+    await deal_leases.finish(deal["group_id"], deal["form_id"], "completed")
+
+
+@effect("lease_cancelled")
+async def _lease_cancelled(client, deal):
+    await deal_leases.finish(deal["group_id"], deal["form_id"], "cancelled")
+
+
+@effect("lease_release")
+async def _lease_release(client, deal):
+    # the /add activated it, so nobody else can hold it: frees the form,
+    # also when it got bound just before the deal expired
+    await deal_leases.release(deal["group_id"], deal["form_id"], deal.get("lease"), deal["_id"])
+
+
+@effect("stats")
+async def _stats(client, deal):
+    # keyed by the deal, so a retry after a crash counts it once; left in
+    # the outbox until the flush before clear_outbox has landed
+    await database.update_stats(
+        deal["admin_id"], deal["amount"], deal["currency"],
+        is_admin=True, username=deal.get("admin_mention"),
+        group_id=deal.get("group_id"), deal_id=deal["_id"]
+    )
+
+
+@effect("processed_completed")
+async def _processed_completed(client, deal):
+    await database.mark_processed(deal["_id"], "completed")
+
+
+@effect("processed_cancelled")
+async def _processed_cancelled(client, deal):
+    await database.mark_processed(deal["_id"], "cancelled")
+
+
+@effect("kick")
+async def _kick(client, deal):
+    schedule_kick(deal)
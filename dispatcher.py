@@ -0,0 +1,112 @@
+import re
+import time
+
+import metrics
+
+# ================== COMMAND DISPATCHER ==================
+#
+# One NewMessage handler for the whole bot. Plain chatter is dropped on a
+# first-character check; commands are a dict lookup on the first word,
+# then (optionally) a precompiled pattern for their arguments.
+#
+# With a ChatQueues (workqueue.py) handlers run on their chat's queue, and
+# expect() replaces client.conversation(): the next message from that
+# user in that chat goes to a callback instead of a coroutine waiting.
+#
+# observers see every message before routing (entities.py keeps recent
+# ones); they are plain functions and must stay cheap.
+
+
+class Route:
+    __slots__ = ("name", "handler", "pattern", "group_only")
+
+    def __init__(self, name, handler, pattern=None, group_only=False):
+        self.name = name
+        self.handler = handler
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.group_only = group_only
+
+
+class CommandRouter:
+
+    def __init__(self, queues=None):
+        self.queues = queues
+        self.commands = {}      # "add" -> Route   (for "/add ...")
+        self.keywords = {}      # "form" -> Route  (whole-message keywords)
+        self.prompts = {}       # (chat_id, user_id) -> (fn(event), expires_at)
+        self.observers = []     # fn(event), called for every message
+        self._max_keyword = 0
+
+    def command(self, name, pattern=None, group_only=False):
+        def deco(fn):
+            self.commands[name.lower()] = Route(name.lower(), fn, pattern, group_only)
+            return fn
+        return deco
+
+    def keyword(self, word, group_only=False):
+        def deco(fn):
+            self.keywords[word.lower()] = Route(word.lower(), fn, None, group_only)
+            self._max_keyword = max(self._max_keyword, len(word))
+            return fn
+        return deco
+
+    def expect(self, chat_id, user_id, fn, timeout=60):
+        """Hand the user's next message in the chat to `fn(event)`."""
+        self.prompts[(chat_id, user_id)] = (fn, time.monotonic() + timeout)
+        if self.queues is not None:
+            # forget it if never answered
+            self.queues.later(timeout + 1, chat_id, lambda: self._expire(chat_id, user_id))
+
+    def has_prompt(self, event):
+        """Whether expect() is waiting for this message (multi-worker mode:
+        the worker that asked takes the answer, whoever owns the chat)."""
+        return (event.chat_id, event.sender_id) in self.prompts
+
+    async def _expire(self, chat_id, user_id):
+        prompt = self.prompts.get((chat_id, user_id))
+        if prompt and prompt[1] <= time.monotonic():
+            del self.prompts[(chat_id, user_id)]
+
+    def route(self, text):
+        """Return the Route for a raw message text, or None."""
+        if not text:
+            return None
+        if text[0] == "/":
+            head = text.split(None, 1)[0]
+            # "/add@EscrowBot 100 inr" -> "add"
+            return self.commands.get(head[1:].split("@", 1)[0].lower())
+        if len(text) <= self._max_keyword:
+            return self.keywords.get(text.lower())
+        return None
+
+    async def dispatch(self, event):
+        for observe in self.observers:
+            observe(event)
+        if self.prompts:
+            prompt = self.prompts.pop((event.chat_id, event.sender_id), None)
+            if prompt and prompt[1] > time.monotonic():
+                metrics.inc("messages_total", routed="prompt")
+                return await self._run("prompt", prompt[0], event)
+
+        text = event.raw_text
+        route = self.route(text)
+        if route is None:
+            metrics.inc("messages_total", routed="no")
+            return
+        metrics.inc("messages_total", routed="yes")
+        if route.group_only and not event.is_group:
+            return
+        if route.pattern is not None:
+            match = route.pattern.match(text)
+            if not match:
+                return
+            event.pattern_match = match
+        await self._run(route.name, route.handler, event)
+
+    async def _run(self, name, handler, event):
+        async def job():
+            async with metrics.timer("handler_seconds", command=name):
+                await handler(event)
+        if self.queues is None:
+            return await job()
+        await self.queues.run(event.chat_id, job)
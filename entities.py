@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from pymongo import ASCENDING
+
+import database
+import metrics
+from cache import MISSING, TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== TELEGRAM ENTITY CACHE ==================
+#
+# Telegram lookups the handlers keep repeating for the same people and
+# messages, each behind a TTL cache:
+#
+#   users        id -> Profile            (/add's admin mention)
+#   permissions  (chat, user) -> creator  (/form, proof commands)
+#   usernames    "seller" -> id           (buyer / seller kicks)
+#   messages     (chat, msg) -> Message   (the form an /add replies to)
+#
+# An edited message is dropped from `messages` (forget_message), so an /add
+# replying to an edited form reads the new text.
+# username -> id resolutions are also persisted in `usernames` (expiring
+# after USERNAME_TTL_DAYS), so a restart does not resolve everyone again.
+# Bans do not trust them that long: auto_kick resolves with max_age.
+# Ids looked up since the last pass are re-fetched in bulk by
+# entity_refresh_worker (get_entity on a list = one GetUsersRequest per
+# ENTITY_BATCH) instead of one call each when their entry expires.
+
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", "3600"))
+PERMISSION_CACHE_TTL = int(os.getenv("PERMISSION_CACHE_TTL", "600"))
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "20000"))
+USERNAME_TTL_DAYS = int(os.getenv("USERNAME_TTL_DAYS", "30"))
+RESOLVE_CONCURRENCY = int(os.getenv("RESOLVE_CONCURRENCY", "4"))
+ENTITY_BATCH = 100
+
+Profile = namedtuple("Profile", "id username first_name")
+Message = namedtuple("Message", "id chat_id sender_id text")
+
+usernames_col = database.db.usernames
+database.ensure_index(usernames_col, [("at", ASCENDING)], expireAfterSeconds=USERNAME_TTL_DAYS * 86400)
+
+users = TTLCache(maxsize=50000, ttl=ENTITY_CACHE_TTL)
+permissions = TTLCache(maxsize=20000, ttl=PERMISSION_CACHE_TTL)
+usernames = TTLCache(maxsize=50000, ttl=ENTITY_CACHE_TTL)
+messages = TTLCache(maxsize=MESSAGE_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+
+_seen = set()       # user ids looked up since the last refresh pass
+_resolve_sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+
+def _name(username):
+    return username.lstrip("@").lower() if username else None
+
+
+# ---------- users ----------
+
+def remember(user):
+    """Cache a Telethon User (or anything with id / username / first_name)."""
+    profile = Profile(user.id, getattr(user, "username", None), getattr(user, "first_name", None) or "")
+    users.set(profile.id, profile)
+    if profile.username:
+        name = _name(profile.username)
+        if usernames.get(name) != profile.id:
+            usernames.set(name, profile.id)
+            database.write_buffer.inc(usernames_col, {"_id": name}, {}, set={
+                "user_id": profile.id, "at": datetime.now(timezone.utc)
+            })
+    return profile
+
+
+async def get_sender(event):
+    """The sender's Profile; Telegram is only asked on a cache miss."""
+    profile = users.get(event.sender_id)
+    if profile is MISSING:
+        metrics.inc("entity_cache_total", kind="user", result="miss")
+        profile = remember(await event.get_sender())
+        await database.write_buffer.maybe_flush()
+    else:
+        metrics.inc("entity_cache_total", kind="user", result="hit")
+    _seen.add(profile.id)
+    return profile
+
+
+# ---------- permissions ----------
+
+async def is_creator(client, chat_id, user_id):
+    key = (chat_id, user_id)
+    creator = permissions.get(key)
+    if creator is MISSING:
+        metrics.inc("entity_cache_total", kind="permission", result="miss")
+        perms = await client.get_permissions(chat_id, user_id)     # errors are not cached
+        creator = bool(perms.is_creator)
+        permissions.set(key, creator)
+    else:
+        metrics.inc("entity_cache_total", kind="permission", result="hit")
+    return creator
+
+
+# ---------- usernames ----------
+
+async def _resolve_one(client, name):
+    async with _resolve_sem:
+        try:
+            entity = await client.get_entity(name)
+        except (ValueError, TypeError) as e:   # no such username / not a user
+            LOGGER.debug(f"Cannot resolve @{name}: {e!r}")
+            usernames.set(name, None)
+            return None
+    return remember(entity).id
+
+
+def _stale(doc, max_age):
+    if max_age is None:
+        return False
+    at = doc.get("at")
+    if at is None:
+        return True
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - at).total_seconds() > max_age
+
+
+async def resolve(client, names, max_age=None):
+    """{"@name": id or None} for usernames: memory, then one Mongo query
+    for all misses, then Telegram for what is left.
+
+    With max_age (seconds), persisted mappings older than that and cached
+    ones whose user has since been seen under another name are asked
+    again: usernames get reassigned, and a ban must hit the current owner."""
+    wanted = {n: _name(n) for n in names if n}
+    found = {}
+    missing = []
+    renamed = set()     # straight to Telegram, the stored mapping is no better
+    for name in set(wanted.values()):
+        user_id = usernames.get(name)
+        if user_id is not MISSING and max_age is not None and user_id is not None:
+            profile = users.get(user_id)
+            if profile is not MISSING and _name(profile.username) != name:
+                renamed.add(name)
+                user_id = MISSING
+        if user_id is MISSING:
+            missing.append(name)
+        else:
+            found[name] = user_id
+    metrics.inc("entity_cache_total", len(found), kind="username", result="hit")
+    if missing:
+        metrics.inc("entity_cache_total", len(missing), kind="username", result="miss")
+        docs = await database.db_call(lambda: list(usernames_col.find({"_id": {"$in": missing}})))
+        for doc in docs:
+            if doc["_id"] in renamed or _stale(doc, max_age):
+                continue
+            found[doc["_id"]] = doc["user_id"]
+            usernames.set(doc["_id"], doc["user_id"])
+        left = [n for n in missing if n not in found]
+        ids = await asyncio.gather(*(_resolve_one(client, n) for n in left), return_exceptions=True)
+        for name, user_id in zip(left, ids):
+            if isinstance(user_id, Exception):
+                LOGGER.warning(f"Resolving @{name} failed: {user_id!r}")
+                user_id = None
+            found[name] = user_id
+        await database.write_buffer.maybe_flush()
+    return {orig: found.get(name) for orig, name in wanted.items()}
+
+
+# ---------- messages ----------
+
+def remember_message(event):
+    """Router observer: keep recent group messages, so an /add replying
+    to a form does not have to fetch it again."""
+    if event.is_group and event.raw_text:
+        messages.set((event.chat_id, event.id),
+                     Message(event.id, event.chat_id, event.sender_id, event.raw_text))
+
+
+async def forget_message(event):
+    """MessageEdited handler: the cached copy is stale now."""
+    messages.invalidate((event.chat_id, event.id))
+
+
+async def get_reply_message(event):
+    reply_to = getattr(event, "reply_to_msg_id", None)
+    message = messages.get((event.chat_id, reply_to)) if reply_to else MISSING
+    if message is MISSING:
+        metrics.inc("entity_cache_total", kind="message", result="miss")
+        return await event.get_reply_message()
+    metrics.inc("entity_cache_total", kind="message", result="hit")
+    return message
+
+
+# ---------- bulk refresh ----------
+
+async def refresh(client):
+    """Re-fetch every user looked up since the last pass, ENTITY_BATCH per call."""
+    ids = list(_seen)
+    _seen.clear()
+    for i in range(0, len(ids), ENTITY_BATCH):
+        batch = ids[i:i + ENTITY_BATCH]
+        try:
+            for user in await client.get_entity(batch):
+                remember(user)
+        except Exception as e:
+            LOGGER.warning(f"Entity refresh of {len(batch)} users failed: {e!r}")
+    await database.write_buffer.maybe_flush()
+    return len(ids)
+
+
+async def entity_refresh_worker(client):
+    # half the TTL: hot entries are replaced before they ever expire
+    while True:
+        await asyncio.sleep(ENTITY_CACHE_TTL / 2)
+        started = time.perf_counter()
+        count = await refresh(client)
+        if count:
+            LOGGER.info(f"👤 Refreshed {count} users in {time.perf_counter() - started:.2f}s")
+
+
+metrics.gauge("entity_cache", lambda: {
+    (("cache", name),): len(cache)
+    for name, cache in (("users", users), ("permissions", permissions),
+                        ("usernames", usernames), ("messages", messages))
+})
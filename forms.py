@@ -0,0 +1,111 @@
+import re
+from functools import lru_cache
+
+import database
+
+# ================== FORM PARSER ==================
+#
+# Each group's form template (database.get_form_data) is compiled once into
+# a single regex that pulls every "Label: value" line out of a filled-in
+# form in one pass, e.g. for the default template
+#
+#   Seller: @bob            -> {"seller": "@bob",
+#   Buyer: @alice                "buyer": "@alice",
+#   Amount: 500 inr              "amount": "500 inr",
+#   Payment Method: UPI          "payment_method": "UPI",
+#   Release to : @bob            "release_to": "@bob"}
+#
+# Compiled parsers are cached by template text, so editing the form
+# (/form) is a new version and compiles again on first use.
+# Seller, Buyer and Amount are always matched, even when a custom template
+# leaves them out.
+
+BASE_FIELDS = ("Seller", "Buyer", "Amount")
+PARTY_FIELDS = ("buyer", "seller")
+
+# a template line: optional markup, a label, then ":" (or ":-")
+_LABEL = re.compile(r"^[ \t*_`]*([A-Za-z][\w ()/&.']*?)[ \t*_`]*:", re.MULTILINE)
+_USERNAME = re.compile(r"@?\w+")
+_AMOUNT = re.compile(r"(\d+)\s*(inr|usdt|₹|\$|usd)?|(inr|usdt|₹|\$|usd)", re.IGNORECASE)
+
+
+def _key(label):
+    return re.sub(r"\W+", "_", label.strip().lower()).strip("_")
+
+
+class FormParser:
+    """Precompiled matcher for one template version."""
+
+    __slots__ = ("fields", "pattern", "_keys")
+
+    def __init__(self, template):
+        labels = {}
+        for label in [*_LABEL.findall(template or ""), *BASE_FIELDS]:
+            key = _key(label)
+            if key and key not in labels.values():
+                labels[" ".join(label.lower().split())] = key
+        self.fields = tuple(labels.values())
+        self._keys = labels
+        # longest first, so "Release to" wins over a "Release" label
+        alts = "|".join(r"\s+".join(map(re.escape, label.split()))
+                        for label in sorted(labels, key=len, reverse=True))
+        self.pattern = re.compile(
+            rf"^[ \t*_`]*({alts})[ \t*_`]*:-?[ \t*]*(.*?)[ \t*]*$",
+            re.MULTILINE | re.IGNORECASE
+        )
+
+    def parse(self, text):
+        """{field: value} for every filled-in line (first occurrence wins)."""
+        found = {}
+        if not text:
+            return found
+        for label, value in self.pattern.findall(text):
+            if value:
+                label = label.lower()
+                key = self._keys.get(label) or self._keys[" ".join(label.split())]
+                if key not in found:
+                    found[key] = value
+        for role in PARTY_FIELDS:
+            if role in found:
+                m = _USERNAME.match(found[role])
+                if m:
+                    found[role] = m.group(0)
+                else:
+                    del found[role]
+        return found
+
+
+@lru_cache(maxsize=1024)
+def compile_form(template):
+    return FormParser(template)
+
+
+async def parse_form(chat_id, text):
+    """Parse a filled-in form with the group's current template."""
+    template, _ = await database.get_form_data(chat_id=chat_id)
+    return compile_form(template).parse(text)
+
+
+def parse_amount(text):
+    """(amount, "inr" | "usdt") from free text, or (None, None).
+
+    A number directly followed by a currency wins; otherwise the first
+    number, if a currency is mentioned anywhere (inr before usdt)."""
+    if not text:
+        return None, None
+    number = None
+    currencies = set()
+    for digits, suffix, word in _AMOUNT.findall(text):
+        if digits and suffix:
+            return int(digits), _currency(suffix)
+        if digits and number is None:
+            number = int(digits)
+        if word:
+            currencies.add(_currency(word))
+    if number is not None and currencies:
+        return number, "inr" if "inr" in currencies else "usdt"
+    return None, None
+
+
+def _currency(word):
+    return "inr" if word.lower() in ("inr", "₹") else "usdt"
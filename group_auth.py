@@ -1,22 +1,79 @@
-from database import db
+import time
+from database import change_listeners, db, db_call, meta
+
+# ================== AUTHORIZED GROUPS ==================
+#
+# Canonical registry of escrow groups: one doc per chat in `auth_groups`
+# (_id = chat id), mirrored in an in-memory set so the per-message
+# is_authorized_group() check never touches Mongo.
+
+auth_col = db.auth_groups
+settings = db.settings  # legacy single-group store
+
+_authorized = set()
+_loaded = False
+
+
+def _migrate_legacy():
+    # older builds kept exactly one group in meta / settings "auth_group"
+    for col in (meta, settings):
+        doc = col.find_one({"_id": "auth_group"})
+        if doc and doc.get("chat_id"):
+            auth_col.update_one(
+                {"_id": int(doc["chat_id"])},
+                {"$setOnInsert": {"added_at": time.time()}},
+                upsert=True
+            )
+        col.delete_one({"_id": "auth_group"})
+
+
+def _load():
+    _migrate_legacy()
+    return {int(d["_id"]) for d in auth_col.find({}, {"_id": 1})}
+
+
+async def load_auth_groups():
+    global _loaded
+    ids = await db_call(_load)
+    _authorized.clear()
+    _authorized.update(ids)
+    _loaded = True
+    return len(_authorized)
 
-settings = db.settings
 
 # Save authorized group
 async def authorize_group(chat_id: int):
-    settings.update_one(
-        {"_id": "auth_group"},
-        {"$set": {"chat_id": int(chat_id)}},
+    await db_call(
+        auth_col.update_one,
+        {"_id": int(chat_id)},
+        {"$setOnInsert": {"added_at": time.time()}},
         upsert=True
     )
+    _authorized.add(int(chat_id))
 
 # Remove authorization
-async def deauthorize_group():
-    settings.delete_one({"_id": "auth_group"})
+async def deauthorize_group(chat_id: int):
+    await db_call(auth_col.delete_one, {"_id": int(chat_id)})
+    _authorized.discard(int(chat_id))
 
 # Check authorization
 async def is_authorized_group(chat_id: int) -> bool:
-    doc = settings.find_one({"_id": "auth_group"})
-    if not doc:
-        return False
-    return doc.get("chat_id") == int(chat_id)
+    if not _loaded:
+        await load_auth_groups()
+    return int(chat_id) in _authorized
+
+def authorized_groups():
+    return set(_authorized)
+
+
+# other instances' /authgroup and /deauthgroup (CONFIG_WATCH=1)
+def _on_change(change):
+    chat_id = change.get("documentKey", {}).get("_id")
+    if chat_id is None:
+        return
+    if change["operationType"] == "delete":
+        _authorized.discard(int(chat_id))
+    else:
+        _authorized.add(int(chat_id))
+
+change_listeners[auth_col.name] = _on_change
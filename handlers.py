@@ -1,9 +1,21 @@
-import asyncio
-import re
 import time
+from datetime import datetime, timezone
 from telethon import events, Button
 from telethon.tl.types import User
 from config import OWNER_ID
+import deal_flow
+import entities
+import forms
+import metrics
+from dispatcher import CommandRouter
+from group_auth import authorize_group, deauthorize_group, is_authorized_group
+from leases import DONE, deal_leases
+import retention
+import leaderboard
+from sender import CLEANUP, fire, send_queue
+from shards import shard_map
+from timers import delete_later
+from workqueue import chat_queues
 import database
 
 # =====================================================
@@ -24,20 +36,7 @@ Type /help to see commands.
 # UTILITIES
 # =====================================================
 
-def parse_deal_info(text):
-    if not text:
-        return None, None
-    t = text.lower()
-    m = re.findall(r'(\d+)\s*(inr|usdt|₹|\$|usd)', t)
-    if m:
-        return int(m[0][0]), ("inr" if m[0][1] in ["inr", "₹"] else "usdt")
-    nums = re.findall(r'(\d+)', t)
-    if nums:
-        if "inr" in t or "₹" in t:
-            return int(nums[0]), "inr"
-        if "usdt" in t or "$" in t or "usd" in t:
-            return int(nums[0]), "usdt"
-    return None, None
+parse_deal_info = forms.parse_amount
 
 
 async def is_bot_owner(uid):
@@ -46,8 +45,7 @@ async def is_bot_owner(uid):
 
 async def is_group_owner(client, chat_id, uid):
     try:
-        perms = await client.get_permissions(chat_id, uid)
-        return perms.is_creator
+        return await entities.is_creator(client, chat_id, uid)
     except:
         return False
 
@@ -75,20 +73,25 @@ async def get_user_limit(user_id, currency):
     return int(data.get(currency.lower(), 0))
 
 
-# =====================================================
-# AUTH GROUP (ONLY BOT OWNER)
-# =====================================================
-
-async def authorize_group(chat_id):
-    await database.set_auth_group(chat_id)
+async def can_manage_admins(uid):
+    return await is_bot_owner(uid) or (await database.get_admin_limit(uid)).get("is_mmod")
 
 
-async def deauthorize_group():
-    await database.remove_auth_group()
+async def can_change_profile(uid, target):
+    """Super mods manage admins and mods; only the bot owner touches a super mod."""
+    return await is_bot_owner(uid) or not (await database.get_admin_limit(target)).get("is_mmod")
 
 
-async def is_authorized_group(chat_id):
-    return await database.is_auth_group(chat_id)
+async def resolve_user(client, event, arg):
+    """Target of an admin command: a user id, @username or the replied-to user."""
+    if arg:
+        if arg.lstrip("-").isdigit():
+            return int(arg)
+        return (await entities.resolve(client, [arg]))[arg]
+    if event.is_reply:
+        reply = await entities.get_reply_message(event)
+        return reply.sender_id if reply else None
+    return None
 
 
 # =====================================================
@@ -112,18 +115,24 @@ async def get_proof_channel(group_id):
 # =====================================================
 
 def register_handlers(client):
+    router = CommandRouter(chat_queues)
+    # multi-worker mode: only this worker's chats (shards.py)
+    client.add_event_handler(shard_map.gated(router.dispatch, always=router.has_prompt), events.NewMessage())
+    router.observers.append(entities.remember_message)
+    # not gated: a worker may get a slot back with copies edited meanwhile
+    client.add_event_handler(entities.forget_message, events.MessageEdited())
 
     # -------------------------------------------------
     # START
     # -------------------------------------------------
-    @client.on(events.NewMessage(pattern="/start"))
+    @router.command("start")
     async def start(event):
         await event.reply(WELCOM_MSG)
 
     # -------------------------------------------------
     # HELP
     # -------------------------------------------------
-    @client.on(events.NewMessage(pattern="/help"))
+    @router.command("help")
     async def help_cmd(event):
         await event.reply("""
 📖 **DVA Escrow Bot – Full Command List**
@@ -153,12 +162,14 @@ form – Show form
 📊 **STATS**
 /mytotal  
 /mydeals  
-/leaderboard  
+/leaderboard [day|week|month] [page]  
 /running  
 
 📈 **REPORTS**
 /dreport  
 /wreport  
+/mreport  
+/report <YYYY-MM-DD> <YYYY-MM-DD>  
 
 ⚠️ Each group has separate:
 • Form
@@ -168,51 +179,93 @@ form – Show form
     # -------------------------------------------------
     # AUTH GROUP
     # -------------------------------------------------
-    @client.on(events.NewMessage(pattern="/authgroup", func=lambda e: e.is_group))
+    @router.command("authgroup", group_only=True)
     async def auth_group(event):
         if event.sender_id != OWNER_ID:
             return await event.reply("❌ Bot owner only.")
         await authorize_group(event.chat_id)
         await event.reply("✅ Group authorized for escrow.")
 
-    @client.on(events.NewMessage(pattern="/deauthgroup", func=lambda e: e.is_group))
+    @router.command("deauthgroup", group_only=True)
     async def deauth_group(event):
         if event.sender_id != OWNER_ID:
             return await event.reply("❌ Bot owner only.")
-        await deauthorize_group()
+        await deauthorize_group(event.chat_id)
         await event.reply("🚫 Group deauthorized.")
 
+    # -------------------------------------------------
+    # ADMIN SYSTEM (limits are cached; set_admin_limit keeps them fresh)
+    # -------------------------------------------------
+    DEFAULT_ADMIN_LIMITS = {"inr": 5000, "usdt": 50}
+
+    @router.command("admin", pattern=r"/admin(?:@\w+)?(?:\s+(@?\w+))?(?:\s+(\d+)\s+(inr|usdt))?\s*$")
+    async def admin_cmd(event):
+        if not await can_manage_admins(event.sender_id):
+            return await event.reply("❌ Bot owner / super mod only.")
+        uid = await resolve_user(client, event, event.pattern_match.group(1))
+        if uid is None:
+            return await event.reply("Usage: /admin <user> [amount inr|usdt] (or reply)")
+        if not await can_change_profile(event.sender_id, uid):
+            return await event.reply("❌ Bot owner only.")
+        if event.pattern_match.group(2):
+            amount, cur = int(event.pattern_match.group(2)), event.pattern_match.group(3)
+            await database.set_admin_limit(uid, amount, cur)
+            sym = "₹" if cur == "inr" else "$"
+            return await event.reply(f"✅ {uid} is admin: {amount}{sym} open limit.")
+        await database.set_admin_limit(uid, **DEFAULT_ADMIN_LIMITS)
+        await event.reply(f"✅ {uid} is admin: ₹{DEFAULT_ADMIN_LIMITS['inr']} + ${DEFAULT_ADMIN_LIMITS['usdt']} open limit.")
+
+    for cmd, flags, title in (
+        ("mod", {"is_mod": True}, "Mod (unlimited)"),
+        ("smod", {"is_mmod": True}, "Super Mod"),
+        ("unadmin", {}, None),
+        ("unmod", {}, None),
+    ):
+        def make(flags=flags, title=title):
+            async def handler(event):
+                if not await can_manage_admins(event.sender_id):
+                    return await event.reply("❌ Bot owner / super mod only.")
+                uid = await resolve_user(client, event, event.pattern_match.group(1))
+                if uid is None:
+                    return await event.reply("Usage: /<command> <user> (or reply)")
+                if flags.get("is_mmod") and not await is_bot_owner(event.sender_id):
+                    return await event.reply("❌ Bot owner only.")
+                if not await can_change_profile(event.sender_id, uid):
+                    return await event.reply("❌ Bot owner only.")
+                await database.set_admin_limit(uid, **flags)
+                await event.reply(f"✅ {uid} is now {title}." if title else f"🚫 {uid} removed.")
+            return handler
+        router.command(cmd, pattern=rf"/{cmd}(?:@\w+)?(?:\s+(@?\w+))?\s*$")(make())
+
     # -------------------------------------------------
     # FORM
     # -------------------------------------------------
-    @client.on(events.NewMessage(pattern="/form"))
+    # the form text is the owner's next DM, picked up by router.expect()
+    # instead of holding a 60s client.conversation() open
+    @router.command("form")
     async def update_form(event):
         if event.is_private and await is_bot_owner(event.sender_id):
-            async with client.conversation(event.sender_id, timeout=60) as conv:
-                await conv.send_message("Send GLOBAL form:")
-                try:
-                    msg = await conv.get_response()
-                except asyncio.TimeoutError:
-                    return
-                await database.update_form_message(msg.text or "")
-                return await conv.send_message("✅ Global form updated.")
+            async def save_global(reply):
+                await database.update_form_message(reply.text or "")
+                await reply.respond("✅ Global form updated.")
+            router.expect(event.sender_id, event.sender_id, save_global, timeout=60)
+            return await event.respond("Send GLOBAL form:")
 
         if event.is_group:
             if not await is_authorized_group(event.chat_id):
                 return await event.reply("❌ Unauthorized group.")
             if not await is_group_owner(client, event.chat_id, event.sender_id):
                 return await event.reply("⚠️ Only group owner.")
-            async with client.conversation(event.sender_id, timeout=60) as conv:
-                await conv.send_message("Send GROUP form:")
-                try:
-                    msg = await conv.get_response()
-                except asyncio.TimeoutError:
-                    return
-                await database.update_form_message(msg.text or "", chat_id=event.chat_id)
-                await conv.send_message("✅ Group form updated.")
-                await event.reply("📩 Check DM.")
-
-    @client.on(events.NewMessage(func=lambda e: e.is_group and e.text and e.text.lower() == "form"))
+            group_id = event.chat_id
+
+            async def save_group(reply):
+                await database.update_form_message(reply.text or "", chat_id=group_id)
+                await reply.respond("✅ Group form updated.")
+            router.expect(event.sender_id, event.sender_id, save_group, timeout=60)
+            await client.send_message(event.sender_id, "Send GROUP form:")
+            await event.reply("📩 Check DM.")
+
+    @router.keyword("form", group_only=True)
     async def show_form(event):
         if not await is_authorized_group(event.chat_id):
             return
@@ -222,58 +275,57 @@ form – Show form
     # -------------------------------------------------
     # ADD DEAL
     # -------------------------------------------------
-    deal_locks = {}
-
-    @client.on(events.NewMessage(pattern=r"/add (\d+) (inr|usdt|₹|\$)", func=lambda e: e.is_group))
+    @router.command("add", pattern=r"/add(?:@\w+)? (\d+) (inr|usdt|₹|\$)", group_only=True)
     async def add_deal(event):
         if not await is_authorized_group(event.chat_id):
             return
         if not event.is_reply:
             return await event.reply("Reply to a form message.")
 
-        reply = await event.get_reply_message()
-        key = (event.chat_id, reply.id)
-        if key in deal_locks:
-            return
-        deal_locks[key] = True
+        reply = await entities.get_reply_message(event)
 
-        try:
-            if await database.get_processed_status(reply.id):
+        # one round-trip: lock + "already used" + active-form claim
+        lease, status = await deal_leases.claim(event.chat_id, reply.id)
+        if not lease:
+            if status in DONE:
                 return await event.reply("❌ Already used.")
+            return await event.reply("❌ Deal already running.")
 
-            if not await database.atomic_start_deal(reply.id):
-                return await event.reply("❌ Deal already running.")
-
+        reserved = None
+        posting, sent, deal_no = False, None, None
+        try:
             amt = int(event.pattern_match.group(1))
             cur = "inr" if event.pattern_match.group(2) in ["inr", "₹"] else "usdt"
 
+            # cached limit vs. open deals + /adds in flight (memory-only
+            # with one worker, shared holds in Mongo with several)
             limit = await get_user_limit(event.sender_id, cur)
-            if limit is not None and amt > limit:
-                warn = await event.reply(
-                    f"❌ Your limit is less than deal amount."
-                )
-                await asyncio.sleep(60)
-                await warn.delete()
-                await event.delete()
+            hold = await database.reserve_exposure(event.sender_id, amt, cur, limit)
+            if not hold:
+                await deal_leases.release(event.chat_id, reply.id, lease)
+                sym = "₹" if cur == "inr" else "$"
+                open_amt = await database.get_exposure(event.sender_id, cur)
+                warn = await send_queue.call(event.chat_id, lambda: event.reply(
+                    f"❌ Your limit is less than deal amount.\n"
+                    f"Open: {open_amt}{sym} / Limit: {limit}{sym}"
+                ))
+                delete_later(60, event.chat_id, warn.id, event.id)
                 return
+            reserved = (event.sender_id, amt, cur, hold)
 
             sym = "₹" if cur == "inr" else "$"
-            deal_no = await database.increment_deal(cur)
+            deal_no = await database.increment_deal(cur, event.chat_id)
             deal_id = f"#Escrow{deal_no}"
 
-    
-                # Get buyer/seller
-                buyer_mention = "@Buyer"
-                seller_mention = "@Seller"
-                if reply_msg and reply_msg.text:
-                    text_to_parse = reply_msg.text
-                    seller_match = re.search(r'Seller:\s*(@?\w+)', text_to_parse, re.IGNORECASE)
-                    if seller_match: seller_mention = seller_match.group(1)
-                    buyer_match = re.search(r'Buyer:\s*(@?\w+)', text_to_parse, re.IGNORECASE)
-                    if buyer_match: buyer_mention = buyer_match.group(1)
+            # every field of the group's form in one pass; buyer / seller
+            # None = not in form, never kicked
+            fields = await forms.parse_form(event.chat_id, reply.text)
+            buyer = fields.pop("buyer", None)
+            seller = fields.pop("seller", None)
+            buyer_mention = buyer or "@Buyer"
+            seller_mention = seller or "@Seller"
 
-
-            sender = await event.get_sender()
+            sender = await entities.get_sender(event)
             admin = f"@{sender.username}" if sender.username else sender.first_name
 
             text = f"""┏━━━━━━━━━━━━━━━━━━━┓
@@ -286,30 +338,53 @@ form – Show form
 ┃ 🛡️ Admin: {admin}
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛"""
 
-            btn = [Button.inline("Complete Deal", data=f"comp_{event.sender_id}")]
-            sent = await event.respond(text, buttons=btn)
+            # nothing is posted unless this /add still holds the form (its
+            # lease may have expired and been claimed again meanwhile)
+            if not await deal_leases.activate(event.chat_id, reply.id, lease):
+                await database.decrement_deal(cur, event.chat_id, deal_no)
+                return await event.reply("❌ Deal already running.")
 
-            try:
-                await client.pin_message(event.chat_id, sent)
-            except:
-                pass
+            btn = [Button.inline("Complete Deal", data=f"comp_{event.sender_id}")]
+            posting = True
+            sent = await send_queue.call(event.chat_id, lambda: event.respond(text, buttons=btn))
 
-            await database.store_deal(sent.id, reply.id, {
+            # pending until the outbox has pinned it and activated the lease
+            await deal_flow.open_deal(client, sent.id, reply.id, {
                 "admin_id": event.sender_id,
                 "amount": amt,
                 "currency": cur,
                 "deal_id": deal_id,
-                "buyer": buyer_mention,
-                "seller": seller_mention
-                "group_id": event.chat_id
+                "buyer": buyer,
+                "seller": seller,
+                "admin_mention": admin,
+                "group_id": event.chat_id,
+                "form": fields,
+                "lease": lease
             })
+        except BaseException as e:
+            if sent is not None:
+                # posted but never stored: take the start message down, but
+                # keep the form taken, a second one must never go out for it
+                fire(event.chat_id, lambda: client.delete_messages(event.chat_id, [sent.id]), CLEANUP)
+            elif not posting or isinstance(e, Exception):
+                # nothing posted (a failed send was given up on): free the
+                # form, and its number is not burned either
+                await deal_leases.release(event.chat_id, reply.id, lease)
+                if deal_no is not None:
+                    await database.decrement_deal(cur, event.chat_id, deal_no)
+            raise
         finally:
-            deal_locks.pop(key, None)
+            # stored (now in the open exposure) or failed: either way done
+            if reserved:
+                await database.release_exposure(*reserved)
 
     # -------------------------------------------------
     # COMPLETE DEAL (NO GLOBAL LOG)
     # -------------------------------------------------
     @client.on(events.CallbackQuery(pattern=br"comp_(\d+)"))
+    @shard_map.gated
+    @chat_queues.serial
+    @metrics.timed("handler_seconds", command="complete")
     async def complete_deal(event):
         admin_id = int(event.data.decode().split("_")[1])
         if event.sender_id != admin_id:
@@ -317,52 +392,154 @@ form – Show form
 
         msg = await event.get_message()
         deal = await get_deal(msg.id)
-        if not deal:
+        if not deal or deal.get("status") not in database.OPEN_STATES:
             return await event.answer("Already processed.", alert=True)
 
-        text = "✅ **DEAL COMPLETED**\n\n" + msg.text
+        # one conditional update; it leaves the open index before awaiting,
+        # so a double click gets "Already processed". The announcement,
+        # unpin, proof post, stats and kick run from the deal's outbox.
+        if not await deal_flow.complete_deal(client, msg.id, msg.text):
+            return await event.answer("Already processed.", alert=True)
         await event.answer("Deal completed!", alert=True)
-        await event.respond(text)
-
-        try:
-            await client.unpin_message(event.chat_id, msg)
-            await msg.delete()
-        except:
-            pass
-
-        proof_ch = await get_proof_channel(event.chat_id)
-        if proof_ch:
-            try:
-                await client.send_message(proof_ch, text)
-            except:
-                pass
-
-        await database.remove_deal(msg.id)
-        await database.mark_processed(msg.id, "completed")
 
     # -------------------------------------------------
     # CANCEL DEAL
     # -------------------------------------------------
-    @client.on(events.NewMessage(pattern="/cancel", func=lambda e: e.is_group))
+    @router.command("cancel", group_only=True)
     async def cancel_deal(event):
         if not event.is_reply:
             return
-        reply = await event.get_reply_message()
+        reply = await entities.get_reply_message(event)
         deal = await get_deal(reply.id)
-        if not deal:
+        if not deal or deal.get("status") not in database.OPEN_STATES:
             return
         if deal["admin_id"] != event.sender_id:
             return await event.reply("❌ Only deal admin can cancel.")
+        await deal_flow.cancel_deal(client, reply.id, reply.text)
 
-        text = "❌ **DEAL CANCELLED**\n\n" + reply.text
-        await event.respond(text)
+    # -------------------------------------------------
+    # RUNNING DEALS (served from the active-deal index)
+    # -------------------------------------------------
+    RUNNING_LIMIT = 50
+
+    def deal_lines(deals, show_admin):
+        deals = sorted(deals, key=lambda d: d.get("time", 0))
+        lines = []
+        for d in deals[:RUNNING_LIMIT]:
+            sym = "₹" if d.get("currency") == "inr" else "$"
+            who = d.get("admin_mention") if show_admin else d.get("group_id")
+            lines.append(f"• {d.get('deal_id')} — {d.get('amount')}{sym} ({who})")
+        if len(deals) > RUNNING_LIMIT:
+            lines.append(f"… and {len(deals) - RUNNING_LIMIT} more")
+        return "\n".join(lines)
+
+    @router.command("running", group_only=True)
+    async def running_cmd(event):
+        if not await is_authorized_group(event.chat_id):
+            return
+        deals = await database.get_running_deals(group_id=event.chat_id)
+        if not deals:
+            return await event.reply("✅ No running deals in this group.")
+        await event.reply(f"⏳ **Running Deals ({len(deals)})**\n\n" + deal_lines(deals, show_admin=True))
+
+    @router.command("mydeals")
+    async def my_deals_cmd(event):
+        deals = await database.get_running_deals(admin_id=event.sender_id)
+        if not deals:
+            return await event.reply("✅ You have no running deals.")
+        await event.reply(f"⏳ **Your Running Deals ({len(deals)})**\n\n" + deal_lines(deals, show_admin=False))
 
+    # -------------------------------------------------
+    # REPORTS
+    # -------------------------------------------------
+    async def report_scope(event):
+        """Group → that group's numbers, owner DM → global. None = refuse."""
+        if event.is_group:
+            if not await is_authorized_group(event.chat_id):
+                return None
+            return {"group_id": event.chat_id}
+        if await is_bot_owner(event.sender_id):
+            return {}
+        return None
+
+    async def send_report(event, title, totals):
+        deals, inr, usdt = totals
+        await event.reply(
+            f"📈 **{title}**\n\n"
+            f"🤝 Deals: {deals}\n"
+            f"💰 INR: ₹{inr:g}\n"
+            f"💵 USDT: ${usdt:g}"
+        )
+
+    for cmd, title, seconds in (
+        ("dreport", "Daily Report", 86400),
+        ("wreport", "Weekly Report", 7 * 86400),
+        ("mreport", "Monthly Report", 30 * 86400),
+    ):
+        async def period_report(event, title=title, seconds=seconds):
+            scope = await report_scope(event)
+            if scope is None:
+                return
+            await send_report(event, title, await database.get_report(seconds, **scope))
+        router.command(cmd)(period_report)
+
+    @router.command("report", pattern=r"/report(?:@\w+)? (\d{4}-\d{2}-\d{2}) (\d{4}-\d{2}-\d{2})")
+    async def range_report(event):
+        scope = await report_scope(event)
+        if scope is None:
+            return
         try:
-            await client.unpin_message(event.chat_id, reply)
-            await reply.delete()
-        except:
-            pass
+            start, end = (
+                datetime.strptime(d, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+                for d in event.pattern_match.groups()
+            )
+        except ValueError:
+            return await event.reply("Usage: /report YYYY-MM-DD YYYY-MM-DD")
+        totals = await database.get_report_range(start, end + 86400, **scope)
+        await send_report(event, f"Report {event.pattern_match.group(1)} → {event.pattern_match.group(2)}", totals)
+
+    @router.command("rebuildreports")
+    async def rebuild_reports(event):
+        if not await is_bot_owner(event.sender_id):
+            return await event.reply("❌ Bot owner only.")
+        started = time.time()
+        buckets = await database.rebuild_rollups()
+        await event.reply(f"✅ Rebuilt {buckets} report buckets in {time.time() - started:.1f}s.")
 
-        await database.remove_deal(reply.id)
-        await database.mark_processed(reply.id, "cancelled")
+    @router.command("storage")
+    async def storage_cmd(event):
+        if not await is_bot_owner(event.sender_id):
+            return await event.reply("❌ Bot owner only.")
+        stats = await retention.storage_stats()
+        lines = ["💾 **Storage**\n"]
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1]["storageSize"] - kv[1]["totalIndexSize"]):
+            lines.append(
+                f"• {name}: {s['count']} docs, {s['storageSize'] / 1048576:.1f} MiB "
+                f"+ {s['totalIndexSize'] / 1048576:.1f} MiB idx"
+            )
+        await event.reply("\n".join(lines))
 
+    # -------------------------------------------------
+    # LEADERBOARD
+    # -------------------------------------------------
+    LEADERBOARD_PAGE = 10
+    LEADERBOARD_TITLES = {"all": "All Time", "day": "Today", "week": "This Week", "month": "This Month"}
+
+    @router.command("leaderboard", pattern=r"/leaderboard(?:@\w+)?(?:\s+(all|day|week|month))?(?:\s+(\d+))?\s*$")
+    async def leaderboard_cmd(event):
+        period = event.pattern_match.group(1) or "all"
+        page = max(1, int(event.pattern_match.group(2) or 1))
+        rows, deals, inr, usdt = await leaderboard.get_leaderboard(
+            period, (page - 1) * LEADERBOARD_PAGE, LEADERBOARD_PAGE
+        )
+        if not rows:
+            return await event.reply("📊 No deals on this page yet.")
+        lines = [f"🏆 **Leaderboard — {LEADERBOARD_TITLES[period]}** (page {page})\n"]
+        for rank, row in enumerate(rows, (page - 1) * LEADERBOARD_PAGE + 1):
+            name = row.get("username") or row["user_id"]
+            lines.append(
+                f"{rank}. {name} — {row.get('deals', 0)} deals, "
+                f"₹{row.get('amount_inr', 0):g} / ${row.get('amount_usdt', 0):g}"
+            )
+        lines.append(f"\n🤝 Total: {deals} deals | ₹{inr:g} | ${usdt:g}")
+        await event.reply("\n".join(lines))
@@ -0,0 +1,146 @@
+import bisect
+import os
+import time
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING
+
+import database
+
+# ================== LEADERBOARD ==================
+#
+# One in-memory board per period ("all", and the current "day", "week",
+# "month"): a map of admin rows, a sorted index and running totals. Every
+# update_stats() call is applied to the live boards in O(log n) and
+# $inc'd into Mongo through the write-behind buffer:
+#
+#   all    -> stats_col (is_admin=True)       + leaderboard "all|0|*"
+#   period -> leaderboard "<period>|<start>|<user_id>" + "<period>|<start>|*"
+#
+# /leaderboard then reads a slice of the sorted index; Mongo is only read
+# when a board is first built or its LEADERBOARD_TTL runs out (picks up
+# other instances' updates).
+
+PERIODS = ("all", "day", "week", "month")
+LEADERBOARD_TTL = int(os.getenv("LEADERBOARD_TTL", "300"))
+
+board_col = database.db.leaderboard
+database.ensure_index(board_col, [("period", ASCENDING), ("start", ASCENDING), ("deals", DESCENDING)])
+database.ensure_index(database.stats_col, [("is_admin", ASCENDING), ("deals", DESCENDING)])
+
+
+def period_start(period, ts=None):
+    ts = time.time() if ts is None else ts
+    if period == "all":
+        return 0
+    if period == "day":
+        return int(ts // 86400 * 86400)
+    if period == "week":
+        # epoch day 0 was a Thursday; weeks start on Monday
+        return int((ts - 4 * 86400) // 604800 * 604800 + 4 * 86400)
+    if period == "month":
+        d = datetime.fromtimestamp(ts, timezone.utc)
+        return int(datetime(d.year, d.month, 1, tzinfo=timezone.utc).timestamp())
+    raise ValueError(f"unknown period {period!r}")
+
+
+def _sort_key(row):
+    return (-row.get("deals", 0), -row.get("amount_inr", 0), -row.get("amount_usdt", 0), row["user_id"])
+
+
+class Board:
+
+    def __init__(self, period, start, rows):
+        self.period = period
+        self.start = start
+        self.loaded_at = time.monotonic()
+        self.rows = {r["user_id"]: r for r in rows}
+        self.order = sorted(_sort_key(r) for r in rows)
+        self.totals = {
+            "deals": sum(r.get("deals", 0) for r in rows),
+            "amount_inr": sum(r.get("amount_inr", 0) for r in rows),
+            "amount_usdt": sum(r.get("amount_usdt", 0) for r in rows),
+        }
+
+    def apply(self, user_id, username, inc):
+        row = self.rows.get(user_id)
+        if row is None:
+            row = self.rows[user_id] = {"user_id": user_id, "deals": 0, "amount_inr": 0, "amount_usdt": 0}
+        else:
+            del self.order[bisect.bisect_left(self.order, _sort_key(row))]
+        for field, value in inc.items():
+            row[field] = row.get(field, 0) + value
+            self.totals[field] = self.totals.get(field, 0) + value
+        if username:
+            row["username"] = username
+        bisect.insort(self.order, _sort_key(row))
+
+    def page(self, offset=0, limit=10):
+        return [self.rows[key[-1]] for key in self.order[offset:offset + limit]]
+
+    def rank(self, user_id):
+        row = self.rows.get(user_id)
+        if row is None:
+            return None
+        return bisect.bisect_left(self.order, _sort_key(row)) + 1
+
+
+_boards = {}    # period -> Board (current start only)
+
+
+def _load_rows(period, start):
+    if period == "all":
+        cursor = database.stats_col.find({"is_admin": True}, {"counted": 0})
+    else:
+        cursor = board_col.find({"period": period, "start": start, "user_id": {"$ne": "*"}})
+    return [
+        {"user_id": str(d["user_id"]), "username": d.get("username", ""),
+         "deals": d.get("deals", 0), "amount_inr": d.get("amount_inr", 0),
+         "amount_usdt": d.get("amount_usdt", 0)}
+        for d in cursor
+    ]
+
+
+async def get_board(period="all"):
+    start = period_start(period)
+    board = _boards.get(period)
+    if board is None or board.start != start or time.monotonic() - board.loaded_at > LEADERBOARD_TTL:
+        await database.write_buffer.flush()
+        board = _boards[period] = Board(period, start, await database.db_call(_load_rows, period, start))
+    return board
+
+
+def _on_deal(user_id, amount, currency, is_admin, username, ts, deal_id=None):
+    """database.stats_listeners hook: runs once per update_stats()."""
+    if not is_admin:
+        return
+    user_id = str(user_id)
+    inc = {"deals": 1, f"amount_{currency}": amount}
+    for period in PERIODS:
+        start = period_start(period, ts)
+        if period != "all":
+            database.write_buffer.inc(
+                board_col,
+                {"_id": f"{period}|{start}|{user_id}"},
+                inc,
+                set={"username": username or ""},
+                set_on_insert={"period": period, "start": start, "user_id": user_id}
+            )
+        database.write_buffer.inc(
+            board_col,
+            {"_id": f"{period}|{start}|*"},
+            inc,
+            set_on_insert={"period": period, "start": start, "user_id": "*"}
+        )
+        board = _boards.get(period)
+        if board is not None and board.start == start:
+            board.apply(user_id, username, inc)
+
+
+database.stats_listeners.append(_on_deal)
+
+
+async def get_leaderboard(period="all", offset=0, limit=10):
+    """Returns (rows, total_deals, total_inr, total_usdt) for one page."""
+    board = await get_board(period)
+    t = board.totals
+    return board.page(offset, limit), t["deals"], t["amount_inr"], t["amount_usdt"]
@@ -0,0 +1,179 @@
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+import database
+
+# ================== DEAL LEASES ==================
+#
+# One record per form message, claimed atomically by /add. It replaces the
+# old in-process deal_locks dict, the processed check and the active_forms
+# insert with a single operation:
+#
+#   (none) --claim--> processing --activate--> active --bind--> active + escrow_id
+#                         |                      |                 --finish--> completed
+#                         |                      |                          \-> cancelled
+#                         +--release / expires_at+--release--> (none)
+#
+# Every claim gets its own owner token: activate (before the start message
+# is posted) and bind (once the deal is stored) only succeed for the /add
+# still holding the form, so a stale /add whose lease expired and was
+# claimed again cannot take it back. A processing lease expires after
+# LEASE_TTL seconds, so a worker that dies mid-/add does not lock the form
+# forever. activate drops the expiry: from then on a start message may be
+# out, and however late the deal gets stored and bound (FloodWait, a
+# handoff, a crash and replay) nobody else may post one for the form; only
+# its own /add or the pending deal's expiry releases it (a worker dying
+# right after activate leaves the form taken: start the deal on a new
+# form). completed / cancelled are terminal ("Already used").
+
+LEASE_TTL = int(os.getenv("LEASE_TTL", "120"))
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "mongo")
+# completed / cancelled leases are reaped by the same TTL index after this
+# many days (0 = keep forever; a reaped form could be /add-ed again)
+RETAIN_FORMS_DAYS = int(os.getenv("RETAIN_FORMS_DAYS", "0"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+DONE = ("completed", "cancelled")
+
+
+def lease_key(chat_id, form_id):
+    # message ids are only unique per chat
+    return f"{chat_id}:{form_id}"
+
+
+def new_owner():
+    return f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+
+
+class MongoLeases:
+    """Shared across bot workers via active_forms; safe to scale out."""
+
+    def __init__(self, col, ttl=LEASE_TTL):
+        self.col = col
+        self.ttl = ttl
+        # Mongo reaps expired leases not yet bound to a deal; bound ones
+        # carry no expires_at, finished ones only when RETAIN_FORMS_DAYS is set.
+        database.ensure_index(col, [("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def _claim(self, key, owner):
+        now = datetime.now(timezone.utc)
+        try:
+            self.col.update_one(
+                {"form_id": key, "status": "processing", "expires_at": {"$lt": now}},
+                {"$set": {
+                    "status": "processing",
+                    "owner": owner,
+                    "expires_at": now + timedelta(seconds=self.ttl)
+                }},
+                upsert=True
+            )
+            return owner, None
+        except DuplicateKeyError:
+            doc = self.col.find_one({"form_id": key}, {"status": 1})
+            return None, doc["status"] if doc else None
+
+    async def claim(self, chat_id, form_id):
+        """Returns (owner token or None, current_status)."""
+        await database.indexes_ready()  # the unique form_id index is the lock
+        return await database.db_call(self._claim, lease_key(chat_id, form_id), new_owner())
+
+    async def activate(self, chat_id, form_id, owner):
+        """processing -> active, if `owner` still holds the lease; it no
+        longer expires (see above)."""
+        res = await database.db_call(
+            self.col.update_one,
+            {"form_id": lease_key(chat_id, form_id), "status": "processing", "owner": owner,
+             "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"$set": {"status": "active"}, "$unset": {"expires_at": ""}}
+        )
+        return res.matched_count > 0
+
+    async def bind(self, chat_id, form_id, owner, escrow_id):
+        """Tie the active lease to its stored deal; True if it is (now) this
+        deal's. Repeating it for the same deal is fine (outbox replays)."""
+        res = await database.db_call(
+            self.col.update_one,
+            {"form_id": lease_key(chat_id, form_id), "status": "active", "$or": [
+                {"owner": owner, "escrow_id": None},
+                {"escrow_id": str(escrow_id)}
+            ]},
+            {"$set": {"escrow_id": str(escrow_id)}, "$unset": {"expires_at": ""}}
+        )
+        return res.matched_count > 0
+
+    async def finish(self, chat_id, form_id, status):
+        if RETAIN_FORMS_DAYS:
+            expiry = {"$set": {"status": status, "expires_at":
+                               datetime.now(timezone.utc) + timedelta(days=RETAIN_FORMS_DAYS)}}
+        else:
+            expiry = {"$set": {"status": status}, "$unset": {"expires_at": ""}}
+        await database.db_call(
+            self.col.update_one,
+            {"form_id": lease_key(chat_id, form_id)},
+            expiry
+        )
+
+    async def release(self, chat_id, form_id, owner, escrow_id=None):
+        """Free the form if `owner` holds it, unbound or bound to `escrow_id`."""
+        await database.db_call(
+            self.col.delete_one,
+            {"form_id": lease_key(chat_id, form_id), "status": {"$in": ["processing", "active"]},
+             "owner": owner, "escrow_id": {"$in": [None, escrow_id and str(escrow_id)]}}
+        )
+
+
+class MemoryLeases:
+    """Single-process stand-in with the same semantics and no round-trips."""
+
+    def __init__(self, ttl=LEASE_TTL):
+        self.ttl = ttl
+        self._leases = {}   # key -> [status, owner, expires_at | None, escrow_id]
+
+    def _held(self, chat_id, form_id, owner, escrow_id=None):
+        lease = self._leases.get(lease_key(chat_id, form_id))
+        if lease and lease[1] == owner and lease[3] in (None, escrow_id and str(escrow_id)) \
+                and lease[0] not in DONE:
+            return lease
+        return None
+
+    async def claim(self, chat_id, form_id):
+        key = lease_key(chat_id, form_id)
+        lease = self._leases.get(key)
+        if lease and not (lease[0] == "processing" and lease[2] < time.monotonic()):
+            return None, lease[0]
+        owner = new_owner()
+        self._leases[key] = ["processing", owner, time.monotonic() + self.ttl, None]
+        return owner, None
+
+    async def activate(self, chat_id, form_id, owner):
+        lease = self._held(chat_id, form_id, owner)
+        if lease and lease[0] == "processing" and lease[2] > time.monotonic():
+            lease[0], lease[2] = "active", None
+            return True
+        return False
+
+    async def bind(self, chat_id, form_id, owner, escrow_id):
+        lease = self._leases.get(lease_key(chat_id, form_id))
+        if lease and lease[0] == "active" and (
+                lease[1] == owner and lease[3] is None or lease[3] == str(escrow_id)):
+            lease[2], lease[3] = None, str(escrow_id)
+            return True
+        return False
+
+    async def finish(self, chat_id, form_id, status):
+        self._leases[lease_key(chat_id, form_id)] = [status, None, None, None]
+
+    async def release(self, chat_id, form_id, owner, escrow_id=None):
+        if self._held(chat_id, form_id, owner, escrow_id):
+            del self._leases[lease_key(chat_id, form_id)]
+
+
+if LEASE_BACKEND == "memory":
+    deal_leases = MemoryLeases()
+else:
+    deal_leases = MongoLeases(database.active_forms_col)
@@ -1,10 +1,20 @@
 import asyncio
 import logging
+import os
+import signal
 import sys
 
 from telethon import TelegramClient
 from config import API_ID, API_HASH, BOT_TOKEN
 from handlers import register_handlers
+from startup import warm_up
+from retention import retention_worker
+from sender import send_queue
+from shards import SHARD_HANDOFF_TIMEOUT, WORKER_NAME, shard_map, shard_worker
+from timers import timer_worker
+from workqueue import chat_queues
+import entities
+import metrics
 
 # ================= LOGGING =================
 
@@ -14,22 +24,22 @@ logging.basicConfig(
 )
 LOGGER = logging.getLogger(__name__)
 
-# ================= MONGODB INIT =================
+# ================= STORAGE INIT =================
 
 try:
-    import database  # importing = mongo connect + indexes
-    LOGGER.info("✅ MongoDB connected")
+    import database  # indexes and connection are deferred to warm_up()
+    LOGGER.info(f"✅ Storage backend: {database.STORAGE_BACKEND}")
 except Exception as e:
-    LOGGER.error(f"❌ MongoDB connection failed: {e}")
-    sys.exit("Fix MONGO_URI and restart bot")
+    LOGGER.error(f"❌ Storage init failed: {e}")
+    sys.exit("Fix STORAGE_BACKEND / MONGO_URI / SQLITE_PATH and restart bot")
 
 # ================= OPTIONAL MODULES =================
 
 # auto_kick (optional, safe)
 try:
-    from auto_kick import auto_kick_worker
+    import auto_kick  # registers the "kick" timer handler
 except Exception:
-    auto_kick_worker = None
+    auto_kick = None
     LOGGER.warning("⚠️ auto_kick.py not loaded (skipping)")
 
 # ❌ admin_logs intentionally DISABLED
@@ -39,7 +49,8 @@ send_log = None
 
 async def main():
     client = TelegramClient(
-        "bot_session",
+        # several workers (SHARD_SLOTS): one session each, same bot token
+        f"bot_session_{WORKER_NAME}" if shard_map.enabled else "bot_session",
         API_ID,
         API_HASH
     )
@@ -50,16 +61,57 @@ async def main():
     # Register handlers
     register_handlers(client)
 
-    # Background auto-kick task
-    if auto_kick_worker:
-        try:
-            asyncio.create_task(auto_kick_worker(client))
-            LOGGER.info("✅ Auto-kick worker started")
-        except Exception as e:
-            LOGGER.warning(f"Auto-kick start failed: {e}")
+    # Indexes in the background, running deals / auth groups / config
+    # into memory before the first event is served
+    try:
+        await warm_up()
+    except Exception as e:
+        LOGGER.error(f"❌ {database.STORAGE_BACKEND} storage unreachable: {e} (fix MONGO_URI and restart bot)")
+        raise
+
+    # Multi-worker mode: lease this worker's share of the chats (shards.py)
+    if shard_map.enabled:
+        await shard_map.start()
+        asyncio.create_task(shard_worker())
+
+    # Prometheus-style metrics endpoint (METRICS_PORT)
+    if metrics.METRICS_PORT:
+        await metrics.serve()
+
+    # Multi-instance config cache invalidation (needs a replica set)
+    if os.getenv("CONFIG_WATCH"):
+        asyncio.create_task(database.watch_config_changes())
+        LOGGER.info("✅ Config change stream started")
+
+    # Deferred actions: auto-kick, message cleanup ... (timers.py)
+    asyncio.create_task(timer_worker(client))
+    LOGGER.info("✅ Timer worker started")
+
+    # Bulk refresh of cached Telegram users (entities.py)
+    asyncio.create_task(entities.entity_refresh_worker(client))
+
+    # TTL indexes, report compaction and storage sizes (retention.py)
+    asyncio.create_task(retention_worker())
+    LOGGER.info("✅ Retention worker started")
+
+    # Heroku / Docker stop with SIGTERM: disconnect so the shutdown
+    # flushes below run instead of the process dying mid-buffer
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, lambda: asyncio.ensure_future(client.disconnect())
+    )
 
     # Run forever
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        if shard_map.enabled:
+            await shard_map.stop()   # other workers take our chats over right away
+        else:
+            # handlers, outbox effects and due timers still running
+            await chat_queues.wait_idle(lambda chat_id: True, SHARD_HANDOFF_TIMEOUT)
+        await send_queue.drain()
+        await database.write_buffer.close()
+        await database.release_deal_ids()
 
 # ================= ENTRY =================
 
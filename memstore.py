@@ -0,0 +1,676 @@
+import copy
+import ipaddress
+import os
+import socket
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+# ================== IN-MEMORY MONGO STAND-IN ==================
+#
+# Implements the slice of the pymongo API this bot uses, so the handlers,
+# benchmarks and small deployments can run with no Mongo server at all
+# (STORAGE_BACKEND=memory or MONGO_URI=memory://). Thread-safe: database.db_call() runs it on the
+# executor just like pymongo.
+
+
+class _Result:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+# ---------- query matching ----------
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def _cmp(a, b, op):
+    try:
+        return op(a, b)
+    except TypeError:
+        return False
+
+
+_OPS = {
+    "$gt": lambda a, b: _cmp(a, b, lambda x, y: x > y),
+    "$gte": lambda a, b: _cmp(a, b, lambda x, y: x >= y),
+    "$lt": lambda a, b: _cmp(a, b, lambda x, y: x < y),
+    "$lte": lambda a, b: _cmp(a, b, lambda x, y: x <= y),
+    "$ne": lambda a, b: b not in a if isinstance(a, list) else a != b,  # arrays: no element equals
+    "$in": lambda a, b: a in b,
+    "$nin": lambda a, b: a not in b,
+}
+
+
+def _match_value(value, present, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+        for op, arg in cond.items():
+            if op == "$exists":
+                if bool(arg) != present:
+                    return False
+            elif not present and op not in ("$ne", "$nin", "$in"):     # a missing field is null
+                return False
+            elif not _OPS[op](value, arg):
+                return False
+        return True
+    return present and (value == cond or isinstance(value, list) and cond in value) or (cond is None and not present)
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+        else:
+            value, present = _get(doc, key)
+            if not _match_value(value, present, cond):
+                return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k for k, v in projection.items() if v}
+    if include:
+        out = {k: copy.deepcopy(doc[k]) for k in include if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    return {k: copy.deepcopy(v) for k, v in doc.items() if k not in projection}
+
+
+# ---------- updates ----------
+
+def _parent(doc, path, create=True):
+    # "a.b.c" -> (doc["a"]["b"], "c"); missing parents are created for writes
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            if not create:
+                return None, parts[-1]
+            child = doc[part] = {}
+        doc = child
+    return doc, parts[-1]
+
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == "$set" or (op == "$setOnInsert" and inserting):
+            for k, v in fields.items():
+                parent, key = _parent(doc, k)
+                parent[key] = copy.deepcopy(v)
+        elif op == "$inc":
+            for k, v in fields.items():
+                parent, key = _parent(doc, k)
+                parent[key] = parent.get(key, 0) + v
+        elif op == "$unset":
+            for k in fields:
+                parent, key = _parent(doc, k, create=False)
+                if parent is not None:
+                    parent.pop(key, None)
+        elif op == "$max":
+            for k, v in fields.items():
+                parent, key = _parent(doc, k)
+                if key not in parent or v > parent[key]:
+                    parent[key] = v
+        elif op == "$min":
+            for k, v in fields.items():
+                parent, key = _parent(doc, k)
+                if key not in parent or v < parent[key]:
+                    parent[key] = v
+        elif op == "$push":
+            for k, v in fields.items():
+                parent, key = _parent(doc, k)
+                items = parent.setdefault(key, [])
+                if isinstance(v, dict) and "$each" in v:
+                    items.extend(copy.deepcopy(v["$each"]))
+                    if "$slice" in v:
+                        parent[key] = items[v["$slice"]:] if v["$slice"] < 0 else items[:v["$slice"]]
+                else:
+                    items.append(copy.deepcopy(v))
+        elif op != "$setOnInsert":
+            raise OperationFailure(f"memstore: unsupported update operator {op}")
+
+
+def _seed_from_filter(query):
+    doc = {}
+    for k, v in query.items():
+        if k.startswith("$"):
+            continue
+        if isinstance(v, dict) and any(op.startswith("$") for op in v):
+            continue
+        doc[k] = copy.deepcopy(v)
+    return doc
+
+
+# ---------- aggregation (just what rebuild_rollups needs) ----------
+
+def _eval(expr, doc):
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get(doc, expr[1:])[0]
+    if isinstance(expr, dict):
+        if len(expr) == 1:
+            op, args = next(iter(expr.items()))
+            if op.startswith("$"):
+                vals = [_eval(a, doc) for a in args] if isinstance(args, list) else None
+                if op == "$subtract":
+                    return vals[0] - vals[1]
+                if op == "$mod":
+                    return vals[0] % vals[1]
+                if op == "$eq":
+                    return vals[0] == vals[1]
+                if op == "$cond":
+                    return vals[1] if vals[0] else vals[2]
+                raise OperationFailure(f"memstore: unsupported expression {op}")
+        return {k: _eval(v, doc) for k, v in expr.items()}
+    return expr
+
+
+def _aggregate(docs, pipeline):
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [d for d in docs if matches(d, spec)]
+        elif name == "$group":
+            groups = {}
+            for d in docs:
+                key = _eval(spec["_id"], d)
+                hkey = repr(key)
+                out = groups.setdefault(hkey, {"_id": key})
+                for field, acc in spec.items():
+                    if field == "_id":
+                        continue
+                    (op, arg), = acc.items()
+                    if op != "$sum":
+                        raise OperationFailure(f"memstore: unsupported accumulator {op}")
+                    out[field] = out.get(field, 0) + _eval(arg, d)
+            docs = list(groups.values())
+        elif name == "$sort":
+            for field, direction in reversed(list(spec.items())):
+                docs.sort(key=lambda d: _get(d, field)[0], reverse=direction < 0)
+        elif name == "$limit":
+            docs = docs[:spec]
+        else:
+            raise OperationFailure(f"memstore: unsupported stage {name}")
+    return docs
+
+
+# ---------- collection ----------
+
+class Cursor:
+
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, d in reversed(keys):
+            self._docs.sort(key=lambda doc: (_get(doc, field)[0] is not None, _get(doc, field)[0]),
+                            reverse=d < 0)
+        return self
+
+    def limit(self, n):
+        if n:
+            self._docs = self._docs[:n]
+        return self
+
+    def skip(self, n):
+        self._docs = self._docs[n:]
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class Collection:
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = {}         # _id -> doc (insertion ordered)
+        self._unique = {}       # field -> {value: _id}
+        self._lock = database._lock
+
+    # ----- storage hooks (sqlitestore.py persists through these) -----
+
+    def _writing(self):
+        """Held around every write operation."""
+        return self._lock
+
+    def _put(self, doc):
+        self._docs[doc["_id"]] = doc
+
+    def _drop_doc(self, _id):
+        del self._docs[_id]
+
+    # ----- indexes -----
+
+    def create_index(self, keys, unique=False, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        if unique and len(keys) == 1:
+            field = keys[0][0]
+            with self._lock:
+                self._unique[field] = {
+                    d[field]: _id for _id, d in self._docs.items() if field in d
+                }
+        return "_".join(f"{k}_{v}" for k, v in keys)
+
+    def _check_unique(self, doc, own_id=None):
+        for field, index in self._unique.items():
+            if field in doc:
+                holder = index.get(doc[field])
+                if holder is not None and holder != own_id:
+                    raise DuplicateKeyError(f"E11000 duplicate key {self.name}.{field}: {doc[field]!r}")
+
+    def _index(self, doc):
+        for field, index in self._unique.items():
+            if field in doc:
+                index[doc[field]] = doc["_id"]
+
+    def _unindex(self, doc):
+        for field, index in self._unique.items():
+            if field in doc and index.get(doc[field]) == doc["_id"]:
+                del index[doc[field]]
+
+    # ----- reads -----
+
+    def _candidates(self, query):
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self._docs.get(query["_id"])
+            return [doc] if doc is not None else []
+        for field, index in self._unique.items():
+            if field in query and not isinstance(query[field], dict):
+                _id = index.get(query[field])
+                return [self._docs[_id]] if _id is not None else []
+        return list(self._docs.values())
+
+    def _find(self, query):
+        query = query or {}
+        return [d for d in self._candidates(query) if matches(d, query)]
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        with self._lock:
+            for doc in self._find(filter):
+                return _project(doc, projection)
+        return None
+
+    def find(self, filter=None, projection=None, **kwargs):
+        with self._lock:
+            return Cursor([_project(d, projection) for d in self._find(filter)])
+
+    def count_documents(self, filter=None, **kwargs):
+        with self._lock:
+            return len(self._find(filter))
+
+    def estimated_document_count(self):
+        return len(self._docs)
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._lock:
+            docs = [copy.deepcopy(d) for d in self._docs.values()]
+        return iter(_aggregate(docs, pipeline))
+
+    # ----- writes -----
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key {self.name}._id: {doc['_id']!r}")
+        self._check_unique(doc)
+        self._put(doc)
+        self._index(doc)
+        return doc
+
+    def insert_one(self, document, **kwargs):
+        with self._writing():
+            doc = self._insert(document)
+        document.setdefault("_id", doc["_id"])
+        return _Result(inserted_id=doc["_id"], acknowledged=True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        ids = []
+        with self._writing():
+            for document in documents:
+                try:
+                    doc = self._insert(document)
+                except DuplicateKeyError:
+                    if ordered:
+                        raise
+                    continue
+                document.setdefault("_id", doc["_id"])
+                ids.append(doc["_id"])
+        return _Result(inserted_ids=ids, acknowledged=True)
+
+    def _update(self, filter, update, upsert, many, replace=False):
+        matched = self._find(filter)
+        if not many:
+            matched = matched[:1]
+        if matched:
+            for doc in matched:
+                new = copy.deepcopy(doc)
+                if replace:
+                    new = {**copy.deepcopy(update), "_id": doc["_id"]}
+                else:
+                    _apply_update(new, update)
+                self._check_unique(new, own_id=doc["_id"])
+                self._unindex(doc)
+                self._put(new)
+                self._index(new)
+            return _Result(matched_count=len(matched), modified_count=len(matched),
+                           upserted_id=None, acknowledged=True), matched[0]["_id"]
+        if not upsert:
+            return _Result(matched_count=0, modified_count=0, upserted_id=None, acknowledged=True), None
+        doc = _seed_from_filter(filter or {})
+        if replace:
+            doc.update(copy.deepcopy(update))
+        else:
+            _apply_update(doc, update, inserting=True)
+        doc = self._insert(doc)
+        return _Result(matched_count=0, modified_count=0, upserted_id=doc["_id"], acknowledged=True), doc["_id"]
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self._writing():
+            return self._update(filter, update, upsert, many=False)[0]
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self._writing():
+            return self._update(filter, update, upsert, many=True)[0]
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self._writing():
+            return self._update(filter, replacement, upsert, many=False, replace=True)[0]
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False,
+                            return_document=False, **kwargs):
+        with self._writing():
+            before = self._find(filter)[:1]
+            before = copy.deepcopy(before[0]) if before else None
+            _, _id = self._update(filter, update, upsert, many=False)
+            if return_document:
+                after = self._docs.get(_id) if _id is not None else None
+                return _project(after, projection) if after else None
+            return _project(before, projection) if before else None
+
+    def find_one_and_delete(self, filter, projection=None, **kwargs):
+        with self._writing():
+            found = self._find(filter)[:1]
+            if not found:
+                return None
+            self._unindex(found[0])
+            self._drop_doc(found[0]["_id"])
+            return _project(found[0], projection)
+
+    def _delete(self, filter, many):
+        matched = self._find(filter)
+        if not many:
+            matched = matched[:1]
+        for doc in matched:
+            self._unindex(doc)
+            self._drop_doc(doc["_id"])
+        return _Result(deleted_count=len(matched), acknowledged=True)
+
+    def delete_one(self, filter, **kwargs):
+        with self._writing():
+            return self._delete(filter, many=False)
+
+    def delete_many(self, filter, **kwargs):
+        with self._writing():
+            return self._delete(filter, many=True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        counts = dict(inserted_count=0, matched_count=0, modified_count=0,
+                      deleted_count=0, upserted_count=0)
+        with self._writing():
+            for op in requests:
+                try:
+                    if isinstance(op, InsertOne):
+                        self._insert(op._doc)
+                        counts["inserted_count"] += 1
+                    elif isinstance(op, (UpdateOne, UpdateMany, ReplaceOne)):
+                        res, _ = self._update(
+                            op._filter, op._doc, op._upsert,
+                            many=isinstance(op, UpdateMany),
+                            replace=isinstance(op, ReplaceOne)
+                        )
+                        counts["matched_count"] += res.matched_count
+                        counts["modified_count"] += res.modified_count
+                        counts["upserted_count"] += res.upserted_id is not None
+                    elif isinstance(op, (DeleteOne, DeleteMany)):
+                        res = self._delete(op._filter, many=isinstance(op, DeleteMany))
+                        counts["deleted_count"] += res.deleted_count
+                except DuplicateKeyError:
+                    if ordered:
+                        raise
+        return _Result(acknowledged=True, **counts)
+
+    def drop(self):
+        with self._writing():
+            for _id in list(self._docs):
+                self._drop_doc(_id)
+            for index in self._unique.values():
+                index.clear()
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("memstore: change streams are not supported")
+
+
+class Database:
+    collection_class = Collection
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            col = self._collections.get(name)
+            if col is None:
+                col = self._collections[name] = self.collection_class(self, name)
+            return col
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def create_collection(self, name, **kwargs):
+        return self[name]
+
+    def command(self, name, *args, **kwargs):
+        if name == "collstats" and args:
+            col = self[args[0]]
+            return {"count": len(col._docs), "size": sum(len(repr(d)) for d in col._docs.values()),
+                    "storageSize": 0, "totalIndexSize": 0}
+        if name == "ping":
+            return {"ok": 1}
+        raise OperationFailure(f"memstore: unsupported command {name}")
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("memstore: change streams are not supported")
+
+
+class MemoryClient:
+    """Drop-in for pymongo.MongoClient backed by process memory."""
+    database_class = Database
+
+    def __init__(self, uri=None, **kwargs):
+        self._dbs = {}
+
+    def __getitem__(self, name):
+        db = self._dbs.get(name)
+        if db is None:
+            db = self._dbs[name] = self.database_class(name)
+        return db
+
+    def close(self):
+        pass
+
+
+# ================== SHARED STORE ==================
+#
+# One memstore shared by several processes (the multi-worker harness in
+# bench.py): serve() answers collection calls over a local socket, and
+# MONGO_URI=memory://host:port makes database.py use a RemoteClient that
+# forwards every call there. Each call runs under the served database's
+# lock, so find_one_and_update & co. stay atomic across processes.
+#
+# Bench only: connections carry pickles, so both ends stay on loopback
+# and share the key in MEMSTORE_AUTHKEY (there is no default).
+
+_ERRORS = {"DuplicateKeyError": DuplicateKeyError, "OperationFailure": OperationFailure}
+
+
+def _authkey():
+    key = os.getenv("MEMSTORE_AUTHKEY")
+    if not key:
+        raise RuntimeError("❌ MEMSTORE_AUTHKEY not set")
+    return key.encode()
+
+
+def _loopback(address):
+    host = address[0]
+    if not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+        raise RuntimeError(f"❌ memstore only serves on loopback, not {host}")
+    return address
+
+
+def serve(address=("127.0.0.1", 0), client=None):
+    """Serve `client` (a new MemoryClient by default) from background
+    threads; returns (client, (host, port))."""
+    client = client or MemoryClient()
+    # every executor thread of every worker connects: the default backlog
+    # of 1 leaves connections hanging in the handshake under a burst
+    listener = Listener(_loopback(address), backlog=128, authkey=_authkey())
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    db, col, method, args, kwargs = conn.recv()
+                except (EOFError, OSError):     # the worker went away
+                    return
+                try:
+                    if method.startswith("_"):
+                        raise OperationFailure(f"memstore: no remote {method}")
+                    target = client[db] if col is None else client[db][col]
+                    result = getattr(target, method)(*args, **kwargs)
+                    if isinstance(result, Cursor):
+                        result = result._docs
+                    elif method == "aggregate":
+                        result = list(result)
+                    conn.send((True, result))
+                except Exception as e:
+                    conn.send((False, (type(e).__name__, str(e))))
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, OSError, AuthenticationError):    # died mid-handshake
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return client, listener.address
+
+
+def _forward(method):
+    def call(self, *args, **kwargs):
+        return self._call(method, args, kwargs)
+    call.__name__ = method
+    return call
+
+
+class RemoteCollection:
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def _call(self, method, args, kwargs):
+        return self.database.client._call(self.database.name, self.name, method, args, kwargs)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        return Cursor(self._call("find", (filter, projection), kwargs))
+
+    def aggregate(self, pipeline, **kwargs):
+        return iter(self._call("aggregate", (pipeline,), kwargs))
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("memstore: change streams are not supported")
+
+
+for _method in ("create_index", "find_one", "count_documents", "estimated_document_count",
+                "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+                "find_one_and_update", "find_one_and_delete", "delete_one", "delete_many",
+                "bulk_write", "drop"):
+    setattr(RemoteCollection, _method, _forward(_method))
+
+
+class RemoteDatabase:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return RemoteCollection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return self.client._call(self.name, None, "list_collection_names", (), {})
+
+    def command(self, name, *args, **kwargs):
+        return self.client._call(self.name, None, "command", (name, *args), kwargs)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("memstore: change streams are not supported")
+
+
+class RemoteClient:
+    """MongoClient stand-in for a memstore served by serve() elsewhere."""
+
+    def __init__(self, uri, **kwargs):
+        host, port = uri[len("memory://"):].rstrip("/").rsplit(":", 1)
+        self._address = _loopback((host, int(port)))
+        self._authkey = _authkey()
+        self._local = threading.local()     # one connection per thread
+
+    def _call(self, db, col, method, args, kwargs):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self._address, authkey=self._authkey)
+        conn.send((db, col, method, args, kwargs))
+        ok, result = conn.recv()
+        if not ok:
+            raise _ERRORS.get(result[0], OperationFailure)(result[1])
+        return result
+
+    def __getitem__(self, name):
+        return RemoteDatabase(self, name)
+
+    def close(self):
+        pass
@@ -0,0 +1,182 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== METRICS ==================
+#
+# Tiny in-process Prometheus-style registry: counters, histograms and
+# callback gauges, served as text on METRICS_PORT (disabled when unset).
+# Calls slower than SLOW_CALL_MS are logged with their labels.
+
+PREFIX = "escrow_"
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+SLOW_CALL_MS = float(os.getenv("SLOW_CALL_MS", "0"))
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bucket bound holding the q-th observation (rough p50/p99)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+_counters = {}      # (name, labels) -> float
+_histograms = {}    # (name, labels) -> Histogram
+_gauges = {}        # name -> fn() -> {labels: value} | value
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = Histogram()
+    hist.observe(seconds)
+    if SLOW_CALL_MS and seconds * 1000 >= SLOW_CALL_MS:
+        LOGGER.warning(f"Slow {name} {labels}: {seconds * 1000:.0f}ms")
+
+
+def gauge(name, fn):
+    """Register a callback evaluated at scrape time."""
+    _gauges[name] = fn
+
+
+def histogram(name, **labels):
+    return _histograms.get(_key(name, labels))
+
+
+def counts(name):
+    """{labels: observation count} for one histogram name."""
+    return {labels: h.count for (n, labels), h in _histograms.items() if n == name}
+
+
+@asynccontextmanager
+async def timer(name, **labels):
+    """Time the block into `name`, labelled with outcome=ok|error."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe(name, time.perf_counter() - started, outcome=outcome, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of timer() for coroutine functions."""
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            async with timer(name, **labels):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+# ================== EXPOSITION ==================
+
+def _fmt_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render():
+    lines = []
+    typed = set()
+
+    for (name, labels), value in sorted(_counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            typed.add(name)
+        lines.append(f"{PREFIX}{name}{_fmt_labels(labels)} {value}")
+
+    for (name, labels), hist in sorted(_histograms.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), hist.counts):
+            cumulative += count
+            lines.append(f"{PREFIX}{name}_bucket{_fmt_labels(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{_fmt_labels(labels)} {hist.sum}")
+        lines.append(f"{PREFIX}{name}_count{_fmt_labels(labels)} {hist.count}")
+
+    for name, fn in sorted(_gauges.items()):
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        try:
+            value = fn()
+        except Exception as e:
+            LOGGER.debug(f"Gauge {name} failed: {e!r}")
+            continue
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                lines.append(f"{PREFIX}{name}{_fmt_labels(labels)} {v}")
+        else:
+            lines.append(f"{PREFIX}{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port=METRICS_PORT, host=METRICS_HOST):
+    server = await asyncio.start_server(_handle, host, int(port))
+    LOGGER.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,400 @@
+"""Bulk import / export of the legacy database.json format.
+
+Reads the file incrementally (one deal / limit / report row at a time, so
+multi-GB dumps never have to fit in memory), validates every row and
+upserts them in bulk_write batches into the configured storage backend.
+A checkpoint next to the input file lets an interrupted import resume;
+all writes are idempotent upserts, so replaying a batch is harmless.
+
+    python migrate.py import database.json
+    python migrate.py import dump.json --batch 5000 --restart
+    python migrate.py export backup.json
+
+Run it against the same STORAGE_BACKEND / MONGO_URI as the bot. With the
+sqlite backend, stop the bot first (it keeps the data in memory).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pymongo import ReplaceOne, UpdateOne
+
+import database
+
+BATCH = 1000
+CHUNK = 1 << 16
+
+
+# ================== STREAMING JSON READER ==================
+
+class JsonStream:
+    """Walks a JSON document without loading it: the top-level object's
+    keys, and the entries of selected object / array values one by one."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of JSON input")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"expected {char!r} at offset {self.pos}, got {self.buf[self.pos]!r}")
+        self.pos += 1
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number cut at the chunk edge still decodes ("12" of "123")
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _items(self, close, keyed):
+        first = True
+        while True:
+            if self._peek() == close:
+                self.pos += 1
+                return
+            if not first:
+                self._expect(",")
+            first = False
+            if keyed:
+                key = self.value()
+                self._expect(":")
+                yield key
+            else:
+                yield None
+
+    def object_keys(self):
+        """Yields each key; the caller must consume its value."""
+        self._expect("{")
+        yield from self._items("}", keyed=True)
+
+    def entries(self):
+        """(key, value) of an object or (index, value) of an array."""
+        opener = self._peek()
+        if opener not in "{[":
+            raise ValueError(f"expected an object or array at offset {self.pos}")
+        self.pos += 1
+        for i, key in enumerate(self._items("}" if opener == "{" else "]", keyed=opener == "{")):
+            yield (i if key is None else key), self.value()
+
+
+# ================== ROW CONVERTERS ==================
+#
+# legacy section -> fn(key, value) -> (collection, write op); raise
+# ValueError / KeyError / TypeError to reject a row.
+
+def _number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _currency(value):
+    cur = str(value).lower()
+    if cur not in ("inr", "usdt"):
+        raise ValueError(f"bad currency {value!r}")
+    return cur
+
+
+def _deal(key, v):
+    doc = dict(v)
+    doc.update({
+        "_id": str(int(key)),
+        "admin_id": int(v["admin_id"]),
+        "amount": _number(v["amount"]),
+        "currency": _currency(v["currency"]),
+        "deal_id": str(v["deal_id"]),
+        # pre-Mongo deals carry no group / form, so they are history only,
+        # whatever their legacy status: an open one could never be closed
+        # and would hold its admin's limit forever
+        "status": v.get("status", "archived") if v.get("group_id") and v.get("form_id") else "archived",
+    })
+    return database.deals_col, ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+
+def _limit(key, v):
+    return database.limits_col, UpdateOne({"user_id": str(int(key))}, {"$set": {
+        "inr": int(v.get("inr", 0)),
+        "usdt": int(v.get("usdt", 0)),
+        "is_mod": bool(v.get("is_mod", False)),
+        "is_mmod": bool(v.get("is_mmod", False)),
+    }}, upsert=True)
+
+
+def _stats(is_admin):
+    def convert(key, v):
+        return database.stats_col, UpdateOne({"user_id": str(int(key)), "is_admin": is_admin}, {"$set": {
+            "deals": int(v.get("deals", 0)),
+            "amount_inr": float(v.get("amount_inr", 0)),
+            "amount_usdt": float(v.get("amount_usdt", 0)),
+            "username": str(v.get("username") or ""),
+        }}, upsert=True)
+    return convert
+
+
+def _report(_, v):
+    doc = {
+        "time": float(v["time"]),
+        "amount": float(v["amount"]),
+        "currency": _currency(v["currency"]),
+        "group_id": v.get("group_id"),
+        "admin_id": v.get("admin_id"),
+    }
+    # content-addressed, so re-importing a dump does not double-count
+    doc["_id"] = "imp:" + hashlib.sha1(json.dumps(doc, sort_keys=True).encode()).hexdigest()[:24]
+    return database.reports_col, ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+
+def _processed(key, v):
+    return database.processed_col, UpdateOne(
+        {"msg_id": str(key)},
+        {"$set": {"status": str(v)}, "$setOnInsert": {"at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+def _tipped(key, v):
+    return database.tipped_col, UpdateOne({"_id": str(key)}, {"$set": {"user_id": str(v)}}, upsert=True)
+
+
+def _chat_form(key, v):
+    message, entities = (v, []) if isinstance(v, str) else (v["message"], v.get("entities", []))
+    return database.forms_col, UpdateOne(
+        {"chat_id": str(key)}, {"$set": {"message": str(message), "entities": list(entities)}}, upsert=True
+    )
+
+
+SECTIONS = {
+    "deals": _deal,
+    "limits": _limit,
+    "admin_stats": _stats(True),
+    "user_stats": _stats(False),
+    "report_history": _report,
+    "processed_messages": _processed,
+    "tipped_messages": _tipped,
+    "chat_forms": _chat_form,
+}
+META_FIELDS = ("deal_count_inr", "deal_count_usdt", "form_message", "form_entities")
+
+
+# ================== IMPORT ==================
+
+class Importer:
+
+    def __init__(self, path, batch, restart=False):
+        self.path = path
+        self.batch = batch
+        self.state_path = f"{path}.import-state"
+        self.state = {"done": [], "section": None, "offset": 0}
+        if not restart and os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+            print(f"resuming: {len(self.state['done'])} sections done, "
+                  f"{self.state['section'] or '-'} at row {self.state['offset']}")
+        self.ops = {}           # collection name -> [collection, [ops]]
+        self.pending = 0
+        self.counts = {}        # section -> [written, rejected]
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.last_report = self.started
+
+    def _checkpoint(self, section, offset):
+        self.state.update(section=section, offset=offset)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def _flush(self, section, offset):
+        for col, ops in self.ops.values():
+            col.bulk_write(ops, ordered=False)
+        self.ops, self.pending = {}, 0
+        self._checkpoint(section, offset)
+        now = time.perf_counter()
+        if now - self.last_report >= 2:
+            self.last_report = now
+            print(f"  {section}: {offset} rows, {self.rows / (now - self.started):.0f} rows/s overall")
+
+    def _add(self, col, op):
+        self.ops.setdefault(col.name, [col, []])[1].append(op)
+        self.pending += 1
+
+    def _section(self, name, entries):
+        convert = SECTIONS[name]
+        skip = self.state["offset"] if self.state["section"] == name else 0
+        counts = self.counts.setdefault(name, [0, 0])
+        offset = 0
+        for key, value in entries:
+            offset += 1
+            if offset <= skip:
+                continue
+            try:
+                col, op = convert(key, value)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                counts[1] += 1
+                print(f"  rejected {name}[{key!r}]: {e!r}", file=sys.stderr)
+                continue
+            self._add(col, op)
+            counts[0] += 1
+            self.rows += 1
+            if self.pending >= self.batch:
+                self._flush(name, offset)
+        self._flush(name, offset)
+        self.state["done"].append(name)
+        self._checkpoint(None, 0)
+
+    def _meta(self, fields):
+        update = {}
+        for cur in ("inr", "usdt"):
+            if f"deal_count_{cur}" in fields:
+                count = int(fields[f"deal_count_{cur}"])
+                # never move a live counter backwards
+                update.setdefault("$max", {})[f"deal_count_{cur}"] = count
+                database.counters_col.update_one({"_id": f"deal_{cur}"}, {"$max": {"seq": count}})
+        if "form_message" in fields:
+            update.setdefault("$set", {})["form_message"] = str(fields["form_message"])
+        if "form_entities" in fields:
+            update.setdefault("$set", {})["form_entities"] = list(fields["form_entities"])
+        if update:
+            database.meta.update_one({"_id": "global"}, update, upsert=True)
+
+    def run(self):
+        meta_fields = {}
+        with open(self.path, encoding="utf-8") as f:
+            stream = JsonStream(f)
+            for key in stream.object_keys():
+                if key in SECTIONS and key not in self.state["done"]:
+                    self._section(key, stream.entries())
+                elif key in META_FIELDS:
+                    meta_fields[key] = stream.value()
+                elif key in SECTIONS:
+                    for _ in stream.entries():   # finished before the interruption
+                        pass
+                else:
+                    value = stream.value()   # consumed, not imported
+                    if key not in SECTIONS and value:
+                        print(f"  skipped unsupported section {key!r}")
+        self._meta(meta_fields)
+
+        if self.counts.get("report_history", [0])[0]:
+            print(f"  rebuilt {asyncio.run(database.rebuild_rollups())} report buckets")
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+        wall = time.perf_counter() - self.started
+        for name, (written, rejected) in self.counts.items():
+            print(f"{name:<20} {written:>9} rows  {rejected:>6} rejected")
+        print(f"imported {self.rows} rows in {wall:.2f}s ({self.rows / wall if wall else 0:.0f} rows/s)")
+
+
+# ================== EXPORT ==================
+
+def _export_entries(out, name, items, keyed=True):
+    out.write(f",\n    {json.dumps(name)}: " + ("{" if keyed else "["))
+    count = 0
+    for key, value in items:
+        out.write("," if count else "")
+        out.write("\n        ")
+        if keyed:
+            out.write(f"{json.dumps(str(key))}: ")
+        out.write(json.dumps(value, ensure_ascii=False, default=str))
+        count += 1
+    out.write(("\n    " if count else "") + ("}" if keyed else "]"))
+    return count
+
+
+def export(path):
+    started = time.perf_counter()
+    g = database.meta.find_one({"_id": "global"}) or {}
+    counts = {}
+    for cur in ("inr", "usdt"):
+        counter = database.counters_col.find_one({"_id": f"deal_{cur}"}) or {}
+        counts[cur] = max(int(g.get(f"deal_count_{cur}", 0)), int(counter.get("seq", 0)))
+
+    def without(doc, *fields):
+        return {k: v for k, v in doc.items() if k not in fields}
+
+    tmp = path + ".tmp"
+    rows = 0
+    with open(tmp, "w", encoding="utf-8") as out:
+        out.write("{\n    " + ",\n    ".join(f"{json.dumps(k)}: {json.dumps(v, ensure_ascii=False)}" for k, v in (
+            ("deal_count_inr", counts["inr"]),
+            ("deal_count_usdt", counts["usdt"]),
+            ("form_message", g.get("form_message", database.DEFAULT_FORM)),
+            ("form_entities", g.get("form_entities", [])),
+        )))
+        rows += _export_entries(out, "deals", ((d["_id"], without(d, "_id")) for d in database.deals_col.find({})))
+        rows += _export_entries(out, "limits", ((d["user_id"], without(d, "_id", "user_id"))
+                                                for d in database.limits_col.find({})))
+        for name, is_admin in (("admin_stats", True), ("user_stats", False)):
+            rows += _export_entries(out, name, ((d["user_id"], without(d, "_id", "user_id", "is_admin"))
+                                                for d in database.stats_col.find({"is_admin": is_admin}, {"counted": 0})))
+        rows += _export_entries(out, "report_history", ((None, without(d, "_id"))
+                                                        for d in database.reports_col.find({}).sort("time", 1)),
+                                keyed=False)
+        rows += _export_entries(out, "processed_messages", ((d["msg_id"], d.get("status"))
+                                                            for d in database.processed_col.find({})))
+        rows += _export_entries(out, "tipped_messages", ((d["_id"], d.get("user_id"))
+                                                         for d in database.tipped_col.find({})))
+        rows += _export_entries(out, "chat_forms", ((d["chat_id"], without(d, "_id", "chat_id"))
+                                                    for d in database.forms_col.find({})))
+        out.write("\n}\n")
+    os.replace(tmp, path)
+    wall = time.perf_counter() - started
+    print(f"exported {rows} rows to {path} in {wall:.2f}s ({rows / wall if wall else 0:.0f} rows/s)")
+
+
+# ================== CLI ==================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="upsert a database.json-format dump")
+    imp.add_argument("path")
+    imp.add_argument("--batch", type=int, default=BATCH, help="ops per bulk_write")
+    imp.add_argument("--restart", action="store_true", help="ignore a saved checkpoint")
+    exp = sub.add_parser("export", help="write the database in database.json format")
+    exp.add_argument("path")
+    args = parser.parse_args(argv)
+
+    asyncio.run(database.indexes_ready())
+    if args.command == "import":
+        Importer(args.path, args.batch, args.restart).run()
+    else:
+        export(args.path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+import database
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== RETENTION ==================
+#
+#   processed  -> TTL index on "at" (RETAIN_PROCESSED_DAYS)
+#   logs       -> TTL index on "at" (RETAIN_LOGS_DAYS)
+#   reports    -> raw rows older than RETAIN_REPORTS_DAYS are rolled into
+#                 the hourly / daily rollup buckets, then deleted
+#   active_forms -> finished leases expire via leases.RETAIN_FORMS_DAYS
+#
+# Legacy docs written before "at" existed get it stamped on the first
+# pass, so they expire one retention period later. 0 disables a rule.
+# retention_worker() runs a pass every RETENTION_INTERVAL seconds and
+# records per-collection storage sizes (/storage, collection_bytes gauge).
+#
+# memstore and sqlitestore accept TTL indexes but never expire anything:
+# on those backends ttl_sweep() deletes what a TTL index (these rules and
+# every database.ensure_index(..., expireAfterSeconds=...)) would have,
+# every TTL_SWEEP_INTERVAL seconds.
+
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", str(6 * 3600)))
+RETAIN_PROCESSED_DAYS = int(os.getenv("RETAIN_PROCESSED_DAYS", "30"))
+RETAIN_LOGS_DAYS = int(os.getenv("RETAIN_LOGS_DAYS", "90"))
+RETAIN_REPORTS_DAYS = int(os.getenv("RETAIN_REPORTS_DAYS", "400"))
+TTL_SWEEP_INTERVAL = int(os.getenv("TTL_SWEEP_INTERVAL", "60"))   # Mongo's TTL monitor period
+
+TTL_RULES = (
+    (database.processed_col, RETAIN_PROCESSED_DAYS),
+    (database.db.logs, RETAIN_LOGS_DAYS),
+)
+
+storage = {}    # collection -> {"count", "size", "storageSize", "totalIndexSize"}
+
+
+def _ensure_ttl(col, days):
+    seconds = days * database.DAY
+    try:
+        col.create_index([("at", ASCENDING)], expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict
+            raise
+        # retention changed since the index was built
+        database.db.command("collMod", col.name, index={"keyPattern": {"at": 1}, "expireAfterSeconds": seconds})
+    # pre-TTL docs have no "at" and would never expire
+    return col.update_many({"at": {"$exists": False}}, {"$set": {"at": datetime.now(timezone.utc)}}).modified_count
+
+
+def _ttl_rules():
+    """(col, field, seconds) of every TTL index this bot relies on."""
+    rules = [(col, "at", days * database.DAY) for col, days in TTL_RULES if days]
+    for col, keys, kwargs in database.INDEXES:
+        if "expireAfterSeconds" in kwargs:
+            rules.append((col, keys[0][0], kwargs["expireAfterSeconds"]))
+    return rules
+
+
+def _sweep(col, field, seconds):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    return col.delete_many({field: {"$lt": cutoff}}).deleted_count
+
+
+async def ttl_sweep():
+    """Delete expired docs by hand; returns {collection: deleted}."""
+    deleted = {}
+    for col, field, seconds in _ttl_rules():
+        count = await database.db_call(_sweep, col, field, seconds)
+        if count:
+            deleted[col.name] = deleted.get(col.name, 0) + count
+    return deleted
+
+
+def _storage_stats():
+    stats = {}
+    for name in database.db.list_collection_names():
+        s = database.db.command("collstats", name)
+        stats[name] = {k: s.get(k, 0) for k in ("count", "size", "storageSize", "totalIndexSize")}
+    return stats
+
+
+async def storage_stats():
+    storage.clear()
+    storage.update(await database.db_call(_storage_stats))
+    return dict(storage)
+
+
+metrics.gauge("collection_bytes", lambda: {
+    (("collection", name), ("kind", kind)): s[kind]
+    for name, s in storage.items() for kind in ("size", "storageSize", "totalIndexSize")
+})
+
+
+async def run_once():
+    started = time.perf_counter()
+    done = []
+    for col, days in TTL_RULES:
+        if days:
+            stamped = await database.db_call(_ensure_ttl, col, days)
+            done.append(f"{col.name} ttl {days}d ({stamped} stamped)")
+
+    if RETAIN_REPORTS_DAYS:
+        # day-aligned, so no daily bucket is rebuilt from half its rows
+        cutoff = int((time.time() - RETAIN_REPORTS_DAYS * database.DAY) // database.DAY * database.DAY)
+        buckets, deleted = await database.compact_reports(cutoff)
+        done.append(f"reports: {deleted} rows rolled into {buckets} buckets")
+
+    stats = await storage_stats()
+    total = sum(s["storageSize"] + s["totalIndexSize"] for s in stats.values())
+    LOGGER.info(
+        f"🧹 Retention pass in {time.perf_counter() - started:.2f}s: {'; '.join(done) or 'nothing enabled'}; "
+        f"storage {total / 1048576:.1f} MiB over {len(stats)} collections"
+    )
+
+
+async def _ttl_sweep_worker():
+    while True:
+        await asyncio.sleep(TTL_SWEEP_INTERVAL)
+        try:
+            deleted = await ttl_sweep()
+        except Exception as e:
+            LOGGER.warning(f"TTL sweep failed: {e!r}")
+            continue
+        if deleted:
+            LOGGER.info(f"🧹 TTL sweep: {', '.join(f'{n} {c}' for n, c in deleted.items())} expired")
+
+
+async def retention_worker():
+    if database.STORAGE_BACKEND != "mongo":
+        asyncio.create_task(_ttl_sweep_worker())
+    while True:
+        try:
+            await run_once()
+        except Exception as e:
+            LOGGER.warning(f"Retention pass failed: {e!r}")
+        await asyncio.sleep(RETENTION_INTERVAL)
@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from telethon.errors import FloodWaitError, RPCError, ServerError
+
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== OUTBOUND SEND QUEUE ==================
+#
+# Every Telegram write the bot makes on the deal path (replies, pins,
+# deletes, proof posts, kicks) goes through one queue so that bursts are
+# shaped by token buckets instead of being answered with FloodWait, and a
+# FloodWait is retried instead of silently losing the proof post / kick.
+
+REPLY = 0       # user-facing answers in the chat
+CLEANUP = 1     # pin / unpin / delete
+PROOF = 2       # proof channel mirror
+KICK = 3        # auto-kick bans
+
+PRIORITY_NAMES = {REPLY: "reply", CLEANUP: "cleanup", PROOF: "proof", KICK: "kick"}
+
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))        # msgs / second
+CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "0.33"))          # ~20 msgs / minute
+CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "20"))
+MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 = available now)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Job:
+    __slots__ = ("chat_id", "factory", "priority", "future", "attempts")
+
+    def __init__(self, chat_id, factory, priority, future):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+
+class SendQueue:
+
+    def __init__(self, workers=SEND_WORKERS, global_rate=GLOBAL_RATE,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_retries=MAX_RETRIES):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self._ready = []        # (priority, seq, job)
+        self._delayed = []      # (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._running = 0       # jobs a worker has started
+        self.counters = {"sent": 0, "failed": 0, "retried": 0, "flood_waits": 0}
+
+    # ---------- public API ----------
+
+    def submit(self, chat_id, factory, priority=REPLY):
+        """Queue `factory()` (returns an awaitable). Returns a future."""
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._push(_Job(chat_id, factory, priority, future))
+        return future
+
+    async def call(self, chat_id, factory, priority=REPLY):
+        """Queue and wait for the result; raises if it finally failed."""
+        return await self.submit(chat_id, factory, priority)
+
+    def depth(self):
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for _, _, job in self._ready + self._delayed:
+            depth[PRIORITY_NAMES[job.priority]] += 1
+        return depth
+
+    def stats(self):
+        return {**self.counters, "depth": self.depth(), "chats": len(self.chat_buckets)}
+
+    async def drain(self, timeout=10):
+        """Wait (bounded) until nothing is queued or running; used on shutdown."""
+        deadline = time.monotonic() + timeout
+        while (self._ready or self._delayed or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    # ---------- internals ----------
+
+    def _start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _push(self, job, delay=0.0):
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+        else:
+            heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+        self._wakeup.set()
+
+    def _promote(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+
+    def _bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            now = time.monotonic()
+            self._promote(now)
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, job = heapq.heappop(self._ready)
+            if job.future.done():   # caller gave up / cancelled
+                continue
+
+            chat = self._bucket(job.chat_id)
+            wait = chat.wait_time(now)
+            if wait > 0:
+                # don't hold a worker for one slow chat; others can go first
+                self._push(job, delay=wait)
+                continue
+
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                self.global_bucket.wait_time(time.monotonic())
+            chat.take()
+            self.global_bucket.take()
+            await self._run(job, chat)
+
+    async def _run(self, job, chat):
+        job.attempts += 1
+        self._running += 1
+        try:
+            async with metrics.timer("telegram_seconds", priority=PRIORITY_NAMES[job.priority]):
+                result = await job.factory()
+        except FloodWaitError as e:
+            self.counters["flood_waits"] += 1
+            chat.block(e.seconds)
+            LOGGER.warning(f"FloodWait {e.seconds}s on chat {job.chat_id} ({PRIORITY_NAMES[job.priority]})")
+            self._retry(job, e, e.seconds)
+        except (ServerError, ConnectionError, asyncio.TimeoutError) as e:
+            self._retry(job, e, min(2 ** job.attempts, 60))
+        except (RPCError, ValueError, TypeError) as e:
+            # permanent: no rights, message gone, bad entity ...
+            self.counters["failed"] += 1
+            LOGGER.debug(f"Send to {job.chat_id} failed: {e!r}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            # a bug in the job itself: fail it, but keep this worker alive
+            self.counters["failed"] += 1
+            LOGGER.warning(f"Send job for chat {job.chat_id} crashed: {e!r}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.counters["sent"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+
+    def _retry(self, job, error, delay):
+        if job.attempts > self.max_retries:
+            self.counters["failed"] += 1
+            LOGGER.warning(f"Giving up on chat {job.chat_id} after {job.attempts} attempts: {error!r}")
+            if not job.future.done():
+                job.future.set_exception(error)
+            return
+        self.counters["retried"] += 1
+        self._push(job, delay=delay)
+
+
+send_queue = SendQueue()
+
+metrics.gauge("send_queue_depth", lambda: {
+    (("priority", name),): depth for name, depth in send_queue.depth().items()
+})
+metrics.gauge("send_queue_events", lambda: {
+    (("event", name),): value for name, value in send_queue.counters.items()
+})
+
+
+def fire(chat_id, factory, priority):
+    """Submit without awaiting; failures are logged by the queue only."""
+    future = send_queue.submit(chat_id, factory, priority)
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import zlib
+from collections import deque
+from functools import wraps
+from pymongo.errors import DuplicateKeyError
+
+import database
+import metrics
+from leases import WORKER_ID
+from timers import timer_wheel
+from workqueue import chat_queues
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== WORKER SHARDING ==================
+#
+# SHARD_SLOTS > 0 runs the bot as several worker processes (each with its
+# own session of the same bot token, so every worker sees every update).
+# Chats hash onto SHARD_SLOTS slots (crc32, stable across processes), and
+# each slot is leased by exactly one worker in `shards`:
+#
+#   {_id: slot, owner, expires_at, renewed_at, released_at}
+#
+# A worker only handles the chats of its slots. Every SHARD_HEARTBEAT it
+# renews its leases and rebalances to ceil(SHARD_SLOTS / live workers):
+# extra slots are released (a worker joined), free or expired ones claimed
+# (a worker left or died; a dead one's leases run out after SHARD_LEASE_TTL).
+#
+# Handoff: the releasing worker stops handling a slot, lets what is in
+# flight for its chats finish (queued jobs, deal outbox effects, due
+# timers: chat_queues.wait_idle) and only then frees it.
+# Every worker keeps SHARD_REPLAY seconds of the other workers' updates,
+# and on taking a slot over replays the ones that arrived after the old
+# owner let go (or last renewed, if it died). What may run twice in that
+# window is already safe to repeat: form leases, deal transitions and the
+# outbox are all conditional writes.
+#
+# A slot's chats move with their in-memory state: open deals (database.py),
+# timers and outbox replays (timers.py), per-group deal id blocks.
+
+SHARD_SLOTS = int(os.getenv("SHARD_SLOTS", "0"))              # 0 = one worker, no sharding
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", "30"))
+SHARD_HEARTBEAT = float(os.getenv("SHARD_HEARTBEAT", "5"))
+SHARD_REPLAY = float(os.getenv("SHARD_REPLAY", "60"))         # seconds of others' updates kept
+SHARD_REPLAY_SIZE = int(os.getenv("SHARD_REPLAY_SIZE", "20000"))
+# workers see the same update at slightly different times: replay this much
+# earlier than the mark too (a repeat is harmless, a gap loses an update)
+SHARD_REPLAY_SKEW = float(os.getenv("SHARD_REPLAY_SKEW", "2"))
+# handing off waits this long for the slots' chats' running work to finish
+SHARD_HANDOFF_TIMEOUT = float(os.getenv("SHARD_HANDOFF_TIMEOUT", "10"))
+# session file suffix; Heroku sets DYNO ("worker.2")
+WORKER_NAME = os.getenv("WORKER_NAME") or os.getenv("DYNO") or str(os.getpid())
+
+shards_col = database.db.shards
+workers_col = database.db.workers
+
+
+def slot_of(chat_id):
+    return zlib.crc32(str(chat_id or 0).encode()) % SHARD_SLOTS
+
+
+class ShardMap:
+
+    def __init__(self, slots=SHARD_SLOTS, worker_id=WORKER_ID):
+        self.slots = slots
+        self.worker_id = worker_id
+        self.owned = set()
+        self.valid_until = 0.0  # leases last renewed + TTL: past it, handle nothing
+        self.on_gain = []       # async fn(owns) for chats just taken over
+        self.on_lose = []       # async fn(owns) for chats just handed off
+        self._recent = deque(maxlen=SHARD_REPLAY_SIZE)    # (arrived, slot, fn, event)
+        self._lock = asyncio.Lock()     # a rebalance and stop() never interleave
+        self._stopped = False
+        self.counters = {"gained": 0, "released": 0, "lost": 0, "replayed": 0}
+
+    @property
+    def enabled(self):
+        return self.slots > 0
+
+    def owns(self, chat_id):
+        if not self.slots:
+            return True
+        return slot_of(chat_id) in self.owned and time.time() < self.valid_until
+
+    def _in(self, slots):
+        slots = frozenset(slots)
+        return lambda chat_id: slot_of(chat_id) in slots
+
+    # ---------- events ----------
+
+    def gated(self, fn, always=None):
+        """Event handler decorator: run only for chats of owned slots (or
+        when `always(event)`); the rest is kept for a handoff replay."""
+        if not self.slots:
+            return fn
+
+        @wraps(fn)
+        async def wrapper(event):
+            if self.owns(event.chat_id) or (always is not None and always(event)):
+                return await fn(event)
+            now = time.time()
+            recent = self._recent
+            while recent and recent[0][0] < now - SHARD_REPLAY:
+                recent.popleft()
+            recent.append((now, slot_of(event.chat_id), fn, event))
+        return wrapper
+
+    def _replay(self, marks):
+        # in arrival order; handlers only queue on the chat before their
+        # first await, so per-chat order is kept
+        for arrived, slot, fn, event in [r for r in self._recent if r[1] in marks]:
+            if arrived >= marks[slot] - SHARD_REPLAY_SKEW:
+                self.counters["replayed"] += 1
+                asyncio.ensure_future(fn(event))
+
+    # ---------- leases ----------
+
+    def _heartbeat(self):
+        now = time.time()
+        workers_col.update_one({"_id": self.worker_id}, {"$set": {"seen": now}}, upsert=True)
+        live = workers_col.count_documents({"seen": {"$gt": now - SHARD_LEASE_TTL}})
+        held = {doc["_id"] for doc in shards_col.find(
+            {"owner": self.worker_id, "expires_at": {"$gt": now}}, {"_id": 1})}
+        shards_col.update_many(
+            {"_id": {"$in": list(held)}, "owner": self.worker_id},
+            {"$set": {"expires_at": now + SHARD_LEASE_TTL, "renewed_at": now}}
+        )
+        return now, live, held
+
+    def _claim(self, want):
+        now = time.time()
+        docs = {doc["_id"]: doc for doc in shards_col.find({})}
+        free = [s for s in range(self.slots)
+                if s not in docs or docs[s].get("owner") is None or docs[s].get("expires_at", 0) < now]
+        random.shuffle(free)    # joining workers do not all race for the same slots
+        marks = {}
+        for slot in free:
+            if len(marks) >= want:
+                break
+            try:
+                shards_col.update_one(
+                    {"_id": slot, "$or": [{"owner": None}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": self.worker_id, "expires_at": now + SHARD_LEASE_TTL,
+                              "renewed_at": now, "released_at": None}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                continue    # someone else was faster
+            prev = docs.get(slot) or {}
+            # replay from when the old owner stopped: let go, or last renewed
+            marks[slot] = prev.get("released_at") or prev.get("renewed_at") or 0
+        return now, marks
+
+    def _release(self, slots, stopped):
+        # released_at = when we stopped handling them, the new owner's replay mark
+        shards_col.update_many(
+            {"_id": {"$in": list(slots)}, "owner": self.worker_id},
+            {"$set": {"owner": None, "expires_at": 0, "released_at": stopped}}
+        )
+
+    async def rebalance(self):
+        async with self._lock:
+            if not self._stopped:
+                await self._rebalance()
+
+    async def _rebalance(self):
+        now, live, held = await database.db_call(self._heartbeat)
+        self.valid_until = now + SHARD_LEASE_TTL
+        lost = self.owned - held
+        if lost:
+            # our leases ran out (stalled) and were taken over
+            LOGGER.warning(f"🧩 Lost {len(lost)} slots to other workers")
+            self.counters["lost"] += len(lost)
+            await self._hand_off(lost)
+        target = -(-self.slots // max(live, 1))
+        extra = sorted(held)[target:]
+        if extra:
+            stopped = await self._hand_off(extra)
+            await database.db_call(self._release, extra, stopped)
+            self.counters["released"] += len(extra)
+        elif len(held) < target:
+            _, marks = await database.db_call(self._claim, target - len(held))
+            if marks:
+                await self._take_over(marks)
+        metrics.inc("shard_rebalance_total")
+
+    async def _hand_off(self, slots):
+        # stop handling first, finish what is in flight, then drop the
+        # state (and only then release)
+        self.owned -= set(slots)
+        stopped = time.time()
+        owns = self._in(slots)
+        # jobs queued before the stop, outbox effects and timers firing
+        # must not run alongside the new owner's replay, or store deals
+        # into state dropped below
+        if not await chat_queues.wait_idle(owns, SHARD_HANDOFF_TIMEOUT):
+            LOGGER.warning(f"🧩 Handing off {len(slots)} slots with jobs still running")
+        for fn in self.on_lose:
+            await fn(owns)
+        return stopped
+
+    async def _take_over(self, marks):
+        # state first, then handle: new updates wait in the replay buffer
+        owns = self._in(marks)
+        for fn in self.on_gain:
+            await fn(owns)
+        self.owned |= set(marks)
+        self.counters["gained"] += len(marks)
+        self._replay(marks)
+        LOGGER.info(f"🧩 Took over {len(marks)} slots, {len(self.owned)}/{self.slots} owned")
+
+    async def start(self):
+        await self.rebalance()
+        LOGGER.info(f"🧩 Worker {self.worker_id}: {len(self.owned)}/{self.slots} slots")
+
+    async def stop(self):
+        """Graceful leave: hand every slot back right away."""
+        # after a rebalance in flight (it could claim slots again after
+        # ours), and none after it
+        async with self._lock:
+            self._stopped = True
+            slots = list(self.owned)
+            stopped = await self._hand_off(slots)
+            await database.db_call(self._release, slots, stopped)
+            await database.db_call(workers_col.delete_one, {"_id": self.worker_id})
+
+
+shard_map = ShardMap()
+
+
+async def _load_state(owns):
+    await database.load_group_deals(owns)
+    await timer_wheel.load(owns)
+
+
+async def _drop_state(owns):
+    database.drop_group_deals(owns)
+    timer_wheel.drop(owns)
+    await database.release_deal_ids(owns)
+
+
+if shard_map.enabled:
+    database.owns_group = shard_map.owns
+    timer_wheel.owns = shard_map.owns
+    shard_map.on_gain.append(_load_state)
+    shard_map.on_lose.append(_drop_state)
+    metrics.gauge("shards", lambda: {
+        (("stat", name),): value
+        for name, value in {**shard_map.counters, "owned": len(shard_map.owned)}.items()
+    })
+
+
+async def shard_worker():
+    while True:
+        await asyncio.sleep(SHARD_HEARTBEAT)
+        try:
+            await shard_map.rebalance()
+        except Exception as e:
+            LOGGER.warning(f"Shard rebalance failed: {e!r}")
@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import timezone
+from bson import json_util
+
+from memstore import Collection, Database, MemoryClient
+
+# ================== SQLITE STORE ==================
+#
+# memstore with durability: every document lives in memory (same query
+# engine, same thread-safety) and each write operation is mirrored into
+# one SQLite table in WAL mode, committed before the call returns. On
+# start the table is read back into memory. Meant for single-worker
+# deployments (STORAGE_BACKEND=sqlite) that want no network round-trips.
+
+# canonical extended JSON keeps int / float / ObjectId / aware datetimes
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=True, tzinfo=timezone.utc)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    col TEXT NOT NULL,
+    id  TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (col, id)
+) WITHOUT ROWID
+"""
+
+
+def _dumps(value):
+    return json_util.dumps(value, json_options=JSON_OPTIONS)
+
+
+def _loads(text):
+    return json_util.loads(text, json_options=JSON_OPTIONS)
+
+
+class SqliteCollection(Collection):
+
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self._conn = database._conn
+        self._key = f"{database.name}.{name}"
+
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            try:
+                yield
+            finally:
+                self._conn.commit()
+
+    def _put(self, doc):
+        super()._put(doc)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO docs (col, id, doc) VALUES (?, ?, ?)",
+            (self._key, _dumps(doc["_id"]), _dumps(doc))
+        )
+
+    def _drop_doc(self, _id):
+        super()._drop_doc(_id)
+        self._conn.execute("DELETE FROM docs WHERE col = ? AND id = ?", (self._key, _dumps(_id)))
+
+
+class SqliteDatabase(Database):
+    collection_class = SqliteCollection
+
+    def __init__(self, name, conn, lock):
+        self._conn = conn
+        super().__init__(name)
+        self._lock = lock   # shared: all databases use the one connection
+        prefix = f"{name}."
+        rows = conn.execute(
+            "SELECT col, doc FROM docs WHERE substr(col, 1, ?) = ?", (len(prefix), prefix)
+        )
+        for col, doc in rows:
+            doc = _loads(doc)
+            self[col[len(prefix):]]._docs[doc["_id"]] = doc
+
+    def command(self, name, *args, **kwargs):
+        if name == "collstats" and args:
+            with self._lock:
+                count, size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(doc) + LENGTH(id)), 0) FROM docs WHERE col = ?",
+                    (f"{self.name}.{args[0]}",)
+                ).fetchone()
+            return {"count": count, "size": size, "storageSize": size, "totalIndexSize": 0}
+        return super().command(name, *args, **kwargs)
+
+
+class SqliteClient(MemoryClient):
+    """Drop-in for pymongo.MongoClient backed by a SQLite file."""
+
+    def __init__(self, path, **kwargs):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+
+    def __getitem__(self, name):
+        db = self._dbs.get(name)
+        if db is None:
+            db = self._dbs[name] = SqliteDatabase(name, self._conn, self._lock)
+        return db
+
+    def close(self):
+        self._conn.close()
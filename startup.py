@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import time
+
+import database
+from group_auth import authorized_groups, load_auth_groups
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== STARTUP WARM-UP ==================
+#
+# Runs once after register_handlers(): index builds go to the background,
+# then the state every handler reads on its first event is pulled into
+# memory in parallel (auth registry, proof channels / forms, running
+# deals), so a restarted worker does not serve its first minutes cold.
+
+
+async def _step(name, coro, timings):
+    started = time.perf_counter()
+    result = await coro
+    timings[name] = time.perf_counter() - started
+    return result
+
+
+async def warm_up():
+    started = time.perf_counter()
+    timings = {}
+
+    # not awaited: builds are idempotent; the /add lease claim waits for
+    # them through database.indexes_ready()
+    database.ensure_indexes()
+
+    await _step("ping", database.db_call(database.db.command, "ping"), timings)
+
+    async def auth_and_config():
+        groups = await _step("auth_groups", load_auth_groups(), timings)
+        # authorized groups without a proof channel / form get cached as such
+        return groups, await _step("config", database.warm_config(authorized_groups()), timings)
+
+    (groups, (proofs, forms)), deals = await asyncio.gather(
+        auth_and_config(),
+        _step("running_deals", database.load_running_deals(), timings),
+    )
+
+    LOGGER.info(
+        f"✅ Ready in {time.perf_counter() - started:.2f}s: {groups} groups, {deals} running deals, "
+        f"{proofs} proof channels, {forms} forms "
+        f"({', '.join(f'{k} {v * 1000:.0f}ms' for k, v in timings.items())})"
+    )
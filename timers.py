@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import time
+from bson import ObjectId
+
+import database
+import metrics
+from sender import CLEANUP, send_queue
+from workqueue import chat_queues
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== TIMER WHEEL ==================
+#
+# One shared service for "do X at time T" (delete a message, kick a deal's
+# users, expire a deal ...). Timers live in a hashed wheel of TIMER_SLOTS
+# buckets of TIMER_TICK seconds: schedule() and cancel() are O(1), one
+# task advances the wheel, and each tick only looks at its own bucket
+# (timers further out than one revolution just stay put until their turn).
+#
+# Every timer is also a doc in `timers` ({_id, kind, due, payload, chat}),
+# inserted through the write-behind buffer and deleted once fired, so
+# pending timers are reloaded after a restart. Handlers are registered
+# per kind: @timer_wheel.handler("kick") async def fn(client, payload).
+#
+# With several workers (shards.py) each one only loads the timers of the
+# chats it owns, and hands them over (drop / load) when chats move.
+#
+# Due timers fire as background tasks (at most TIMER_CONCURRENCY handlers
+# at once), so a slow kick or a burst of expiries does not hold up the
+# ticks after it.
+
+TIMER_TICK = float(os.getenv("TIMER_TICK", "1"))
+TIMER_SLOTS = int(os.getenv("TIMER_SLOTS", "4096"))
+TIMER_CONCURRENCY = int(os.getenv("TIMER_CONCURRENCY", "64"))     # handlers running at once
+
+timers_col = database.db.timers
+
+
+class TimerWheel:
+
+    def __init__(self, col, tick=TIMER_TICK, slots=TIMER_SLOTS, concurrency=TIMER_CONCURRENCY):
+        self.col = col
+        self.tick = tick
+        self._sem = asyncio.Semaphore(concurrency)
+        self._firing = set()    # batch tasks still running
+        self.buckets = [[] for _ in range(slots)]
+        self.entries = {}       # timer id -> [id, kind, due_tick, payload, cancelled, chat]
+        self.handlers = {}      # kind -> async fn(client, payload)
+        # async fn(owns) run after the persisted timers load; owns(chat_id)
+        # tells which chats that load was for
+        self.startup = []
+        self.owns = None        # chat_id -> bool, set by shards.py
+        self.current = int(time.time() // tick)
+        self.counters = {"scheduled": 0, "fired": 0, "failed": 0, "cancelled": 0}
+
+    def handler(self, kind):
+        def deco(fn):
+            self.handlers[kind] = fn
+            return fn
+        return deco
+
+    def __len__(self):
+        return len(self.entries)
+
+    # ---------- scheduling ----------
+
+    def _add(self, timer_id, kind, due, payload, chat_id=None):
+        due_tick = max(int(-(-due // self.tick)), self.current + 1)
+        entry = [timer_id, kind, due_tick, payload, False, chat_id]
+        self.entries[timer_id] = entry
+        self.buckets[due_tick % len(self.buckets)].append(entry)
+
+    def schedule(self, kind, due, payload, timer_id=None, chat_id=None):
+        """Run handler `kind` with `payload` at unix time `due`.
+
+        Ids are unique: scheduling an id that is already pending is a no-op,
+        so recovery code can re-schedule deterministically named timers.
+        `chat_id` is the chat the timer acts on (whose worker runs it)."""
+        timer_id = timer_id or f"{kind}:{ObjectId()}"
+        if timer_id in self.entries:
+            return timer_id
+        self._add(timer_id, kind, due, payload, chat_id)
+        self.counters["scheduled"] += 1
+        database.write_buffer.insert(self.col, {"_id": timer_id, "kind": kind, "due": due,
+                                                "payload": payload, "chat": chat_id})
+        return timer_id
+
+    def cancel(self, timer_id):
+        entry = self.entries.pop(timer_id, None)
+        if entry is None:
+            return False
+        entry[4] = True     # dropped from its bucket lazily
+        self.counters["cancelled"] += 1
+        asyncio.ensure_future(self._forget([timer_id]))
+        return True
+
+    async def _forget(self, ids):
+        # the insert may still be buffered; flush first or it lands after the delete
+        await database.write_buffer.flush()
+        await database.db_call(self.col.delete_many, {"_id": {"$in": ids}})
+
+    # ---------- running ----------
+
+    async def load(self, owns=None):
+        """Load the persisted timers (of the chats `owns` accepts) and run
+        the startup hooks for them; timers already pending are kept."""
+        owns = owns or _everything
+        docs = await database.db_call(lambda: list(self.col.find({})))
+        for doc in docs:
+            chat_id = doc.get("chat", _legacy_chat(doc.get("payload")))
+            if doc["_id"] not in self.entries and owns(chat_id):
+                self._add(doc["_id"], doc["kind"], doc["due"], doc.get("payload"), chat_id)
+        for fn in self.startup:
+            await fn(owns)
+        LOGGER.info(f"⏰ Timers: {len(self.entries)} pending loaded")
+
+    def drop(self, owns):
+        """Forget the timers of the chats `owns` accepts, in memory only:
+        their docs stay for the worker taking those chats over."""
+        dropped = [entry for entry in self.entries.values() if owns(entry[5])]
+        for entry in dropped:
+            entry[4] = True
+            del self.entries[entry[0]]
+        return len(dropped)
+
+    def _due(self, now_tick):
+        due = []
+        # after a long stall, one revolution visits every bucket once
+        start = max(self.current + 1, now_tick - len(self.buckets) + 1)
+        for t in range(start, now_tick + 1):
+            bucket = self.buckets[t % len(self.buckets)]
+            if not bucket:
+                continue
+            keep = []
+            for entry in bucket:
+                if entry[4]:
+                    continue
+                if entry[2] <= now_tick:
+                    due.append(entry)
+                    self.entries.pop(entry[0], None)
+                else:
+                    keep.append(entry)
+            bucket[:] = keep
+        self.current = now_tick
+        return due
+
+    async def _fire(self, client, entry):
+        timer_id, kind, _, payload, _, _ = entry
+        fn = self.handlers.get(kind)
+        if fn is None:
+            LOGGER.warning(f"No timer handler for {kind!r}, dropping {timer_id}")
+            return
+        try:
+            async with self._sem:
+                await fn(client, payload)
+            self.counters["fired"] += 1
+        except Exception as e:
+            self.counters["failed"] += 1
+            LOGGER.warning(f"Timer {timer_id} failed: {e!r}")
+
+    async def run(self, client):
+        await self.load(self.owns)
+        while True:
+            now = time.time()
+            await asyncio.sleep(max(0.0, (int(now // self.tick) + 1) * self.tick - now))
+            due = self._due(int(time.time() // self.tick))
+            if not due:
+                continue
+            task = asyncio.create_task(self._fire_batch(client, due))
+            self._firing.add(task)
+            task.add_done_callback(self._firing.discard)
+            # a handoff waits for the batch, docs deleted included, or the
+            # new owner loads and fires them again
+            for chat_id in {entry[5] for entry in due}:
+                chat_queues.track(chat_id, task)
+
+    async def _fire_batch(self, client, due):
+        await asyncio.gather(*(self._fire(client, entry) for entry in due))
+        try:
+            await self._forget([entry[0] for entry in due])
+        except Exception as e:
+            # fired already; a restart would only run them again
+            LOGGER.warning(f"Deleting {len(due)} fired timers failed: {e!r}")
+
+
+def _everything(chat_id):
+    return True
+
+
+def _legacy_chat(payload):
+    # timers persisted before docs carried "chat"
+    payload = payload or {}
+    return payload.get("group_id") or payload.get("chat_id")
+
+
+timer_wheel = TimerWheel(timers_col)
+
+metrics.gauge("timers", lambda: {
+    (("stat", name),): value
+    for name, value in {**timer_wheel.counters, "pending": len(timer_wheel)}.items()
+})
+
+
+async def timer_worker(client):
+    await timer_wheel.run(client)
+
+
+# ================== COMMON TIMERS ==================
+
+@timer_wheel.handler("delete")
+async def _delete_messages(client, payload):
+    chat_id = payload["chat_id"]
+    await send_queue.call(chat_id, lambda: client.delete_messages(chat_id, payload["msg_ids"]), CLEANUP)
+
+
+def delete_later(delay, chat_id, *msg_ids):
+    """Delete messages after `delay` seconds (survives restarts)."""
+    return timer_wheel.schedule("delete", time.time() + delay,
+                                {"chat_id": chat_id, "msg_ids": [int(m) for m in msg_ids]}, chat_id=chat_id)
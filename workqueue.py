@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from functools import wraps
+
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== PER-CHAT WORK QUEUES ==================
+#
+# Every handler runs through the queue of its chat: jobs of one chat run
+# one at a time in arrival order, different chats run in parallel up to
+# CHAT_CONCURRENCY. A chat whose backlog reaches CHAT_BACKLOG drops new
+# jobs instead of growing without bound, so one flooded group costs the
+# others nothing but its share of the concurrency limit.
+#
+# later() replaces "await asyncio.sleep(n)" inside handlers: the action is
+# put on a timer heap and queued on its chat when due, instead of a
+# coroutine being parked for minutes.
+#
+# Work for a chat that runs outside its queue (deal outbox effects, due
+# timers) is registered with track(), so wait_idle() - a shard handoff,
+# shutdown - waits for it too.
+
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "64"))
+CHAT_BACKLOG = int(os.getenv("CHAT_BACKLOG", "200"))
+
+
+class ChatBusy(Exception):
+    """The chat's backlog is full; the job was not queued."""
+
+
+class ChatQueues:
+
+    def __init__(self, concurrency=CHAT_CONCURRENCY, backlog=CHAT_BACKLOG):
+        self.backlog = backlog
+        self._sem = asyncio.Semaphore(concurrency)
+        self._queues = {}       # chat_id -> deque[(factory, future, queued_at)]
+        self._timers = []       # (due, seq, chat_id, factory)
+        self._seq = itertools.count()
+        self._timer_task = None
+        self._timer_wakeup = None
+        self._tracked = {}      # chat_id -> set of background tasks
+        self.counters = {"run": 0, "failed": 0, "dropped": 0, "deferred": 0}
+
+    # ---------- public API ----------
+
+    def submit(self, chat_id, factory):
+        """Queue `factory()` (returns an awaitable) on the chat; returns a future."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            asyncio.create_task(self._drain(chat_id, queue))
+        elif len(queue) >= self.backlog:
+            self.counters["dropped"] += 1
+            metrics.inc("chat_jobs_dropped_total")
+            future.set_exception(ChatBusy(chat_id))
+            return future
+        queue.append((factory, future, time.monotonic()))
+        return future
+
+    async def run(self, chat_id, factory):
+        """Queue and wait; ChatBusy is swallowed (the job is dropped)."""
+        try:
+            return await self.submit(chat_id, factory)
+        except ChatBusy:
+            LOGGER.warning(f"Chat {chat_id} backlog full ({self.backlog}), dropping job")
+
+    def serial(self, fn):
+        """Decorator: run an event handler on its chat's queue."""
+        @wraps(fn)
+        async def wrapper(event):
+            return await self.run(event.chat_id, lambda: fn(event))
+        return wrapper
+
+    def later(self, delay, chat_id, factory):
+        """Queue `factory()` on the chat after `delay` seconds."""
+        self.counters["deferred"] += 1
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._seq), chat_id, factory))
+        if self._timer_task is None:
+            self._timer_wakeup = asyncio.Event()
+            self._timer_task = asyncio.create_task(self._timer())
+        self._timer_wakeup.set()
+
+    def track(self, chat_id, task):
+        """Count `task` as work of the chat until it is done."""
+        tasks = self._tracked.setdefault(chat_id, set())
+        tasks.add(task)
+        task.add_done_callback(lambda t: self._untrack(chat_id, t))
+        return task
+
+    def _untrack(self, chat_id, task):
+        tasks = self._tracked.get(chat_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tracked[chat_id]
+
+    def depth(self):
+        return {chat_id: len(q) for chat_id, q in self._queues.items()}
+
+    def stats(self):
+        depth = self.depth()
+        return {**self.counters, "chats": len(depth), "queued": sum(depth.values()),
+                "timers": len(self._timers)}
+
+    async def wait_idle(self, chats, timeout):
+        """Wait until no chat with chats(chat_id) has a job queued or
+        running, or a tracked task; False if some still do after `timeout`
+        seconds."""
+        deadline = time.monotonic() + timeout
+        while any(chats(chat_id) for chat_id in [*self._queues, *self._tracked]):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    # ---------- internals ----------
+
+    async def _drain(self, chat_id, queue):
+        # one drainer per chat with pending work; it exits (and the chat
+        # is forgotten) as soon as the queue is empty
+        try:
+            while queue:
+                factory, future, queued_at = queue[0]
+                metrics.observe("chat_queue_wait_seconds", time.monotonic() - queued_at)
+                try:
+                    async with self._sem:
+                        result = await factory()
+                except Exception as e:
+                    # surfaced to whoever awaits the job (the handler task)
+                    self.counters["failed"] += 1
+                    if not future.done():
+                        future.set_exception(e)
+                except BaseException:
+                    future.cancel()
+                    raise
+                else:
+                    self.counters["run"] += 1
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    queue.popleft()
+        finally:
+            if self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+            for _, future, _ in queue:  # only left over when cancelled
+                future.cancel()
+
+    async def _timer(self):
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, chat_id, factory = heapq.heappop(self._timers)
+                self.submit(chat_id, factory).add_done_callback(_log_failure)
+            timeout = self._timers[0][0] - now if self._timers else None
+            self._timer_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._timer_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception():
+        LOGGER.warning(f"Deferred job failed: {future.exception()!r}")
+
+
+chat_queues = ChatQueues()
+
+metrics.gauge("chat_queue", lambda: {
+    (("stat", name),): value for name, value in chat_queues.stats().items()
+})
+# the noisiest chats, so one group's backlog is visible on its own
+metrics.gauge("chat_backlog", lambda: {
+    (("chat", str(chat_id)),): depth
+    for chat_id, depth in sorted(chat_queues.depth().items(), key=lambda kv: -kv[1])[:10]
+})
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+LOGGER = logging.getLogger(__name__)
+
+# ================== WRITE-BEHIND BUFFER ==================
+#
+# Coalesces $inc upserts per (collection, filter) and batches inserts per
+# collection, then flushes them with one bulk_write / insert_many per
+# collection every `interval` seconds or once `max_batch` ops are pending.
+# interval=0 flushes on every write (no buffering).
+#
+# inc(..., once=key) is applied at most once per key, however often it is
+# buffered again (outbox retries, replays after a crash): it is not summed
+# with other increments, and lands as a conditional $inc that also pushes
+# the key onto the doc's `counted` list (the last ONCE_WINDOW keys).
+#
+# Only give a key to what must not count twice (a deal's stats): each
+# keyed op costs an extra upsert and a `counted` entry on the doc, which
+# readers should project out. Other increments merge into one plain $inc
+# upsert per doc. Inserts get their _id when buffered, so retrying a
+# flush whose outcome is unknown (connection lost mid-write) skips the
+# inserts and keyed $incs that landed; plain $incs may then count twice.
+# A bulk error names the ops that failed: only those stay queued.
+
+ONCE_WINDOW = 1000
+
+
+class WriteBehind:
+
+    def __init__(self, run, interval=1.0, max_batch=500):
+        self.run = run                  # database.db_call
+        self.interval = interval
+        self.max_batch = max_batch
+        self._updates = {}              # (col name, filter key, once) -> [col, filter, inc, set, set_on_insert, once]
+        self._inserts = {}              # col name -> [col, [docs]]
+        self._pending = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.ops_in = 0
+        self.ops_out = 0
+
+    # ---------- producers ----------
+
+    def inc(self, col, filter, inc, set=None, set_on_insert=None, once=None):
+        key = (col.name, tuple(sorted(filter.items())), once)
+        entry = self._updates.get(key)
+        if entry is None:
+            self._updates[key] = [col, filter, dict(inc), dict(set or {}), dict(set_on_insert or {}), once]
+            self._pending += 1
+        elif once is None:
+            for field, value in inc.items():
+                entry[2][field] = entry[2].get(field, 0) + value
+            entry[3].update(set or {})
+            for field, value in (set_on_insert or {}).items():
+                entry[4].setdefault(field, value)
+        self.ops_in += 1
+
+    def insert(self, col, doc):
+        doc.setdefault("_id", ObjectId())     # a retried insert is a duplicate, not a second row
+        entry = self._inserts.get(col.name)
+        if entry is None:
+            entry = self._inserts[col.name] = [col, []]
+        entry[1].append(doc)
+        self._pending += 1
+        self.ops_in += 1
+
+    async def maybe_flush(self):
+        """Call after producing; flushes inline when due, else arms the
+        timer. A failed inline flush is left to the timer to retry: the
+        caller's writes are queued either way."""
+        if not self.interval or self._pending >= self.max_batch:
+            try:
+                await self.flush()
+                return
+            except Exception as e:
+                LOGGER.warning(f"Write-behind flush failed, will retry: {e!r}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._timer())
+
+    def pending(self):
+        return self._pending
+
+    # ---------- flushing ----------
+
+    async def _timer(self):
+        while True:
+            await asyncio.sleep(self.interval or 1.0)   # write-through: only failed flushes get here
+            if self._pending:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    LOGGER.warning(f"Write-behind flush failed, will retry: {e!r}")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            updates, inserts = self._updates, self._inserts
+            self._updates, self._inserts, self._pending = {}, {}, 0
+            try:
+                await self.run(self._write, updates, inserts)
+            except Exception:
+                self._requeue(updates, inserts)
+                raise
+            self.flushes += 1
+
+    def _write(self, updates, inserts):
+        # entries are removed as they land; what is left is requeued
+        ready, keyed = {}, {}   # col name -> [col, ops, keys]; keyed ops run second
+        for key, (col, filter, inc, set_, set_on_insert, once) in updates.items():
+            update = {}
+            if inc:
+                update["$inc"] = inc
+            if set_:
+                update["$set"] = set_
+            batch = ready.setdefault(col.name, [col, [], []])
+            if once is None:
+                if set_on_insert:
+                    update["$setOnInsert"] = set_on_insert
+                batch[1].append(UpdateOne(filter, update, upsert=True))
+                batch[2].append((key, True))
+            else:
+                # create the doc first (upserting the conditional update
+                # would insert a second doc once it is counted), then $inc
+                # only where `once` is not counted yet
+                batch[1].append(UpdateOne(filter, {"$setOnInsert": {**set_on_insert, "counted": []}}, upsert=True))
+                batch[2].append((key, False))
+                update["$push"] = {"counted": {"$each": [once], "$slice": -ONCE_WINDOW}}
+                batch = keyed.setdefault(col.name, [col, [], []])
+                batch[1].append(UpdateOne({**filter, "counted": {"$ne": once}}, update))
+                batch[2].append((key, True))
+        errors = []
+        blocked = set()     # keyed ops whose doc may not exist
+        for col, ops, keys in ready.values():
+            failed = self._bulk(col, ops, keys, errors)
+            blocked.update(failed)
+            for key, done in keys:
+                if done and key not in failed:
+                    del updates[key]
+        for col, ops, keys in keyed.values():
+            if blocked:
+                ops = [op for op, (key, _) in zip(ops, keys) if key not in blocked]
+                keys = [k for k in keys if k[0] not in blocked]
+            failed = self._bulk(col, ops, keys, errors) if ops else set()
+            for key, _ in keys:
+                if key not in failed:
+                    del updates[key]
+        for name, (col, docs) in list(inserts.items()):
+            try:
+                col.insert_many(docs, ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                if e.details.get("writeConcernErrors"):
+                    raise   # outcome unknown: retry all (the _ids dedupe)
+                # a retried batch may be partly in already: dupes are done
+                failed = [docs[err["index"]] for err in e.details.get("writeErrors", [])
+                          if err.get("code") != 11000]
+                if failed:
+                    errors.append(e)
+            self.ops_out += 1
+            if failed:
+                inserts[name][1] = failed
+            else:
+                del inserts[name]
+        if errors:
+            raise errors[0]
+
+    def _bulk(self, col, ops, keys, errors):
+        """bulk_write; the keys of the ops that failed (and did not land)."""
+        self.ops_out += 1
+        try:
+            col.bulk_write(ops, ordered=False)
+            return set()
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise   # outcome unknown: retry all (keyed $incs dedupe)
+            errors.append(e)
+            return {keys[err["index"]][0] for err in e.details.get("writeErrors", [])}
+
+    def _requeue(self, updates, inserts):
+        ops_in = self.ops_in
+        for col, filter, inc, set_, set_on_insert, once in updates.values():
+            self.inc(col, filter, inc, set_, set_on_insert, once)
+        for col, docs in inserts.values():
+            for doc in docs:
+                self.insert(col, doc)
+        self.ops_in = ops_in
+
+    async def close(self):
+        """Durable flush on shutdown."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()